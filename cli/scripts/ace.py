@@ -4,12 +4,16 @@
 """ACE is the place of the Anti Chaos Engine"""
 
 import ast
+import csv
+import importlib.util
+import io
 import json
 import os
 import sys
 import re
-import subprocess
 from datetime import datetime
+from itertools import islice
+from types import SimpleNamespace
 import logging
 
 import fire
@@ -19,9 +23,15 @@ import cluster
 import util
 import ace_db
 import ace_api
+import ace_connections
+import ace_diff_index
+import ace_metadata
+import ace_nodes
 import ace_config as config
 from ace_data_models import (
+    ClusterSweepTask,
     RepsetDiffTask,
+    RepsetRepairTask,
     SchemaDiffTask,
     SpockDiffTask,
     TableDiffTask,
@@ -139,71 +149,71 @@ def get_row_count(p_con, p_schema, p_table):
     return rows
 
 
-def get_cols(p_con, p_schema, p_table):
+def get_row_estimate(p_con, p_schema, p_table):
+    """
+    Returns the planner's estimate of the number of rows in a table, without
+    scanning it: reltuples scaled to the current size of the table, or the live
+    tuple count from pg_stat_user_tables, whichever is larger. Returns None if
+    the table has no statistics yet.
+    """
+
     sql = """
-    SELECT ordinal_position, column_name
-    FROM information_schema.columns
-    WHERE table_schema = %s and table_name = %s
-    ORDER BY 1, 2
+    SELECT CASE
+               WHEN c.reltuples < 0 THEN NULL
+               WHEN c.relpages = 0 THEN c.reltuples
+               ELSE c.reltuples / c.relpages
+                    * (pg_relation_size(c.oid) / current_setting('block_size')::int)
+           END::bigint,
+           s.n_live_tup
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+    WHERE n.nspname = %s AND c.relname = %s
     """
 
     try:
         cur = p_con.cursor()
-        cur.execute(
-            sql,
-            [
-                p_schema,
-                p_table,
-            ],
-        )
-        rows = cur.fetchall()
+        cur.execute(sql, [p_schema, p_table])
+        r = cur.fetchone()
+
+        estimates = [int(x) for x in (r or []) if x is not None]
+        rows = max(estimates) if estimates else None
+
+        # Statistics may not cover rows loaded since the last analyze yet. A
+        # table that has any rows must never be taken for an empty one.
+        if rows == 0:
+            cur.execute(f'SELECT EXISTS (SELECT 1 FROM {p_schema}."{p_table}")')
+            rows = 1 if cur.fetchone()[0] else 0
+
         cur.close()
+    except Exception as e:
+        util.exit_message("Error in get_row_estimate():\n" + str(e), 1)
+
+    return rows
+
+
+def get_cols(p_con, p_schema, p_table):
+    try:
+        metadata = ace_metadata.get_table_metadata(p_con, p_schema, p_table)
     except Exception as e:
         util.exit_message("Error in get_cols():\n" + str(e), 1)
 
-    if not rows:
+    if not metadata or not metadata["cols"]:
         return None
 
-    col_lst = []
-    for row in rows:
-        col_lst.append(str(row[1]))
-
-    return ",".join(col_lst)
+    return ",".join(metadata["cols"])
 
 
 def get_key(p_con, p_schema, p_table):
-    sql = """
-    SELECT C.COLUMN_NAME
-    FROM INFORMATION_SCHEMA.TABLE_CONSTRAINTS T,
-    INFORMATION_SCHEMA.CONSTRAINT_COLUMN_USAGE C
-    WHERE c.constraint_name = t.constraint_name
-    AND c.table_schema = t.constraint_schema
-    AND c.table_schema = %s AND c.table_name = %s
-    AND T.CONSTRAINT_TYPE='PRIMARY KEY'
-    """
-
     try:
-        cur = p_con.cursor()
-        cur.execute(
-            sql,
-            [
-                p_schema,
-                p_table,
-            ],
-        )
-        rows = cur.fetchall()
-        cur.close()
+        metadata = ace_metadata.get_table_metadata(p_con, p_schema, p_table)
     except Exception as e:
         util.exit_message("Error in get_key():\n" + str(e), 1)
 
-    if not rows:
+    if not metadata or not metadata["key"]:
         return None
 
-    key_lst = []
-    for row in rows:
-        key_lst.append(str(row[0]))
-
-    return ",".join(key_lst)
+    return ",".join(metadata["key"])
 
 
 def parse_nodes(nodes, quiet_mode=False) -> list:
@@ -226,38 +236,92 @@ def parse_nodes(nodes, quiet_mode=False) -> list:
     return node_list
 
 
-def get_row_types(conn, table_name):
+def check_deadline(deadline):
     """
-    Here we are grabbing the name and data type of each row from table from the
-    given conn. Using this complex query instead of a simpler one since this
-    gives the correct name of non standard datatypes (i.e. vectors from Vector
-    and geometries from PostGIS)
+    Validates a task deadline given in seconds. None or 0 means that the task
+    has no deadline.
+    """
+
+    if deadline is None:
+        return None
+
+    try:
+        deadline = float(deadline)
+    except (TypeError, ValueError):
+        raise AceException("Invalid value for ACE_TASK_DEADLINE or --deadline")
+
+    if deadline < 0:
+        raise AceException("Deadline should be a positive number of seconds")
+
+    return deadline or None
+
+
+def check_parallel_workers(parallel_workers):
+    """
+    Validates the number of Postgres parallel workers per block hash. None or 0
+    means that blocks are hashed without parallel query.
     """
 
-    psql_qry = """
-        SELECT
-            a.attname AS column_name,
-            pg_catalog.format_type(a.atttypid, a.atttypmod) AS data_type
-        FROM
-            pg_catalog.pg_attribute a
-        JOIN
-            pg_catalog.pg_class c ON a.attrelid = c.oid
-        JOIN
-            pg_catalog.pg_type t ON a.atttypid = t.oid
-        LEFT JOIN
-            pg_catalog.pg_namespace n ON c.relnamespace = n.oid
-        WHERE
-            c.relname = %s
-            AND a.attnum > 0
-            AND NOT a.attisdropped
-        ORDER BY
-            a.attnum;
+    if parallel_workers is None:
+        return 0
+
+    try:
+        parallel_workers = int(parallel_workers)
+    except (TypeError, ValueError):
+        raise AceException("Invalid value for --parallel_workers")
+
+    if parallel_workers < 0 or parallel_workers > config.MAX_PARALLEL_HASH_WORKERS:
+        raise AceException(
+            "Parallel workers should be between 0 and "
+            f"{config.MAX_PARALLEL_HASH_WORKERS}"
+        )
+
+    return parallel_workers
+
+
+def check_throttle(task):
+    """
+    Validates the low-impact options of a diff task. Setting a rate implies
+    low_impact; low_impact without a rate uses the configured default rates.
     """
 
     try:
-        cur = conn.cursor()
-        cur.execute(psql_qry, (table_name,))
-        table_types = {col_name: col_type for col_name, col_type in cur.fetchall()}
+        rows_per_sec = float(task.max_rows_per_sec or 0)
+        mb_per_sec = float(task.max_mb_per_sec or 0)
+    except (TypeError, ValueError):
+        raise AceException("Invalid value for --max_rows_per_sec or --max_mb_per_sec")
+
+    if rows_per_sec < 0 or mb_per_sec < 0:
+        raise AceException("Rate limits should be positive numbers")
+
+    low_impact = task.low_impact
+    if type(low_impact) is str:
+        low_impact = low_impact.lower() in ("true", "1", "yes")
+
+    if rows_per_sec or mb_per_sec:
+        low_impact = True
+    elif low_impact:
+        rows_per_sec = config.THROTTLE_ROWS_PER_SEC_DEFAULT
+        mb_per_sec = config.THROTTLE_MB_PER_SEC_DEFAULT
+
+    task.low_impact = bool(low_impact)
+    task.max_rows_per_sec = rows_per_sec or None
+    task.max_mb_per_sec = mb_per_sec or None
+
+    return task
+
+
+def get_row_types(conn, schema_name, table_name):
+    """
+    Here we are grabbing the name and data type of each row from table from the
+    given conn. The cached metadata uses format_type() instead of
+    information_schema since this gives the correct name of non standard
+    datatypes (i.e. vectors from Vector and geometries from PostGIS)
+    """
+
+    try:
+        metadata = ace_metadata.get_table_metadata(conn, schema_name, table_name)
+        table_types = dict(metadata["types"]) if metadata else dict()
     except Exception:
         table_types = dict()
 
@@ -276,7 +340,7 @@ def check_cluster_exists(cluster_name, base_dir="cluster"):
     return True if os.path.exists(cluster_dir) else False
 
 
-def write_diffs_json(diff_dict, row_types, quiet_mode=False):
+def write_diffs_json(diff_store, row_types, quiet_mode=False, key=None):
 
     def convert_to_json_type(item: str, type: str):
         try:
@@ -315,26 +379,33 @@ def write_diffs_json(diff_dict, row_types, quiet_mode=False):
 
     filename = os.path.join(dirname, diff_filename)
 
-    # Converts diff so that values are correct json type
+    # Converts diff so that values are correct json type. Rows are converted
+    # as they are streamed out of the spill file of the diff.
     write_dict = {
         node_pair: {
-            node: [
+            node: (
                 {
                     key: convert_to_json_type(val, row_types[key])
                     for key, val in row.items()
                 }
                 for row in rows
-            ]
+            )
             for node, rows in nodes_data.items()
         }
-        for node_pair, nodes_data in diff_dict.items()
+        for node_pair, nodes_data in diff_store.items()
     }
 
-    if not quiet_mode:
-        with open(filename, "w") as f:
-            f.write(json.dumps(write_dict, default=str))
+    if not quiet_mode and key:
+        # Also writes the key index that table-rerun and table-repair read
+        ace_diff_index.write_diff_file(filename, write_dict, key.split(","))
+    elif not quiet_mode:
+        with open(filename, "wb") as f:
+            ace_diff_index.dump_diffs(f, write_dict)
     else:
-        print(json.dumps(write_dict, default=str))
+        # JSON is all ASCII, so every chunk decodes on its own
+        stdout = SimpleNamespace(write=lambda data: sys.stdout.write(data.decode()))
+        ace_diff_index.dump_diffs(stdout, write_dict)
+        print()
 
     util.message(
         f"Diffs written out to" f" {util.set_colour(filename, 'blue')}",
@@ -344,56 +415,109 @@ def write_diffs_json(diff_dict, row_types, quiet_mode=False):
     return filename
 
 
-# TODO: Come up with better naming convention for diff files
-def write_diffs_csv(diff_dict):
-    import pandas as pd
-
+def write_diffs_csv(diff_store, quiet_mode=False, output="csv"):
     """
-    All diff runs from ACE will be stored in diffs/<date>/diffs_<time>.json
-    Each day will have its own directory and each run will have its own file
-    that indicates the time of the run.
+    Writes the rows of every node pair to diffs/<date>/<node1>_<node2>_<time>
+    as CSV or Parquet, with the node of each row in its first column. A unified
+    summary of all node pairs, with the rows of each primary key next to each
+    other, goes to diffs/<date>/diffs_<time>.diff. Rows are streamed out of the
+    spill file of the diff. Returns the path of the summary.
     """
-    now = datetime.now()
-    dirname = now.strftime("%Y-%m-%d")
-
-    if not os.path.exists("diffs"):
-        os.mkdir("diffs")
-
-    dirname = os.path.join("diffs", dirname)
-
-    if not os.path.exists(dirname):
-        os.mkdir(dirname)
-
-    for node_pair in diff_dict.keys():
-        diff_file_suffix = now.strftime("%H%M%S") + f"{now.microsecond // 1000:03d}"
-        node1, node2 = node_pair.split("/")
-        node_str = f"{node1}_{node2}"
-        diff_file_name = f"{node_str}_" + diff_file_suffix + ".diff"
-        diff_file_path = os.path.join(dirname, diff_file_name)
-        t1_file_name = node1 + ".csv"
-        t2_file_name = node2 + ".csv"
 
-        t1_write_path = os.path.join(dirname, t1_file_name)
-        t2_write_path = os.path.join(dirname, t2_file_name)
+    now = datetime.now()
+    dirname = os.path.join("diffs", now.strftime("%Y-%m-%d"))
+    diff_file_suffix = now.strftime("%H%M%S") + f"{now.microsecond // 1000:03d}"
+    os.makedirs(dirname, exist_ok=True)
 
-        df1 = pd.DataFrame.from_dict(diff_dict[node_pair][node1])
-        df2 = pd.DataFrame.from_dict(diff_dict[node_pair][node2])
+    if output == "parquet":
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise AceException("Parquet output needs pyarrow, which is not installed")
+
+    line = io.StringIO()
+    line_writer = csv.writer(line, lineterminator="\n")
+
+    def csv_line(values):
+        line.seek(0)
+        line.truncate()
+        line_writer.writerow(values)
+        return line.getvalue()
+
+    def node_rows(node_pair, nodes):
+        for node in nodes:
+            for row in diff_store.rows(node_pair, node):
+                yield node, row
+
+    summary_path = os.path.join(dirname, f"diffs_{diff_file_suffix}.diff")
+
+    with open(summary_path, "w") as summary:
+        for node_pair, node_rows_count in diff_store.counts().items():
+            node1, node2 = node_pair.split("/")
+            diff_file_path = os.path.join(
+                dirname, f"{node1}_{node2}_{diff_file_suffix}.{output}"
+            )
 
-        df1.to_csv(t1_write_path, header=True, index=False)
-        df2.to_csv(t2_write_path, header=True, index=False)
+            cols = None
+            if output == "parquet":
+                writer = None
+                rows = node_rows(node_pair, (node1, node2))
+                while True:
+                    batch = list(islice(rows, config.DIFF_SPILL_FETCH_ROWS))
+                    if not batch:
+                        break
+                    if writer is None:
+                        cols = list(batch[0][1].keys())
+                        schema = pa.schema(
+                            [(name, pa.string()) for name in ["node"] + cols]
+                        )
+                        writer = pq.ParquetWriter(diff_file_path, schema)
+                    columns = [[node for node, _ in batch]] + [
+                        [
+                            None if row[col] is None else str(row[col])
+                            for _, row in batch
+                        ]
+                        for col in cols
+                    ]
+                    writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+                if writer is not None:
+                    writer.close()
+            else:
+                with open(diff_file_path, "w", newline="") as f:
+                    writer = csv.writer(f)
+                    for node, row in node_rows(node_pair, (node1, node2)):
+                        if cols is None:
+                            cols = list(row.keys())
+                            writer.writerow(["node"] + cols)
+                        writer.writerow([node] + list(row.values()))
+
+            summary.write(f"--- {node1}\n+++ {node2}\n")
+            summary.write(
+                f"@@ -{node_rows_count[node1]} +{node_rows_count[node2]} @@\n"
+            )
+            if cols:
+                summary.write(" " + csv_line(cols))
+            for row1, row2 in diff_store.aligned_rows(node_pair, node1, node2):
+                if row1 is not None:
+                    summary.write("-" + csv_line(row1.values()))
+                if row2 is not None:
+                    summary.write("+" + csv_line(row2.values()))
 
-        cmd = f"diff -u {t1_write_path} {t2_write_path} | ydiff > {diff_file_path}"
-        subprocess.check_output(cmd, shell=True)
+            util.message(
+                f"DIFFS BETWEEN {util.set_colour(node1, 'blue')}"
+                f" AND {util.set_colour(node2, 'blue')}: {diff_file_path}",
+                p_state="info",
+                quiet_mode=quiet_mode,
+            )
 
-        # Delete the temporary files
-        os.remove(t1_write_path)
-        os.remove(t2_write_path)
+    util.message(
+        f"Diff summary written out to {util.set_colour(summary_path, 'blue')}",
+        p_state="info",
+        quiet_mode=quiet_mode,
+    )
 
-        util.message(
-            f"DIFFS BETWEEN {util.set_colour(node1, 'blue')}"
-            f" AND {util.set_colour(node2, 'blue')}: {diff_file_path}",
-            p_state="info",
-        )
+    return summary_path
 
 
 def table_diff_checks(td_task: TableDiffTask) -> TableDiffTask:
@@ -409,11 +533,15 @@ def table_diff_checks(td_task: TableDiffTask) -> TableDiffTask:
     elif type(td_task.block_rows) is not int:
         raise AceException("Invalid value type for ACE_BLOCK_ROWS")
 
+    td_task.parallel_workers = check_parallel_workers(td_task.parallel_workers)
+
     # Capping max block size here to prevent the hash function from taking forever
-    if td_task.block_rows > config.MAX_ALLOWED_BLOCK_SIZE:
-        raise AceException(
-            f"Block row size should be <= {config.MAX_ALLOWED_BLOCK_SIZE}"
-        )
+    max_block_size = config.MAX_ALLOWED_BLOCK_SIZE
+    if td_task.parallel_workers:
+        max_block_size = config.MAX_ALLOWED_PARALLEL_BLOCK_SIZE
+
+    if td_task.block_rows > max_block_size:
+        raise AceException(f"Block row size should be <= {max_block_size}")
     if td_task.block_rows < config.MIN_ALLOWED_BLOCK_SIZE:
         raise AceException(
             f"Block row size should be >= {config.MIN_ALLOWED_BLOCK_SIZE}"
@@ -434,9 +562,27 @@ def table_diff_checks(td_task: TableDiffTask) -> TableDiffTask:
             "Invalid value range for ACE_MAX_CPU_RATIO or --max_cpu_ratio"
         )
 
-    if td_task.output not in ["csv", "json"]:
+    if td_task.output not in ["csv", "json", "parquet"]:
         raise AceException(
-            "table-diff currently supports only csv and json output formats"
+            "table-diff currently supports only csv, json and parquet output "
+            "formats"
+        )
+
+    if td_task.output == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        raise AceException("Parquet output needs pyarrow, which is not installed")
+
+    td_task.scheduler.deadline = check_deadline(td_task.scheduler.deadline)
+    check_throttle(td_task)
+
+    if type(td_task.exact_counts) is str:
+        td_task.exact_counts = td_task.exact_counts.lower() in ("true", "1", "yes")
+
+    if type(td_task.fingerprint) is str:
+        td_task.fingerprint = td_task.fingerprint.lower() in ("true", "1", "yes")
+
+    if type(td_task.digest_large_cols) is str:
+        td_task.digest_large_cols = td_task.digest_large_cols.lower() in (
+            "true", "1", "yes"
         )
 
     node_list = []
@@ -498,6 +644,10 @@ def table_diff_checks(td_task: TableDiffTask) -> TableDiffTask:
         combined_json = {**database, **node}
         cluster_nodes.append(combined_json)
 
+    # Nodes of other clusters, and DSNs such as a physical standby
+    td_task.dsns = ace_nodes.parse_dsns(td_task.dsns)
+    cluster_nodes += ace_nodes.external_nodes(database, node_list, td_task.dsns)
+
     if td_task._nodes == "all" and len(cluster_nodes) > 3:
         raise AceException("Table-diff only supports up to three way comparison")
 
@@ -508,6 +658,13 @@ def table_diff_checks(td_task: TableDiffTask) -> TableDiffTask:
 
     conn_params = []
     conn_list = []
+    read_only_nodes = []
+
+    # The nodes with row-hash indexes are looked up once per task, as the
+    # tables of a repset-diff share its fields
+    row_hash_nodes = None
+    if td_task.fields.row_hash_nodes is None:
+        row_hash_nodes = []
 
     try:
         for nd in cluster_nodes:
@@ -515,17 +672,32 @@ def table_diff_checks(td_task: TableDiffTask) -> TableDiffTask:
                 node_list.append(nd["name"])
 
             if (node_list and nd["name"] in node_list) or (not node_list):
-                params = {
-                    "dbname": nd["db_name"],
-                    "user": nd["db_user"],
-                    "password": nd["db_password"],
-                    "host": nd["public_ip"],
-                    "port": nd.get("port", 5432),
-                    "options": f"-c statement_timeout={config.STATEMENT_TIMEOUT}",
-                }
-                conn_list.append(psycopg.connect(**params))
+                params = ace_nodes.conn_params(
+                    nd,
+                    {
+                        "dbname": nd["db_name"],
+                        "user": nd["db_user"],
+                        "password": nd["db_password"],
+                        "host": nd["public_ip"],
+                        "port": nd.get("port", 5432),
+                        "options": f"-c statement_timeout={config.STATEMENT_TIMEOUT}",
+                    },
+                )
+                conn = ace_connections.get_node_conn(params)
+                conn_list.append(conn)
                 conn_params.append(params)
 
+                in_recovery, has_row_hash = conn.execute(
+                    "SELECT pg_is_in_recovery(), "
+                    "to_regclass('ace.row_hash_tables') IS NOT NULL"
+                ).fetchone()
+
+                # A physical standby cannot create the temp tables of keys
+                if in_recovery:
+                    read_only_nodes.append(nd["name"])
+                if has_row_hash and row_hash_nodes is not None:
+                    row_hash_nodes.append(nd["name"])
+
     except Exception as e:
         raise AceException("Error in table_diff() Getting Connections:" + str(e), 1)
 
@@ -569,16 +741,26 @@ def table_diff_checks(td_task: TableDiffTask) -> TableDiffTask:
         if not os.path.exists(td_task.diff_file_path):
             raise AceException(f"Diff file {td_task.diff_file_path} not found")
 
-        try:
-            diff_data = json.load(open(td_task.diff_file_path, "r"))
-        except Exception as e:
-            raise AceException(f"Could not load diff file as JSON: {e}")
+        # A fresh key index records the node pairs of the diff file and the
+        # nodes of each, so the diff file need not be parsed to check them
+        index = ace_diff_index.read_header(td_task.diff_file_path, key.split(","))
+        if index:
+            header, _ = index
+            diff_pairs = {
+                node_pair: pair["rows"] for node_pair, pair in header["pairs"].items()
+            }
+        else:
+            try:
+                with open(td_task.diff_file_path, "r") as f:
+                    diff_pairs = json.load(f)
+            except Exception as e:
+                raise AceException(f"Could not load diff file as JSON: {e}")
 
         try:
             if any(
                 [
-                    set(list(diff_data[k].keys())) != set(k.split("/"))
-                    for k in diff_data.keys()
+                    set(list(diff_pairs[k].keys())) != set(k.split("/"))
+                    for k in diff_pairs.keys()
                 ]
             ):
                 raise AceException("Contents of diff file improperly formatted")
@@ -596,6 +778,10 @@ def table_diff_checks(td_task: TableDiffTask) -> TableDiffTask:
     # Psycopg connection objects cannot be pickled easily,
     # so, we send the connection parameters instead
     td_task.fields.conn_params = conn_params
+    td_task.fields.cluster_nodes = cluster_nodes
+    td_task.fields.read_only_nodes = read_only_nodes
+    if row_hash_nodes is not None:
+        td_task.fields.row_hash_nodes = row_hash_nodes
     td_task.fields.cols = cols
     td_task.fields.key = key
     td_task.fields.l_schema = l_schema
@@ -757,6 +943,190 @@ def table_repair_checks(tr_task: TableRepairTask) -> TableRepairTask:
     return tr_task
 
 
+def repset_repair_checks(rr_task: RepsetRepairTask) -> RepsetRepairTask:
+
+    if not rr_task.cluster_name:
+        raise AceException("cluster_name is a required argument")
+
+    if not rr_task.diff_task_id:
+        raise AceException("diff_task_id is a required argument")
+
+    if not rr_task.source_of_truth:
+        raise AceException("source_of_truth is a required argument")
+
+    for option in ("dry_run", "upsert_only"):
+        value = getattr(rr_task, option)
+        if type(value) is str:
+            if value in ["True", "true", "1", "t"]:
+                value = True
+            elif value in ["False", "false", "0", "f"]:
+                value = False
+            else:
+                raise AceException(f"Invalid value for {option}")
+        elif type(value) is int:
+            if value < 0 or value > 1:
+                raise AceException(f"{option} should be True (1) or False (0)")
+            value = bool(value)
+        elif type(value) is not bool:
+            raise AceException(f"{option} should be True (1) or False (0)")
+        setattr(rr_task, option, value)
+
+    diff_task = ace_db.get_ace_task_by_id(str(rr_task.diff_task_id))
+    if not diff_task:
+        raise AceException(f"Task {rr_task.diff_task_id} not found")
+
+    if diff_task["task_type"] != "repset-diff":
+        raise AceException(f"Task {rr_task.diff_task_id} is not a repset-diff")
+
+    if diff_task["task_status"] in ("QUEUED", "RUNNING"):
+        raise AceException(f"Repset-diff {rr_task.diff_task_id} has not finished")
+
+    if diff_task["cluster_name"] != rr_task.cluster_name:
+        raise AceException(
+            f"Repset-diff {rr_task.diff_task_id} was not run on cluster "
+            f"{rr_task.cluster_name}"
+        )
+
+    # Tables that were found to differ, and whose diffs were written out
+    diff_tables = [
+        status
+        for status in diff_task["task_context"] or []
+        if status.get("mismatch") and status.get("diff_file_path")
+    ]
+
+    for status in diff_tables:
+        if not os.path.exists(status["diff_file_path"]):
+            raise AceException(f"Diff file {status['diff_file_path']} does not exist")
+
+    found = check_cluster_exists(rr_task.cluster_name)
+    if found:
+        util.message(
+            f"Cluster {rr_task.cluster_name} exists",
+            p_state="success",
+            quiet_mode=rr_task.quiet_mode,
+        )
+    else:
+        raise AceException(f"Cluster {rr_task.cluster_name} not found")
+
+    db, pg, node_info = cluster.load_json(rr_task.cluster_name)
+
+    cluster_nodes = []
+    database = {}
+
+    if rr_task._dbname:
+        for db_entry in db:
+            if db_entry["db_name"] == rr_task._dbname:
+                database = db_entry
+                break
+    else:
+        database = db[0]
+
+    if not database:
+        raise AceException(
+            f"Database '{rr_task._dbname}' " +
+            f"not found in cluster '{rr_task.cluster_name}'"
+        )
+
+    # Combine db and cluster_nodes into a single json
+    for node in node_info:
+        combined_json = {**database, **node}
+        cluster_nodes.append(combined_json)
+
+    if not any(node.get("name") == rr_task.source_of_truth for node in cluster_nodes):
+        raise AceException(
+            f"Source of truth node {rr_task.source_of_truth} not present in cluster"
+        )
+
+    conns = {}
+    conn_params = []
+    host_map = {}
+
+    try:
+        for nd in cluster_nodes:
+            params = {
+                "dbname": nd["db_name"],
+                "user": nd["db_user"],
+                "password": nd["db_password"],
+                "host": nd["public_ip"],
+                "port": nd.get("port", 5432),
+                "options": f"-c statement_timeout={config.STATEMENT_TIMEOUT}",
+            }
+
+            # Use port number to support localhost clusters
+            host_map[nd["public_ip"] + ":" + params["port"]] = nd["name"]
+            conn_params.append(params)
+            conns[nd["name"]] = psycopg.connect(**params)
+
+    except Exception as e:
+        raise AceException(
+            "Error in repset_repair_checks() Getting Connections:" + str(e)
+        )
+
+    util.message(
+        "Connections successful to nodes in cluster",
+        p_state="success",
+        quiet_mode=rr_task.quiet_mode,
+    )
+
+    table_list = []
+    for status in diff_tables:
+        nm_lst = status["table"].split(".")
+        if len(nm_lst) != 2:
+            raise AceException(
+                f"TableName {status['table']} must be of form 'schema.table_name'"
+            )
+
+        l_schema, l_table = nm_lst
+        cols = None
+        key = None
+
+        for conn in conns.values():
+            curr_cols = get_cols(conn, l_schema, l_table)
+            curr_key = get_key(conn, l_schema, l_table)
+
+            if not curr_cols:
+                raise AceException(f"Invalid table name '{status['table']}'")
+            if not curr_key:
+                raise AceException(f"No primary key found for '{status['table']}'")
+
+            if (cols, key) != (None, None) and (curr_cols, curr_key) != (cols, key):
+                raise AceException(f"Table schemas don't match for {status['table']}")
+
+            cols = curr_cols
+            key = curr_key
+
+        table_list.append(
+            {
+                "table": status["table"],
+                "diff_file_path": status["diff_file_path"],
+                "l_schema": l_schema,
+                "l_table": l_table,
+                "cols": cols,
+                "key": key,
+            }
+        )
+
+    for conn in conns.values():
+        conn.close()
+
+    util.message(
+        f"{len(table_list)} tables of repset-diff {rr_task.diff_task_id} to repair",
+        p_state="success",
+        quiet_mode=rr_task.quiet_mode,
+    )
+
+    """
+    Derived fields for RepsetRepairTask
+    """
+    rr_task.fields.cluster_nodes = cluster_nodes
+    rr_task.fields.database = database
+    rr_task.fields.conn_params = conn_params
+    rr_task.fields.host_map = host_map
+    rr_task.fields.table_list = table_list
+
+    return rr_task
+
+
 def repset_diff_checks(rd_task: RepsetDiffTask) -> RepsetDiffTask:
 
     if type(rd_task.block_rows) is str:
@@ -767,11 +1137,15 @@ def repset_diff_checks(rd_task: RepsetDiffTask) -> RepsetDiffTask:
     elif type(rd_task.block_rows) is not int:
         raise AceException("Invalid value type for ACE_BLOCK_ROWS or --block_rows")
 
+    rd_task.parallel_workers = check_parallel_workers(rd_task.parallel_workers)
+
     # Capping max block size here to prevent the hash function from taking forever
-    if rd_task.block_rows > config.MAX_ALLOWED_BLOCK_SIZE:
-        raise AceException(
-            f"Block row size should be <= {config.MAX_ALLOWED_BLOCK_SIZE}"
-        )
+    max_block_size = config.MAX_ALLOWED_BLOCK_SIZE
+    if rd_task.parallel_workers:
+        max_block_size = config.MAX_ALLOWED_PARALLEL_BLOCK_SIZE
+
+    if rd_task.block_rows > max_block_size:
+        raise AceException(f"Block row size should be <= {max_block_size}")
     if rd_task.block_rows < config.MIN_ALLOWED_BLOCK_SIZE:
         raise AceException(
             f"Block row size should be >= {config.MIN_ALLOWED_BLOCK_SIZE}"
@@ -796,11 +1170,32 @@ def repset_diff_checks(rd_task: RepsetDiffTask) -> RepsetDiffTask:
             "Invalid value range for ACE_MAX_CPU_RATIO or --max_cpu_ratio"
         )
 
-    if rd_task.output not in ["csv", "json"]:
+    if rd_task.output not in ["csv", "json", "parquet"]:
         raise AceException(
-            "Diff-tables currently supports only csv and json output formats"
+            "Diff-tables currently supports only csv, json and parquet output "
+            "formats"
         )
 
+    if rd_task.output == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        raise AceException("Parquet output needs pyarrow, which is not installed")
+
+    rd_task.scheduler.deadline = check_deadline(rd_task.scheduler.deadline)
+    check_throttle(rd_task)
+
+    if type(rd_task.exact_counts) is str:
+        rd_task.exact_counts = rd_task.exact_counts.lower() in ("true", "1", "yes")
+
+    if type(rd_task.fingerprint) is str:
+        rd_task.fingerprint = rd_task.fingerprint.lower() in ("true", "1", "yes")
+
+    if type(rd_task.digest_large_cols) is str:
+        rd_task.digest_large_cols = rd_task.digest_large_cols.lower() in (
+            "true", "1", "yes"
+        )
+
+    if type(rd_task.skip_unchanged) is str:
+        rd_task.skip_unchanged = rd_task.skip_unchanged.lower() in ("true", "1", "yes")
+
     node_list = []
     try:
         node_list = parse_nodes(rd_task._nodes)
@@ -852,6 +1247,10 @@ def repset_diff_checks(rd_task: RepsetDiffTask) -> RepsetDiffTask:
         combined_json = {**database, **node}
         cluster_nodes.append(combined_json)
 
+    # Nodes of other clusters, and DSNs such as a physical standby
+    rd_task.dsns = ace_nodes.parse_dsns(rd_task.dsns)
+    cluster_nodes += ace_nodes.external_nodes(database, node_list, rd_task.dsns)
+
     if rd_task._nodes != "all" and len(node_list) > 1:
         for n in node_list:
             if not any(filter(lambda x: x["name"] == n, cluster_nodes)):
@@ -865,13 +1264,20 @@ def repset_diff_checks(rd_task: RepsetDiffTask) -> RepsetDiffTask:
                 node_list.append(nd["name"])
 
             if (node_list and nd["name"] in node_list) or (not node_list):
-                psql_conn = psycopg.connect(
-                    dbname=nd["db_name"],
-                    user=nd["db_user"],
-                    password=nd["db_password"],
-                    host=nd["public_ip"],
-                    port=nd.get("port", 5432),
-                    options=f"-c statement_timeout={config.STATEMENT_TIMEOUT}",
+                psql_conn = ace_connections.get_node_conn(
+                    ace_nodes.conn_params(
+                        nd,
+                        {
+                            "dbname": nd["db_name"],
+                            "user": nd["db_user"],
+                            "password": nd["db_password"],
+                            "host": nd["public_ip"],
+                            "port": nd.get("port", 5432),
+                            "options": (
+                                f"-c statement_timeout={config.STATEMENT_TIMEOUT}"
+                            ),
+                        },
+                    )
                 )
                 conn_list.append(psql_conn)
 
@@ -914,6 +1320,7 @@ def repset_diff_checks(rd_task: RepsetDiffTask) -> RepsetDiffTask:
 
     rd_task.fields.cluster_nodes = cluster_nodes
     rd_task.fields.database = database
+    rd_task.fields.node_list = node_list
 
     if rd_task.skip_tables is None:
         rd_task.skip_tables = set()
@@ -925,6 +1332,113 @@ def repset_diff_checks(rd_task: RepsetDiffTask) -> RepsetDiffTask:
     return rd_task
 
 
+def cluster_sweep_checks(cs_task: ClusterSweepTask) -> ClusterSweepTask:
+    """
+    Runs the repset-diff checks for every repset of every database in the
+    sweep, and adds the repset-diffs to cs_task.repset_tasks
+    """
+
+    found = check_cluster_exists(cs_task.cluster_name)
+    if found:
+        util.message(
+            f"Cluster {cs_task.cluster_name} exists",
+            p_state="success",
+            quiet_mode=cs_task.quiet_mode,
+        )
+    else:
+        raise AceException(f"Cluster {cs_task.cluster_name} not found")
+
+    db, pg, node_info = cluster.load_json(cs_task.cluster_name)
+
+    if cs_task._dbnames:
+        if isinstance(cs_task._dbnames, str):
+            db_names = [name.strip() for name in cs_task._dbnames.split(",")]
+        else:
+            db_names = list(cs_task._dbnames)
+
+        for name in db_names:
+            if not any(db_entry["db_name"] == name for db_entry in db):
+                raise AceException(
+                    f"Database '{name}' not found in cluster '{cs_task.cluster_name}'"
+                )
+        databases = [db_entry for db_entry in db if db_entry["db_name"] in db_names]
+    else:
+        databases = db
+
+    if cs_task.repsets is None:
+        repsets = None
+    elif isinstance(cs_task.repsets, str):
+        repsets = [name.strip() for name in cs_task.repsets.split(",")]
+    else:
+        repsets = list(cs_task.repsets)
+
+    if cs_task.max_workers is not None:
+        try:
+            cs_task.max_workers = int(cs_task.max_workers)
+        except (TypeError, ValueError):
+            raise AceException("Invalid value for --max_workers")
+        if cs_task.max_workers < 1:
+            raise AceException("Max workers should be a positive number")
+
+    cs_task.scheduler.deadline = check_deadline(cs_task.scheduler.deadline)
+
+    for database in databases:
+        # The repsets are the same on every node, so any node will do
+        node = {**database, **node_info[0]}
+        try:
+            conn = ace_connections.get_node_conn(
+                {
+                    "dbname": node["db_name"],
+                    "user": node["db_user"],
+                    "password": node["db_password"],
+                    "host": node["public_ip"],
+                    "port": node.get("port", 5432),
+                    "options": f"-c statement_timeout={config.STATEMENT_TIMEOUT}",
+                }
+            )
+            cur = conn.cursor()
+            cur.execute("select set_name from spock.replication_set;")
+            repset_list = [item[0] for item in cur.fetchall()]
+        except Exception as e:
+            raise AceException(
+                f"Error getting repsets of database {database['db_name']}: {e}"
+            )
+
+        if repsets is not None:
+            repset_list = [name for name in repset_list if name in repsets]
+
+        for repset_name in repset_list:
+            rd_task = RepsetDiffTask(
+                _dbname=database["db_name"],
+                _nodes=cs_task._nodes,
+                cluster_name=cs_task.cluster_name,
+                repset_name=repset_name,
+                block_rows=cs_task.block_rows,
+                max_cpu_ratio=cs_task.max_cpu_ratio,
+                output=cs_task.output,
+                batch_size=cs_task.batch_size,
+                quiet_mode=cs_task.quiet_mode,
+                skip_tables=cs_task.skip_tables,
+                invoke_method=cs_task.invoke_method,
+                low_impact=cs_task.low_impact,
+                max_rows_per_sec=cs_task.max_rows_per_sec,
+                max_mb_per_sec=cs_task.max_mb_per_sec,
+                exact_counts=cs_task.exact_counts,
+                fingerprint=cs_task.fingerprint,
+                parallel_workers=cs_task.parallel_workers,
+                digest_large_cols=cs_task.digest_large_cols,
+                skip_unchanged=cs_task.skip_unchanged,
+            )
+            cs_task.repset_tasks.append(repset_diff_checks(rd_task))
+
+    if not cs_task.repset_tasks:
+        raise AceException(
+            f"No repsets to sweep in cluster '{cs_task.cluster_name}'"
+        )
+
+    return cs_task
+
+
 def spock_diff_checks(sd_task: SpockDiffTask) -> SpockDiffTask:
     node_list = []
     try:
@@ -1078,6 +1592,29 @@ def schema_diff_checks(sc_task: SchemaDiffTask) -> SchemaDiffTask:
     return sc_task
 
 
+def cancel_task_checks(task_id) -> dict:
+    if not task_id:
+        raise AceException("task_id is a required argument")
+
+    task_details = ace_db.get_ace_task_by_id(task_id)
+
+    if not task_details:
+        raise AceException(f"Task {task_id} not found")
+
+    status = task_details["task_status"]
+    if status not in ("QUEUED", "RUNNING"):
+        raise AceException(f"Task {task_id} is not queued or running ({status})")
+
+    task_type = task_details["task_type"]
+    if status == "RUNNING" and task_type not in config.CANCELLABLE_TASK_TYPES:
+        raise AceException(
+            f"A running {task_type} task cannot be cancelled. Only "
+            f"{', '.join(config.CANCELLABLE_TASK_TYPES)} tasks can be."
+        )
+
+    return task_details
+
+
 def handle_task_exception(task, task_context):
     task.scheduler.task_status = "FAILED"
     task.scheduler.finished_at = datetime.now()
@@ -1092,6 +1629,26 @@ def handle_task_exception(task, task_context):
         ace_db.update_ace_task(task)
 
 
+def handle_task_cancellation(task, reason, task_context):
+    task.scheduler.task_status = "CANCELLED"
+    task.scheduler.finished_at = datetime.now()
+    task.scheduler.time_taken = util.round_timedelta(
+        datetime.now() - task.scheduler.started_at
+    ).total_seconds()
+    task.scheduler.task_context = {**task_context, "reason": reason}
+
+    util.message(
+        f"TASK CANCELLED: {reason}",
+        p_state="warning",
+        quiet_mode=getattr(task, "quiet_mode", False),
+    )
+
+    skip_update = getattr(task, "skip_db_update", False)
+
+    if not skip_update:
+        ace_db.update_ace_task(task)
+
+
 def error_listener(event):
     if event.exception:
         job_id = event.job_id
@@ -1125,8 +1682,13 @@ if __name__ == "__main__":
             "table-repair": ace_cli.table_repair_cli,
             "table-rerun": ace_cli.table_rerun_cli,
             "repset-diff": ace_cli.repset_diff_cli,
+            "cluster-sweep": ace_cli.cluster_sweep_cli,
+            "repset-repair": ace_cli.repset_repair_cli,
             "schema-diff": ace_cli.schema_diff_cli,
             "spock-diff": ace_cli.spock_diff_cli,
+            "task-cancel": ace_cli.task_cancel_cli,
+            "monitor": ace_cli.monitor_cli,
+            "row-hash": ace_cli.row_hash_cli,
             "start": ace_api.start_ace,
         }
     )
@@ -1,16 +1,23 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 from flask import Flask, jsonify, request
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.jobstores.memory import MemoryJobStore
 from apscheduler.executors.pool import ProcessPoolExecutor
+from apscheduler.executors.pool import ThreadPoolExecutor as SchedulerThreadPool
 
 import ace
+import cluster
 import ace_config as config
 import ace_core
 import ace_db
+from ace_queue import JobQueue
 from ace_data_models import (
+    ClusterSweepTask,
     RepsetDiffTask,
+    RepsetRepairTask,
     SchemaDiffTask,
     SpockDiffTask,
     TableDiffTask,
@@ -22,9 +29,17 @@ app = Flask(__name__)
 # apscheduler setup
 scheduler = BackgroundScheduler(
     jobstores={"default": MemoryJobStore()},
-    executors={"default": ProcessPoolExecutor(32)},
+    executors={
+        "default": ProcessPoolExecutor(config.MAX_RUNNING_JOBS),
+        # Housekeeping jobs, such as purging old tasks, run in-process
+        "maintenance": SchedulerThreadPool(1),
+    },
 )
 
+# Jobs are not handed to the scheduler directly. They wait in the job queue
+# until the global and per-cluster concurrency limits admit them.
+job_queue = JobQueue(scheduler)
+
 
 """
 API endpoint for initiating a table diff operation.
@@ -35,14 +50,36 @@ This endpoint accepts the following GET parameters:
 - dbname (optional): Name of the database
 - block_rows (optional): Number of rows per block (default: config.BLOCK_ROWS_DEFAULT)
 - max_cpu_ratio (optional): Max CPU usage ratio (default: config.MAX_CPU_RATIO_DEFAULT)
-- output (optional): Output format, default is 'json'
+- output (optional): Output format: json, csv or parquet, default is 'json'
 - nodes (optional): Nodes to include in diff, default is 'all'
 - batch_size (optional): Batch size for processing (default: config.BATCH_SIZE_DEFAULT)
 - quiet (optional): Whether to suppress output, default is False
+- priority (optional): Queue priority; higher values run first (default: 0)
+- deadline (optional): Maximum run time in seconds, after which the diff is
+  cancelled and its partial results recorded (default:
+  config.TASK_DEADLINE_DEFAULT; 0 means no deadline)
+- low_impact (optional): Throttle the diff: block queries are paced per node
+  and pause while a node is busy (default: False)
+- max_rows_per_sec (optional): Target rows/sec read from each node; implies
+  low_impact (default: config.THROTTLE_ROWS_PER_SEC_DEFAULT)
+- max_mb_per_sec (optional): Target MB/sec read from each node; implies
+  low_impact (default: config.THROTTLE_MB_PER_SEC_DEFAULT)
+- exact_counts (optional): Count the rows on every node before the diff
+  instead of using planner estimates (default: False)
+- fingerprint (optional): Only compare one order-independent hash of the
+  whole table per node, without fetching rows (default: False)
+- parallel_workers (optional): Hash every block with this many Postgres
+  parallel workers per node, using fewer connections (default: 0, disabled)
+- digest_large_cols (optional): Compare large columns (bytea, jsonb, vector
+  etc.) by their digests, fetching values only for rows that differ
+  (default: False)
+- dsns (optional): JSON object of {name: DSN} of nodes outside the cluster,
+  such as a physical standby, that nodes may then name. nodes may also name
+  <cluster>:<node> for a node of another cluster.
 
 Returns:
-    JSON response with task_id and submitted_at timestamp on success,
-    or an error message on failure.
+    JSON response with task_id, submitted_at timestamp and the queue position
+    of the task on success, or an error message on failure.
 """
 
 
@@ -57,6 +94,16 @@ def table_diff_api():
     nodes = request.args.get("nodes", "all")
     batch_size = request.args.get("batch_size", config.BATCH_SIZE_DEFAULT, type=int)
     quiet = request.args.get("quiet", False)
+    priority = request.args.get("priority", config.JOB_PRIORITY_DEFAULT, type=int)
+    deadline = request.args.get("deadline", config.TASK_DEADLINE_DEFAULT)
+    low_impact = request.args.get("low_impact", False)
+    max_rows_per_sec = request.args.get("max_rows_per_sec", None)
+    max_mb_per_sec = request.args.get("max_mb_per_sec", None)
+    exact_counts = request.args.get("exact_counts", False)
+    fingerprint = request.args.get("fingerprint", False)
+    parallel_workers = request.args.get("parallel_workers", 0)
+    digest_large_cols = request.args.get("digest_large_cols", False)
+    dsns = request.args.get("dsns", None)
 
     if not cluster_name or not table_name:
         return jsonify({"error": "cluster_name and table_name are required parameters"})
@@ -75,21 +122,29 @@ def table_diff_api():
             batch_size=batch_size,
             quiet_mode=quiet,
             skip_db_update=False,
+            low_impact=low_impact,
+            max_rows_per_sec=max_rows_per_sec,
+            max_mb_per_sec=max_mb_per_sec,
+            exact_counts=exact_counts,
+            fingerprint=fingerprint,
+            parallel_workers=parallel_workers,
+            digest_large_cols=digest_large_cols,
+            dsns=dsns,
         )
 
         raw_args.scheduler.task_id = task_id
         raw_args.scheduler.task_type = "table-diff"
-        raw_args.scheduler.task_status = "RUNNING"
-        raw_args.scheduler.started_at = datetime.now()
+        raw_args.scheduler.deadline = deadline
         td_task = ace.table_diff_checks(raw_args)
 
-        ace_db.create_ace_task(task=td_task)
-        scheduler.add_job(
-            ace_core.table_diff,
-            args=(td_task,),
+        queue_info = job_queue.submit(ace_core.table_diff, td_task, priority)
+        return jsonify(
+            {
+                "task_id": task_id,
+                "submitted_at": datetime.now().isoformat(),
+                "queue": queue_info,
+            }
         )
-
-        return jsonify({"task_id": task_id, "submitted_at": datetime.now().isoformat()})
     except Exception as e:
         return jsonify({"error": str(e)})
 
@@ -109,10 +164,11 @@ This endpoint accepts the following GET parameters:
   (default: False)
 - upsert_only (optional): If True, only performs upsert operations, skipping
   deletions (default: False)
+- priority (optional): Queue priority; higher values run first (default: 0)
 
 Returns:
-    JSON response with task_id and submitted_at timestamp on success,
-    or an error message on failure.
+    JSON response with task_id, submitted_at timestamp and the queue position
+    of the task on success, or an error message on failure.
 """
 
 
@@ -125,6 +181,7 @@ def table_repair_api():
     dbname = request.args.get("dbname")
     dry_run = request.args.get("dry_run", False)
     quiet = request.args.get("quiet", False)
+    priority = request.args.get("priority", config.JOB_PRIORITY_DEFAULT, type=int)
     generate_report = request.args.get("generate_report", False)
     upsert_only = request.args.get("upsert_only", False)
 
@@ -152,13 +209,84 @@ def table_repair_api():
         )
         raw_args.scheduler.task_id = task_id
         raw_args.scheduler.task_type = "table-repair"
-        raw_args.scheduler.task_status = "RUNNING"
-        raw_args.scheduler.started_at = datetime.now()
         tr_task = ace.table_repair_checks(raw_args)
-        ace_db.create_ace_task(task=tr_task)
 
-        scheduler.add_job(ace_core.table_repair, args=(tr_task,))
-        return jsonify({"task_id": task_id, "submitted_at": datetime.now().isoformat()})
+        queue_info = job_queue.submit(ace_core.table_repair, tr_task, priority)
+        return jsonify(
+            {
+                "task_id": task_id,
+                "submitted_at": datetime.now().isoformat(),
+                "queue": queue_info,
+            }
+        )
+    except Exception as e:
+        return jsonify({"error": str(e)})
+
+
+"""
+API endpoint for repairing every table that a repset-diff found to differ.
+
+This endpoint accepts the following GET parameters:
+- cluster_name (required): Name of the cluster
+- diff_task_id (required): Task ID of a finished repset-diff
+- source_of_truth (required): Source of truth for the data
+- dbname (optional): Name of the database
+- dry_run (optional): If True, reports the repairs without making them
+  (default: False)
+- quiet (optional): Whether to suppress output (default: False)
+- upsert_only (optional): If True, only performs upsert operations, skipping
+  deletions (default: False)
+- priority (optional): Queue priority; higher values run first (default: 0)
+
+Returns:
+    JSON response with task_id, submitted_at timestamp and the queue position
+    of the task on success, or an error message on failure.
+"""
+
+
+@app.route("/ace/repset-repair", methods=["GET"])
+def repset_repair_api():
+    cluster_name = request.args.get("cluster_name")
+    diff_task_id = request.args.get("diff_task_id")
+    source_of_truth = request.args.get("source_of_truth")
+    dbname = request.args.get("dbname")
+    dry_run = request.args.get("dry_run", False)
+    quiet = request.args.get("quiet", False)
+    priority = request.args.get("priority", config.JOB_PRIORITY_DEFAULT, type=int)
+    upsert_only = request.args.get("upsert_only", False)
+
+    if not cluster_name or not diff_task_id or not source_of_truth:
+        return jsonify(
+            {
+                "error": "cluster_name, diff_task_id and source_of_truth are "
+                "required parameters"
+            }
+        )
+
+    task_id = ace_db.generate_task_id()
+
+    try:
+        raw_args = RepsetRepairTask(
+            cluster_name=cluster_name,
+            diff_task_id=diff_task_id,
+            source_of_truth=source_of_truth,
+            _dbname=dbname,
+            dry_run=dry_run,
+            quiet_mode=quiet,
+            upsert_only=upsert_only,
+        )
+        raw_args.scheduler.task_id = task_id
+        raw_args.scheduler.task_type = "repset-repair"
+        rr_task = ace.repset_repair_checks(raw_args)
+
+        queue_info = job_queue.submit(ace_core.repset_repair, rr_task, priority)
+        return jsonify(
+            {
+                "task_id": task_id,
+                "submitted_at": datetime.now().isoformat(),
+                "queue": queue_info,
+            }
+        )
     except Exception as e:
         return jsonify({"error": str(e)})
 
@@ -178,10 +306,15 @@ GET parameters:
     behavior (str): The behavior to use for rerunning
                     (optional, default: "multiprocessing")
                     Supported values: "multiprocessing", "hostdb"
-
+    priority (int): Queue priority; higher values run first (optional, default: 0)
+    deadline (int): Maximum run time in seconds
+                    (optional, default: config.TASK_DEADLINE_DEFAULT)
+    low_impact (bool): Throttle the rerun, as for table-diff (optional)
+    max_rows_per_sec (int): Target rows/sec read from each node (optional)
+    max_mb_per_sec (float): Target MB/sec read from each node (optional)
 Returns:
-    JSON response with task_id and submitted_at timestamp on success,
-    or an error message on failure.
+    JSON response with task_id, submitted_at timestamp and the queue position
+    of the task on success, or an error message on failure.
 """
 
 
@@ -192,7 +325,12 @@ def table_rerun_api():
     table_name = request.args.get("table_name")
     dbname = request.args.get("dbname", None)
     quiet = request.args.get("quiet", False)
+    priority = request.args.get("priority", config.JOB_PRIORITY_DEFAULT, type=int)
     behavior = request.args.get("behavior", "multiprocessing")
+    deadline = request.args.get("deadline", config.TASK_DEADLINE_DEFAULT)
+    low_impact = request.args.get("low_impact", False)
+    max_rows_per_sec = request.args.get("max_rows_per_sec", None)
+    max_mb_per_sec = request.args.get("max_mb_per_sec", None)
 
     if not cluster_name or not diff_file or not table_name:
         return jsonify(
@@ -216,29 +354,40 @@ def table_rerun_api():
             batch_size=config.BATCH_SIZE_DEFAULT,
             quiet_mode=quiet,
             diff_file_path=diff_file,
+            low_impact=low_impact,
+            max_rows_per_sec=max_rows_per_sec,
+            max_mb_per_sec=max_mb_per_sec,
         )
         raw_args.scheduler.task_id = task_id
         raw_args.scheduler.task_type = "table-rerun"
-        raw_args.scheduler.task_status = "RUNNING"
-        raw_args.scheduler.started_at = datetime.now()
+        raw_args.scheduler.deadline = deadline
         td_task = ace.table_diff_checks(raw_args)
-        ace_db.create_ace_task(task=td_task)
     except Exception as e:
         return jsonify({"error": str(e)})
 
-    try:
-        if behavior == "multiprocessing":
-            scheduler.add_job(ace_core.table_rerun_async, args=(td_task,))
-            return jsonify(
-                {"task_id": task_id, "submitted_at": datetime.now().isoformat()}
-            )
-        elif behavior == "hostdb":
-            scheduler.add_job(ace_core.table_rerun_temptable, args=(td_task,))
+    if behavior == "multiprocessing":
+        rerun_func = ace_core.table_rerun_async
+    elif behavior == "hostdb":
+        if td_task.fields.read_only_nodes:
             return jsonify(
-                {"task_id": task_id, "submitted_at": datetime.now().isoformat()}
+                {
+                    "error": "The hostdb rerun cannot run on read-only nodes "
+                    f"{', '.join(td_task.fields.read_only_nodes)}"
+                }
             )
-        else:
-            return jsonify({"error": f"Invalid behavior: {behavior}"})
+        rerun_func = ace_core.table_rerun_temptable
+    else:
+        return jsonify({"error": f"Invalid behavior: {behavior}"})
+
+    try:
+        queue_info = job_queue.submit(rerun_func, td_task, priority)
+        return jsonify(
+            {
+                "task_id": task_id,
+                "submitted_at": datetime.now().isoformat(),
+                "queue": queue_info,
+            }
+        )
     except Exception as e:
         return jsonify({"error": str(e)})
 
@@ -256,16 +405,38 @@ Query Parameters:
     block_rows (int): Number of rows per block (default: config.BLOCK_ROWS_DEFAULT)
     max_cpu_ratio (float): Maximum CPU usage ratio
                            (default: config.MAX_CPU_RATIO_DEFAULT)
-    output (str): Output format (default: "json")
+    output (str): Output format: json, csv or parquet (default: "json")
     nodes (str): Nodes to include in the diff (default: "all")
     batch_size (int): Size of each batch (default: config.BATCH_SIZE_DEFAULT)
     quiet (bool): Whether to suppress output (default: False)
     skip_tables (str): Comma-separated list of tables to skip (optional)
+    priority (int): Queue priority; higher values run first (default: 0)
+    deadline (int): Maximum run time in seconds for the whole repset; tables
+                    not reached by then are not checked
+                    (default: config.TASK_DEADLINE_DEFAULT)
+    low_impact (bool): Throttle the diff of every table, as for table-diff
+                       (default: False)
+    max_rows_per_sec (int): Target rows/sec read from each node (optional)
+    max_mb_per_sec (float): Target MB/sec read from each node (optional)
+    exact_counts (bool): Count the rows of every table exactly instead of
+                         using planner estimates (default: False)
+    fingerprint (bool): Fingerprint all tables first, and diff only those
+                        whose fingerprints differ (default: False)
+    parallel_workers (int): Hash blocks with Postgres parallel workers, as for
+                            table-diff (default: 0)
+    digest_large_cols (bool): Compare large columns by their digests, as for
+                              table-diff (default: False)
+    skip_unchanged (bool): Skip tables that were last verified without
+                           differences and have had no writes since
+                           (default: False)
+    dsns (str): JSON object of {name: DSN} of nodes outside the cluster, as
+                for table-diff (optional)
 
 Returns:
     JSON object containing:
         task_id (str): Unique identifier for the submitted task
         submitted_at (str): ISO formatted timestamp of task submission
+        queue (dict): Queue depth and the position of the task in the queue
 """
 
 
@@ -280,7 +451,18 @@ def repset_diff_api():
     nodes = request.args.get("nodes", "all")
     batch_size = request.args.get("batch_size", config.BATCH_SIZE_DEFAULT, type=int)
     quiet = request.args.get("quiet", False)
+    priority = request.args.get("priority", config.JOB_PRIORITY_DEFAULT, type=int)
     skip_tables = request.args.get("skip_tables", None)
+    deadline = request.args.get("deadline", config.TASK_DEADLINE_DEFAULT)
+    low_impact = request.args.get("low_impact", False)
+    max_rows_per_sec = request.args.get("max_rows_per_sec", None)
+    max_mb_per_sec = request.args.get("max_mb_per_sec", None)
+    exact_counts = request.args.get("exact_counts", False)
+    fingerprint = request.args.get("fingerprint", False)
+    parallel_workers = request.args.get("parallel_workers", 0)
+    digest_large_cols = request.args.get("digest_large_cols", False)
+    dsns = request.args.get("dsns", None)
+    skip_unchanged = request.args.get("skip_unchanged", False)
 
     if not cluster_name or not repset_name:
         return jsonify(
@@ -302,16 +484,133 @@ def repset_diff_api():
             quiet_mode=quiet,
             skip_tables=skip_tables,
             invoke_method="API",
+            low_impact=low_impact,
+            max_rows_per_sec=max_rows_per_sec,
+            max_mb_per_sec=max_mb_per_sec,
+            exact_counts=exact_counts,
+            fingerprint=fingerprint,
+            parallel_workers=parallel_workers,
+            digest_large_cols=digest_large_cols,
+            skip_unchanged=skip_unchanged,
+            dsns=dsns,
         )
 
         raw_args.scheduler.task_id = task_id
         raw_args.scheduler.task_type = "repset-diff"
-        raw_args.scheduler.task_status = "RUNNING"
-        raw_args.scheduler.started_at = datetime.now()
+        raw_args.scheduler.deadline = deadline
         rd_task = ace.repset_diff_checks(raw_args)
-        ace_db.create_ace_task(task=rd_task)
-        scheduler.add_job(ace_core.repset_diff, args=(rd_task,))
-        return jsonify({"task_id": task_id, "submitted_at": datetime.now().isoformat()})
+        queue_info = job_queue.submit(ace_core.repset_diff, rd_task, priority)
+        return jsonify(
+            {
+                "task_id": task_id,
+                "submitted_at": datetime.now().isoformat(),
+                "queue": queue_info,
+            }
+        )
+    except Exception as e:
+        return jsonify({"error": str(e)})
+
+
+"""
+Diffs every repset of every database of a cluster as a single task.
+
+API Endpoint: /ace/cluster-sweep
+Method: GET
+
+Query Parameters:
+    cluster_name (str): Name of the cluster (required)
+    dbnames (str): Comma-separated databases to sweep (default: all)
+    repsets (str): Comma-separated repsets to sweep in each database
+                   (default: all)
+    block_rows (int): Number of rows per block (default: config.BLOCK_ROWS_DEFAULT)
+    max_cpu_ratio (float): Maximum CPU usage ratio
+                           (default: config.MAX_CPU_RATIO_DEFAULT)
+    max_workers (int): Upper bound on the worker processes of the whole sweep,
+                       below the job budget of the queue (optional)
+    output (str): Output format: json, csv or parquet (default: "json")
+    nodes (str): Nodes to include in the diff (default: "all")
+    batch_size (int): Size of each batch (default: config.BATCH_SIZE_DEFAULT)
+    quiet (bool): Whether to suppress output (default: False)
+    skip_tables (str): Comma-separated list of tables to skip (optional)
+    priority (int): Queue priority; higher values run first (default: 0)
+    deadline (int): Maximum run time in seconds for the whole sweep
+                    (default: config.TASK_DEADLINE_DEFAULT)
+    low_impact, max_rows_per_sec, max_mb_per_sec, exact_counts, fingerprint,
+    parallel_workers, digest_large_cols, skip_unchanged: As for repset-diff
+
+Returns:
+    JSON object containing:
+        task_id (str): Unique identifier for the submitted task
+        submitted_at (str): ISO formatted timestamp of task submission
+        queue (dict): Queue depth and the position of the task in the queue
+"""
+
+
+@app.route("/ace/cluster-sweep", methods=["GET"])
+def cluster_sweep_api():
+    cluster_name = request.args.get("cluster_name")
+    dbnames = request.args.get("dbnames", None)
+    repsets = request.args.get("repsets", None)
+    block_rows = request.args.get("block_rows", config.BLOCK_ROWS_DEFAULT)
+    max_cpu_ratio = request.args.get("max_cpu_ratio", config.MAX_CPU_RATIO_DEFAULT)
+    max_workers = request.args.get("max_workers", None)
+    output = request.args.get("output", "json")
+    nodes = request.args.get("nodes", "all")
+    batch_size = request.args.get("batch_size", config.BATCH_SIZE_DEFAULT, type=int)
+    quiet = request.args.get("quiet", False)
+    priority = request.args.get("priority", config.JOB_PRIORITY_DEFAULT, type=int)
+    skip_tables = request.args.get("skip_tables", None)
+    deadline = request.args.get("deadline", config.TASK_DEADLINE_DEFAULT)
+    low_impact = request.args.get("low_impact", False)
+    max_rows_per_sec = request.args.get("max_rows_per_sec", None)
+    max_mb_per_sec = request.args.get("max_mb_per_sec", None)
+    exact_counts = request.args.get("exact_counts", False)
+    fingerprint = request.args.get("fingerprint", False)
+    parallel_workers = request.args.get("parallel_workers", 0)
+    digest_large_cols = request.args.get("digest_large_cols", False)
+    skip_unchanged = request.args.get("skip_unchanged", False)
+
+    if not cluster_name:
+        return jsonify({"error": "cluster_name is a required parameter"})
+
+    task_id = ace_db.generate_task_id()
+
+    try:
+        raw_args = ClusterSweepTask(
+            cluster_name=cluster_name,
+            _dbnames=dbnames,
+            _nodes=nodes,
+            repsets=repsets,
+            block_rows=block_rows,
+            max_cpu_ratio=max_cpu_ratio,
+            max_workers=max_workers,
+            output=output,
+            batch_size=batch_size,
+            quiet_mode=quiet,
+            skip_tables=skip_tables,
+            invoke_method="API",
+            low_impact=low_impact,
+            max_rows_per_sec=max_rows_per_sec,
+            max_mb_per_sec=max_mb_per_sec,
+            exact_counts=exact_counts,
+            fingerprint=fingerprint,
+            parallel_workers=parallel_workers,
+            digest_large_cols=digest_large_cols,
+            skip_unchanged=skip_unchanged,
+        )
+
+        raw_args.scheduler.task_id = task_id
+        raw_args.scheduler.task_type = "cluster-sweep"
+        raw_args.scheduler.deadline = deadline
+        cs_task = ace.cluster_sweep_checks(raw_args)
+        queue_info = job_queue.submit(ace_core.cluster_sweep, cs_task, priority)
+        return jsonify(
+            {
+                "task_id": task_id,
+                "submitted_at": datetime.now().isoformat(),
+                "queue": queue_info,
+            }
+        )
     except Exception as e:
         return jsonify({"error": str(e)})
 
@@ -326,11 +625,14 @@ Parameters:
     dbname (str): Optional. Name of the database. Defaults to None.
     nodes (str): Optional. Nodes to include in the diff. Defaults to "all".
     quiet (bool): Optional. Whether to suppress output. Defaults to False.
+    priority (int): Optional. Queue priority; higher values run first.
+        Defaults to 0.
 
 Returns:
     JSON object containing:
         - task_id (str): Unique identifier for the submitted task.
         - submitted_at (str): ISO formatted timestamp of task submission.
+        - queue (dict): Queue depth and the position of the task in the queue.
 """
 
 
@@ -340,6 +642,7 @@ def spock_diff_api():
     dbname = request.args.get("dbname", None)
     nodes = request.args.get("nodes", "all")
     quiet = request.args.get("quiet", False)
+    priority = request.args.get("priority", config.JOB_PRIORITY_DEFAULT, type=int)
 
     if not cluster_name:
         return jsonify({"error": "cluster_name is a required parameter"})
@@ -356,12 +659,15 @@ def spock_diff_api():
 
         raw_args.scheduler.task_id = task_id
         raw_args.scheduler.task_type = "spock-diff"
-        raw_args.scheduler.task_status = "RUNNING"
-        raw_args.scheduler.started_at = datetime.now()
         sd_task = ace.spock_diff_checks(raw_args)
-        ace_db.create_ace_task(task=sd_task)
-        scheduler.add_job(ace_core.spock_diff, args=(sd_task,))
-        return jsonify({"task_id": task_id, "submitted_at": datetime.now().isoformat()})
+        queue_info = job_queue.submit(ace_core.spock_diff, sd_task, priority)
+        return jsonify(
+            {
+                "task_id": task_id,
+                "submitted_at": datetime.now().isoformat(),
+                "queue": queue_info,
+            }
+        )
     except Exception as e:
         return jsonify({"error": str(e)})
 
@@ -377,11 +683,14 @@ Parameters:
     dbname (str): Optional. Name of the database. Defaults to None.
     nodes (str): Optional. Nodes to include in the diff. Defaults to "all".
     quiet (bool): Optional. Whether to suppress output. Defaults to False.
+    priority (int): Optional. Queue priority; higher values run first.
+        Defaults to 0.
 
 Returns:
     JSON object containing:
         - task_id (str): Unique identifier for the submitted task.
         - submitted_at (str): ISO formatted timestamp of task submission.
+        - queue (dict): Queue depth and the position of the task in the queue.
 """
 
 
@@ -392,6 +701,7 @@ def schema_diff_api():
     dbname = request.args.get("dbname", None)
     nodes = request.args.get("nodes", "all")
     quiet = request.args.get("quiet", False)
+    priority = request.args.get("priority", config.JOB_PRIORITY_DEFAULT, type=int)
 
     task_id = ace_db.generate_task_id()
 
@@ -412,12 +722,15 @@ def schema_diff_api():
 
         raw_args.scheduler.task_id = task_id
         raw_args.scheduler.task_type = "schema-diff"
-        raw_args.scheduler.task_status = "RUNNING"
-        raw_args.scheduler.started_at = datetime.now()
         sd_task = ace.schema_diff_checks(raw_args)
-        ace_db.create_ace_task(task=sd_task)
-        scheduler.add_job(ace_core.schema_diff, args=(sd_task,))
-        return jsonify({"task_id": task_id, "submitted_at": datetime.now().isoformat()})
+        queue_info = job_queue.submit(ace_core.schema_diff, sd_task, priority)
+        return jsonify(
+            {
+                "task_id": task_id,
+                "submitted_at": datetime.now().isoformat(),
+                "queue": queue_info,
+            }
+        )
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -431,6 +744,14 @@ Parameters:
 Returns:
     JSON object containing:
         - Task details if found, including status and other relevant information.
+          Tasks stay in the QUEUED state until the job queue admits them.
+        - queue: current queue depth and running jobs, along with the position
+          and wait time of the task if it is still queued.
+        - task_progress: live progress of a running diff or repair: blocks
+          done/total, mismatched blocks, rows/sec, bytes fetched, per-node
+          query latency percentiles and ETA. A running task whose progress
+          has not been updated for config.PROGRESS_STALL_SECONDS is flagged
+          as stalled.
         - Error message if task_id is missing or task is not found.
 """
 
@@ -450,21 +771,167 @@ def task_status_api():
     if not task_details:
         return jsonify({"error": f"Task {task_id} not found"}), 404
 
+    task_details["queue"] = job_queue.queue_info(task_id)
+
+    progress = task_details.get("task_progress")
+    if progress and task_details["task_status"] == "RUNNING":
+        since_update = datetime.now() - datetime.fromisoformat(progress["updated_at"])
+        progress["stalled"] = (
+            since_update.total_seconds() > config.PROGRESS_STALL_SECONDS
+        )
+
     return jsonify(task_details)
 
 
+"""
+Cancels a queued or running task.
+
+A queued task is removed from the job queue and marked as CANCELLED right away.
+A running table-diff, table-rerun or repset-diff is asked to stop: within
+config.CANCEL_POLL_INTERVAL seconds its in-flight queries are cancelled on the
+nodes, and it is marked as CANCELLED along with the diffs found so far.
+
+Args:
+    task_id (str): The ID of the task to cancel (required)
+
+Returns:
+    JSON object containing:
+        - task_id: The ID of the task.
+        - task_status: CANCELLED if the task was still queued, or CANCELLING if
+          it is running and has been asked to stop.
+        - Error message if the task is not found, has already finished, or is
+          a running task that cannot be cancelled.
+"""
+
+
+@app.route("/ace/task-cancel", methods=["GET"])
+def task_cancel_api():
+    task_id = request.args.get("task_id")
+
+    if not task_id:
+        return jsonify({"error": "task_id is a required parameter"})
+
+    try:
+        task_status = job_queue.cancel(task_id)
+    except Exception as e:
+        return jsonify({"error": str(e)})
+
+    return jsonify({"task_id": task_id, "task_status": task_status})
+
+
+"""
+API endpoint for the drift history recorded by the consistency monitor.
+
+Args:
+    cluster_name (str): Name of the cluster (required)
+    dbname (str, optional): Name of the database. Defaults to the first
+        database of the cluster.
+    table_name (str, optional): Limit the history to one table
+    limit (int, optional): Maximum number of history entries. Defaults to 100.
+
+Returns:
+    JSON object containing:
+        - watermarks: The last check and last successful verification of every
+          table of the database, by table name.
+        - history: The most recent checks, newest first.
+        - Error message if parameters are invalid.
+"""
+
+
+@app.route("/ace/table-drift", methods=["GET"])
+def table_drift_api():
+    cluster_name = request.args.get("cluster_name")
+    dbname = request.args.get("dbname", None)
+    table_name = request.args.get("table_name")
+    limit = request.args.get("limit", 100, type=int)
+
+    if not cluster_name:
+        return jsonify({"error": "cluster_name is a required parameter"})
+
+    if not dbname:
+        if not ace.check_cluster_exists(cluster_name):
+            return jsonify({"error": f"Cluster {cluster_name} not found"})
+
+        db, _, _ = cluster.load_json(cluster_name)
+        dbname = db[0]["db_name"]
+
+    try:
+        watermarks = ace_db.get_table_watermarks(cluster_name, dbname)
+        if table_name:
+            watermarks = {
+                name: watermark
+                for name, watermark in watermarks.items()
+                if name == table_name
+            }
+
+        history = ace_db.get_drift_history(cluster_name, dbname, table_name, limit)
+    except Exception as e:
+        return jsonify({"error": str(e)})
+
+    return jsonify({"watermarks": watermarks, "history": history})
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    # HTTP/1.1 lets pollers reuse their connections across requests. Idle
+    # connections are closed after the timeout so that they do not hold on
+    # to a server thread indefinitely.
+    protocol_version = "HTTP/1.1"
+    timeout = config.API_KEEPALIVE_TIMEOUT
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    WSGI server that hands every connection to a fixed-size pool of threads.
+
+    Status requests are served while other threads are busy validating and
+    submitting tasks. The tasks themselves run in the scheduler's process pool,
+    so a long-running diff never occupies a server thread.
+
+    Multi-process servers such as gunicorn are deliberately not used here: the
+    job queue lives in this process, and separate worker processes would each
+    enforce their own concurrency limits.
+    """
+
+    def __init__(self, host, port, wsgi_app, threads):
+        super().__init__(host, port, wsgi_app, handler=KeepAliveRequestHandler)
+        self.request_pool = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="ace-api"
+        )
+
+    def process_request(self, request, client_address):
+        self.request_pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.request_pool.shutdown(wait=False)
+
+
 """
 Starts the ACE API server.
 
 This function performs the following tasks:
-1. Creates necessary database tables for ACE.
-2. Starts the background scheduler for job management.
+1. Creates necessary database tables for ACE and purges expired tasks.
+2. Starts the background scheduler for job management, along with a
+   periodic purge of tasks older than config.TASK_RETENTION_DAYS.
 3. Runs the Flask application to serve the API.
 
-The API server is configured to:
-- Listen on localhost (127.0.0.1)
-- Use port 5000
-- Run in debug mode
+Args:
+    host (str, optional): Address to listen on. Defaults to config.API_HOST.
+    port (int, optional): Port to listen on. Defaults to config.API_PORT.
+    threads (int, optional): Number of threads serving requests. Defaults to
+        config.API_THREADS.
+    debug (bool, optional): If True, runs Flask's single-threaded development
+        server in debug mode instead. Defaults to False.
+
+By default, the API is served by a PooledWSGIServer with HTTP/1.1 keep-alive.
 
 Note: The scheduler is a BackgroundScheduler, so start() does not block execution.
 Future versions may require manual event listening for job management.
@@ -474,8 +941,22 @@ Returns:
 """
 
 
-def start_ace():
+def start_ace(
+    host=config.API_HOST,
+    port=config.API_PORT,
+    threads=config.API_THREADS,
+    debug=False,
+):
     ace_db.create_ace_tables()
+    ace_db.purge_ace_tasks()
+
+    scheduler.add_job(
+        ace_db.purge_ace_tasks,
+        "interval",
+        hours=config.TASK_PURGE_INTERVAL_HOURS,
+        executor="maintenance",
+        id="purge-ace-tasks",
+    )
 
     # Since the scheduler is a BackgroundScheduler,
     # start() will not block
@@ -488,4 +969,18 @@ def start_ace():
     # a BackgroundScheduler with add_job() will automatically
     # run the job in the background.
     # scheduler.add_listener(listener, EVENT_JOB_ADDED)
-    app.run(host="127.0.0.1", port=5000, debug=True)
+    if debug:
+        # The reloader would start a second scheduler and job queue
+        app.run(host=host, port=port, debug=True, use_reloader=False)
+        return
+
+    server = PooledWSGIServer(host, int(port), app, int(threads))
+    print(f"ACE API listening on http://{host}:{port} with {threads} threads")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        scheduler.shutdown(wait=False)
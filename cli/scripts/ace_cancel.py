@@ -0,0 +1,150 @@
+"""
+Cancellation and deadlines for running ACE tasks.
+"""
+
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import psycopg
+
+import ace_config as config
+import ace_db
+import util
+
+
+class TaskCanceller:
+    def __init__(
+        self,
+        task,
+        cancel_event,
+        backend_pids,
+        conn_params,
+        poll_interval=config.CANCEL_POLL_INTERVAL,
+    ):
+        """
+        Args:
+            task: The running task. Its task_id is used to look up cancel
+                requests and its scheduler.deadline, if set, limits its run time.
+            cancel_event: A multiprocessing (Manager) Event shared with the
+                workers of the task.
+            backend_pids: A shared list that workers append
+                (host, port, backend_pid) tuples to for every connection they
+                open.
+            conn_params: Connection parameters for the nodes of the task, used
+                to issue pg_cancel_backend().
+        """
+
+        self.task = task
+        self.cancel_event = cancel_event
+        self.backend_pids = backend_pids
+        self.conn_params = {
+            (params["host"], str(params["port"])): params for params in conn_params
+        }
+        self.poll_interval = poll_interval
+
+        self.reason = None
+
+        self.deadline_at = None
+        deadline = task.scheduler.deadline
+        if deadline is not None:
+            self.deadline_at = time.monotonic() + float(deadline)
+            if task.scheduler.started_at:
+                self.deadline_at -= (
+                    datetime.now() - task.scheduler.started_at
+                ).total_seconds()
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.reason is not None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def start(self) -> None:
+        # Catch a cancel request made while the task was still queued, or a
+        # deadline that has already expired, before any work is started
+        self.check()
+
+        self._thread = threading.Thread(
+            target=self._watch, name="ace-task-canceller", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def register_conn(self, conn) -> None:
+        """Makes a connection opened by the task itself cancellable as well"""
+
+        info = conn.info
+        self.backend_pids.append((info.host, str(info.port), info.backend_pid))
+
+    def check(self) -> bool:
+        if self.cancelled:
+            return True
+
+        if self.deadline_at is not None and time.monotonic() >= self.deadline_at:
+            self.cancel("deadline exceeded")
+        elif self.task.scheduler.task_id and ace_db.is_ace_task_cancel_requested(
+            self.task.scheduler.task_id
+        ):
+            self.cancel("cancelled by user")
+
+        return self.cancelled
+
+    def cancel(self, reason) -> None:
+        self.reason = reason
+        self.cancel_event.set()
+        self.cancel_backends()
+
+    def cancel_backends(self) -> None:
+        pids_by_node = defaultdict(list)
+        for host, port, pid in list(self.backend_pids):
+            pids_by_node[(host, str(port))].append(pid)
+
+        for node, pids in pids_by_node.items():
+            params = self.conn_params.get(node)
+            if not params:
+                continue
+
+            try:
+                with psycopg.connect(**params) as conn:
+                    conn.execute(
+                        "SELECT pg_cancel_backend(pid) FROM unnest(%s::int[]) AS pid",
+                        (pids,),
+                    )
+            except Exception as e:
+                # The workers still stop at their next check of cancel_event
+                util.message(
+                    f"Could not cancel queries on {node[0]}:{node[1]}: {str(e)}",
+                    p_state="warning",
+                    quiet_mode=getattr(self.task, "quiet_mode", False),
+                )
+
+    def _watch(self) -> None:
+        while not self._stop.wait(self.poll_interval):
+            try:
+                if self.cancelled:
+                    # A worker may have sent a new query just before it saw
+                    # cancel_event, so keep cancelling until the task stops
+                    self.cancel_backends()
+                else:
+                    self.check()
+            except Exception as e:
+                # A transient task store error must not kill the watcher
+                util.message(
+                    f"Could not check for cancel requests: {str(e)}",
+                    p_state="warning",
+                    quiet_mode=getattr(self.task, "quiet_mode", False),
+                )
@@ -3,13 +3,17 @@ import ace_config as config
 import ace_core
 import ace_db
 from ace_data_models import (
+    ClusterSweepTask,
     RepsetDiffTask,
+    RepsetRepairTask,
     SchemaDiffTask,
     SpockDiffTask,
     TableDiffTask,
     TableRepairTask,
 )
 import ace
+import ace_connections
+import ace_monitor
 import util
 from ace_exceptions import AceException
 
@@ -25,11 +29,42 @@ Args:
         config.BLOCK_ROWS_DEFAULT.
     max_cpu_ratio (float, optional): Maximum CPU usage ratio. Defaults to
         config.MAX_CPU_RATIO_DEFAULT.
-    output (str, optional): Output format. Defaults to "json".
+    output (str, optional): Output format: json, csv or parquet. Defaults to
+        "json".
     nodes (str, optional): Nodes to include in the diff. Defaults to "all".
     batch_size (int, optional): Size of each batch. Defaults to
         config.BATCH_SIZE_DEFAULT.
     quiet (bool, optional): Whether to suppress output. Defaults to False.
+    deadline (int, optional): Maximum run time in seconds. The diff is
+        cancelled once it expires, and the diffs found so far are written out.
+        Defaults to config.TASK_DEADLINE_DEFAULT; 0 means no deadline.
+    low_impact (bool, optional): Throttle the diff to protect the nodes. Block
+        queries are paced to max_rows_per_sec and max_mb_per_sec per node, and
+        pause while a node has too many active backends, too much replication
+        lag or slow block queries. Defaults to False.
+    max_rows_per_sec (int, optional): Target rows/sec read from each node.
+        Implies low_impact. Defaults to config.THROTTLE_ROWS_PER_SEC_DEFAULT
+        in low-impact mode.
+    max_mb_per_sec (float, optional): Target MB/sec read from each node.
+        Implies low_impact. Defaults to config.THROTTLE_MB_PER_SEC_DEFAULT
+        in low-impact mode.
+    exact_counts (bool, optional): Count the rows of the table on every node
+        before the diff, instead of using planner estimates. The counts run
+        concurrently but scan the whole table. Defaults to False.
+    fingerprint (bool, optional): Only compare one order-independent hash of
+        the whole table per node. Says whether the tables match, without
+        fetching any rows or writing a diff file. Defaults to False.
+    parallel_workers (int, optional): Hash every block with this many Postgres
+        parallel workers per node, and use correspondingly fewer connections.
+        Blocks of up to config.MAX_ALLOWED_PARALLEL_BLOCK_SIZE rows are then
+        allowed. Defaults to 0, which disables parallel hashing.
+    digest_large_cols (bool, optional): Compare non-key columns of large types
+        (config.DIGEST_COLUMN_TYPES, e.g. bytea, jsonb and vector) by their
+        md5 digests, and fetch their values only for rows that differ.
+        Defaults to False.
+    dsns (dict, optional): {name: DSN} of nodes outside the cluster, such as a
+        physical standby, that nodes may then name. Nodes may also name
+        <cluster>:<node> for a node of another cluster. Defaults to None.
 
 Raises:
     AceException: If there's an error specific to the ACE operation.
@@ -52,8 +87,19 @@ def table_diff_cli(
     nodes="all",
     batch_size=config.BATCH_SIZE_DEFAULT,
     quiet=False,
+    deadline=config.TASK_DEADLINE_DEFAULT,
+    low_impact=False,
+    max_rows_per_sec=None,
+    max_mb_per_sec=None,
+    exact_counts=False,
+    fingerprint=False,
+    parallel_workers=0,
+    digest_large_cols=False,
+    dsns=None,
 ):
 
+    # The pre-flight checks and the diff share their node connections
+    ace_connections.enable_persistent_connections()
     task_id = ace_db.generate_task_id()
 
     try:
@@ -67,11 +113,20 @@ def table_diff_cli(
             _nodes=nodes,
             batch_size=batch_size,
             quiet_mode=quiet,
+            low_impact=low_impact,
+            max_rows_per_sec=max_rows_per_sec,
+            max_mb_per_sec=max_mb_per_sec,
+            exact_counts=exact_counts,
+            fingerprint=fingerprint,
+            parallel_workers=parallel_workers,
+            digest_large_cols=digest_large_cols,
+            dsns=dsns,
         )
         raw_args.scheduler.task_id = task_id
         raw_args.scheduler.task_type = "table-diff"
         raw_args.scheduler.task_status = "RUNNING"
         raw_args.scheduler.started_at = datetime.now()
+        raw_args.scheduler.deadline = deadline
 
         td_task = ace.table_diff_checks(raw_args)
         ace_db.create_ace_task(task=td_task)
@@ -149,6 +204,66 @@ def table_repair_cli(
         util.exit_message(f"Unexpected error while running table repair: {e}")
 
 
+"""
+Repairs every table that a previous repset-diff found to differ.
+
+Args:
+    cluster_name (str): Name of the cluster to perform the repair on.
+    diff_task_id (str): Task ID of the repset-diff whose diff files to apply.
+    source_of_truth (str): Node to be used as the source of truth for the repair.
+    dbname (str, optional): Name of the database. Defaults to None.
+    dry_run (bool, optional): If True, reports the changes per table and node
+        without making them. Defaults to False.
+    quiet (bool, optional): Whether to suppress output. Defaults to False.
+    upsert_only (bool, optional): If True, only performs upsert operations,
+        skipping deletions. Defaults to False.
+
+Raises:
+    AceException: If there's an error specific to the ACE operation.
+    Exception: For any unexpected errors during the repset repair operation.
+
+Returns:
+    None. Every node is repaired over one connection, in parallel with the
+    other nodes, with tables in foreign key order and rows applied in
+    transactions of config.REPAIR_BATCH_ROWS rows.
+"""
+
+
+def repset_repair_cli(
+    cluster_name,
+    diff_task_id,
+    source_of_truth,
+    dbname=None,
+    dry_run=False,
+    quiet=False,
+    upsert_only=False,
+):
+
+    task_id = ace_db.generate_task_id()
+
+    try:
+        raw_args = RepsetRepairTask(
+            cluster_name=cluster_name,
+            diff_task_id=diff_task_id,
+            source_of_truth=source_of_truth,
+            _dbname=dbname,
+            dry_run=dry_run,
+            quiet_mode=quiet,
+            upsert_only=upsert_only,
+        )
+        raw_args.scheduler.task_id = task_id
+        raw_args.scheduler.task_type = "repset-repair"
+        raw_args.scheduler.task_status = "RUNNING"
+        raw_args.scheduler.started_at = datetime.now()
+        rr_task = ace.repset_repair_checks(raw_args)
+        ace_db.create_ace_task(task=rr_task)
+        ace_core.repset_repair(rr_task)
+    except AceException as e:
+        util.exit_message(str(e))
+    except Exception as e:
+        util.exit_message(f"Unexpected error while running repset repair: {e}")
+
+
 """
 Reruns a table diff operation based on a previous diff file.
 
@@ -160,6 +275,12 @@ Args:
     quiet (bool, optional): Whether to suppress output. Defaults to False.
     behavior (str, optional): The rerun behavior, either "multiprocessing" or
         "hostdb". Defaults to "multiprocessing".
+    deadline (int, optional): Maximum run time in seconds. Defaults to
+        config.TASK_DEADLINE_DEFAULT; 0 means no deadline.
+    low_impact (bool, optional): Throttle the rerun, as for table-diff.
+        Defaults to False.
+    max_rows_per_sec (int, optional): Target rows/sec read from each node.
+    max_mb_per_sec (float, optional): Target MB/sec read from each node.
 
 Raises:
     AceException: If there's an error specific to the ACE operation.
@@ -179,8 +300,14 @@ def table_rerun_cli(
     dbname=None,
     quiet=False,
     behavior="multiprocessing",
+    deadline=config.TASK_DEADLINE_DEFAULT,
+    low_impact=False,
+    max_rows_per_sec=None,
+    max_mb_per_sec=None,
 ):
 
+    # The pre-flight checks and the diff share their node connections
+    ace_connections.enable_persistent_connections()
     task_id = ace_db.generate_task_id()
 
     try:
@@ -195,11 +322,15 @@ def table_rerun_cli(
             batch_size=config.BATCH_SIZE_DEFAULT,
             quiet_mode=quiet,
             diff_file_path=diff_file,
+            low_impact=low_impact,
+            max_rows_per_sec=max_rows_per_sec,
+            max_mb_per_sec=max_mb_per_sec,
         )
         raw_args.scheduler.task_id = task_id
         raw_args.scheduler.task_type = "table-rerun"
         raw_args.scheduler.task_status = "RUNNING"
         raw_args.scheduler.started_at = datetime.now()
+        raw_args.scheduler.deadline = deadline
         td_task = ace.table_diff_checks(raw_args)
         ace_db.create_ace_task(task=td_task)
     except AceException as e:
@@ -231,12 +362,35 @@ Args:
         config.BLOCK_ROWS_DEFAULT.
     max_cpu_ratio (float, optional): Maximum CPU usage ratio. Defaults to
         config.MAX_CPU_RATIO_DEFAULT.
-    output (str, optional): Output format. Defaults to "json".
+    output (str, optional): Output format: json, csv or parquet. Defaults to
+        "json".
     nodes (str, optional): Nodes to include in the diff. Defaults to "all".
     batch_size (int, optional): Size of each batch. Defaults to
         config.BATCH_SIZE_DEFAULT.
     quiet (bool, optional): Whether to suppress output. Defaults to False.
     skip_tables (list, optional): List of tables to skip. Defaults to None.
+    deadline (int, optional): Maximum run time in seconds for the whole repset.
+        Tables not reached by then are not checked. Defaults to
+        config.TASK_DEADLINE_DEFAULT; 0 means no deadline.
+    low_impact (bool, optional): Throttle the diff of every table, as for
+        table-diff. Defaults to False.
+    max_rows_per_sec (int, optional): Target rows/sec read from each node.
+    max_mb_per_sec (float, optional): Target MB/sec read from each node.
+    exact_counts (bool, optional): Count the rows of every table exactly
+        instead of using planner estimates, as for table-diff. Defaults to
+        False.
+    fingerprint (bool, optional): Fingerprint all tables first, and diff only
+        the tables whose fingerprints differ across nodes. Defaults to False.
+    parallel_workers (int, optional): Hash blocks with Postgres parallel
+        workers, as for table-diff. Defaults to 0.
+    digest_large_cols (bool, optional): Compare large columns by their
+        digests, as for table-diff. Defaults to False.
+    skip_unchanged (bool, optional): Skip the tables that were last verified
+        without differences, by repset-diff or the monitor, and that have had
+        no writes on any node since, going by pg_stat_user_tables. Defaults to
+        False.
+    dsns (dict, optional): {name: DSN} of nodes outside the cluster, as for
+        table-diff. Defaults to None.
 
 Raises:
     AceException: If there's an error specific to the ACE operation.
@@ -260,8 +414,20 @@ def repset_diff_cli(
     batch_size=config.BATCH_SIZE_DEFAULT,
     quiet=False,
     skip_tables=None,
+    deadline=config.TASK_DEADLINE_DEFAULT,
+    low_impact=False,
+    max_rows_per_sec=None,
+    max_mb_per_sec=None,
+    exact_counts=False,
+    fingerprint=False,
+    parallel_workers=0,
+    digest_large_cols=False,
+    skip_unchanged=False,
+    dsns=None,
 ):
 
+    # The pre-flight checks and the diff share their node connections
+    ace_connections.enable_persistent_connections()
     task_id = ace_db.generate_task_id()
 
     try:
@@ -277,11 +443,21 @@ def repset_diff_cli(
             quiet_mode=quiet,
             invoke_method="CLI",
             skip_tables=skip_tables,
+            low_impact=low_impact,
+            max_rows_per_sec=max_rows_per_sec,
+            max_mb_per_sec=max_mb_per_sec,
+            exact_counts=exact_counts,
+            fingerprint=fingerprint,
+            parallel_workers=parallel_workers,
+            digest_large_cols=digest_large_cols,
+            skip_unchanged=skip_unchanged,
+            dsns=dsns,
         )
         raw_args.scheduler.task_id = task_id
         raw_args.scheduler.task_type = "repset-diff"
         raw_args.scheduler.task_status = "RUNNING"
         raw_args.scheduler.started_at = datetime.now()
+        raw_args.scheduler.deadline = deadline
         rd_task = ace.repset_diff_checks(raw_args)
         ace_db.create_ace_task(task=rd_task)
         ace_core.repset_diff(rd_task)
@@ -291,6 +467,110 @@ def repset_diff_cli(
         util.exit_message(f"Unexpected error while running repset diff: {e}")
 
 
+"""
+Diffs every repset of every database of a cluster as a single task, and writes
+one report of the results to reports/<date>/.
+
+Args:
+    cluster_name (str): Name of the cluster.
+    dbnames (str, optional): Comma-separated databases to sweep. Defaults to
+        all databases of the cluster.
+    repsets (str, optional): Comma-separated repsets to sweep in each
+        database. Defaults to all repsets.
+    block_rows (int, optional): Number of rows per block. Defaults to
+        config.BLOCK_ROWS_DEFAULT.
+    max_cpu_ratio (float, optional): Maximum CPU usage ratio. Defaults to
+        config.MAX_CPU_RATIO_DEFAULT.
+    max_workers (int, optional): Upper bound on the worker processes of the
+        whole sweep. Defaults to no limit beyond max_cpu_ratio.
+    output (str, optional): Output format: json, csv or parquet. Defaults to
+        "json".
+    nodes (str, optional): Nodes to include in the diff. Defaults to "all".
+    batch_size (int, optional): Size of each batch. Defaults to
+        config.BATCH_SIZE_DEFAULT.
+    quiet (bool, optional): Whether to suppress output. Defaults to False.
+    skip_tables (list, optional): List of tables to skip. Defaults to None.
+    deadline (int, optional): Maximum run time in seconds for the whole sweep.
+        Tables not reached by then are not checked. Defaults to
+        config.TASK_DEADLINE_DEFAULT; 0 means no deadline.
+    low_impact, max_rows_per_sec, max_mb_per_sec, exact_counts, fingerprint,
+    parallel_workers, digest_large_cols, skip_unchanged: As for repset-diff,
+        applied to every repset.
+
+Raises:
+    AceException: If there's an error specific to the ACE operation.
+    Exception: For any unexpected errors during the sweep.
+
+Returns:
+    None. All output messages are printed to stdout since it's a CLI function.
+"""
+
+
+def cluster_sweep_cli(
+    cluster_name,
+    dbnames=None,
+    repsets=None,
+    block_rows=config.BLOCK_ROWS_DEFAULT,
+    max_cpu_ratio=config.MAX_CPU_RATIO_DEFAULT,
+    max_workers=None,
+    output="json",
+    nodes="all",
+    batch_size=config.BATCH_SIZE_DEFAULT,
+    quiet=False,
+    skip_tables=None,
+    deadline=config.TASK_DEADLINE_DEFAULT,
+    low_impact=False,
+    max_rows_per_sec=None,
+    max_mb_per_sec=None,
+    exact_counts=False,
+    fingerprint=False,
+    parallel_workers=0,
+    digest_large_cols=False,
+    skip_unchanged=False,
+):
+
+    # The pre-flight checks and the diffs of every repset share their node
+    # connections
+    ace_connections.enable_persistent_connections()
+    task_id = ace_db.generate_task_id()
+
+    try:
+        raw_args = ClusterSweepTask(
+            cluster_name=cluster_name,
+            _dbnames=dbnames,
+            _nodes=nodes,
+            repsets=repsets,
+            block_rows=block_rows,
+            max_cpu_ratio=max_cpu_ratio,
+            max_workers=max_workers,
+            output=output,
+            batch_size=batch_size,
+            quiet_mode=quiet,
+            invoke_method="CLI",
+            skip_tables=skip_tables,
+            low_impact=low_impact,
+            max_rows_per_sec=max_rows_per_sec,
+            max_mb_per_sec=max_mb_per_sec,
+            exact_counts=exact_counts,
+            fingerprint=fingerprint,
+            parallel_workers=parallel_workers,
+            digest_large_cols=digest_large_cols,
+            skip_unchanged=skip_unchanged,
+        )
+        raw_args.scheduler.task_id = task_id
+        raw_args.scheduler.task_type = "cluster-sweep"
+        raw_args.scheduler.task_status = "RUNNING"
+        raw_args.scheduler.started_at = datetime.now()
+        raw_args.scheduler.deadline = deadline
+        cs_task = ace.cluster_sweep_checks(raw_args)
+        ace_db.create_ace_task(task=cs_task)
+        ace_core.cluster_sweep(cs_task)
+    except AceException as e:
+        util.exit_message(str(e))
+    except Exception as e:
+        util.exit_message(f"Unexpected error while running cluster sweep: {e}")
+
+
 """
 Performs a spock diff operation on a specified cluster.
 
@@ -382,3 +662,198 @@ def schema_diff_cli(cluster_name, schema_name, nodes="all", dbname=None, quiet=F
         util.exit_message(str(e))
     except Exception as e:
         util.exit_message(f"Unexpected error while running schema diff: {e}")
+
+
+"""
+Cancels a queued or running ACE task.
+
+A running table-diff, table-rerun or repset-diff stops within
+config.CANCEL_POLL_INTERVAL seconds: its in-flight queries are cancelled on the
+nodes, and the diffs found so far are written out and recorded with the task.
+A queued task is cancelled by the API server before it starts.
+
+Args:
+    task_id (str): ID of the task to cancel.
+
+Raises:
+    AceException: If the task does not exist, has already finished, or is a
+        running task that cannot be cancelled.
+
+Returns:
+    None. All output messages are printed to stdout since it's a CLI function.
+"""
+
+
+def task_cancel_cli(task_id):
+
+    # fire parses an all-digit task ID as a number
+    task_id = str(task_id)
+
+    try:
+        ace.cancel_task_checks(task_id)
+        if not ace_db.request_ace_task_cancel(task_id):
+            raise AceException(f"Task {task_id} is not queued or running")
+
+        util.message(
+            f"Requested cancellation of task {task_id}",
+            p_state="success",
+        )
+    except AceException as e:
+        util.exit_message(str(e))
+    except Exception as e:
+        util.exit_message(f"Unexpected error while cancelling task: {e}")
+
+
+"""
+Continuously checks the replicated tables of a cluster for drift.
+
+Every interval seconds, the monitor diffs every table listed in spock.tables
+that has seen writes since it was last verified, most written first, as well as
+tables whose last verification is more than reverify_hours old. Every check is
+recorded as a table-diff task and in the drift history of the table. The
+monitor stops after the current table on SIGTERM.
+
+Args:
+    cluster_name (str): Name of the cluster.
+    dbname (str, optional): Name of the database. Defaults to None.
+    nodes (str, optional): Nodes to include in the diffs. Defaults to "all".
+    interval (int, optional): Seconds between monitor cycles. Defaults to
+        config.MONITOR_INTERVAL.
+    reverify_hours (int, optional): Hours after which unchanged tables are
+        checked again. Defaults to config.MONITOR_REVERIFY_HOURS.
+    once (bool, optional): Run a single cycle and exit. Defaults to False.
+    block_rows (int, optional): Number of rows per block. Defaults to
+        config.BLOCK_ROWS_DEFAULT.
+    max_cpu_ratio (float, optional): Maximum CPU usage ratio. Defaults to
+        config.MAX_CPU_RATIO_DEFAULT.
+    batch_size (int, optional): Size of each batch. Defaults to
+        config.BATCH_SIZE_DEFAULT.
+    low_impact (bool, optional): Throttle every diff, as for table-diff.
+        Defaults to False.
+    max_rows_per_sec (int, optional): Target rows/sec read from each node.
+    max_mb_per_sec (float, optional): Target MB/sec read from each node.
+    quiet (bool, optional): Whether to suppress the output of the diffs.
+        Defaults to False.
+
+Raises:
+    AceException: If there's an error specific to the ACE operation.
+    Exception: For any unexpected errors while running the monitor.
+
+Returns:
+    None. All output messages are printed to stdout since it's a CLI function.
+"""
+
+
+def monitor_cli(
+    cluster_name,
+    dbname=None,
+    nodes="all",
+    interval=config.MONITOR_INTERVAL,
+    reverify_hours=config.MONITOR_REVERIFY_HOURS,
+    once=False,
+    block_rows=config.BLOCK_ROWS_DEFAULT,
+    max_cpu_ratio=config.MAX_CPU_RATIO_DEFAULT,
+    batch_size=config.BATCH_SIZE_DEFAULT,
+    low_impact=False,
+    max_rows_per_sec=None,
+    max_mb_per_sec=None,
+    quiet=False,
+):
+
+    try:
+        monitor = ace_monitor.ConsistencyMonitor(
+            cluster_name=cluster_name,
+            dbname=dbname,
+            nodes=nodes,
+            interval=interval,
+            reverify_hours=reverify_hours,
+            block_rows=block_rows,
+            max_cpu_ratio=max_cpu_ratio,
+            batch_size=batch_size,
+            low_impact=low_impact,
+            max_rows_per_sec=max_rows_per_sec,
+            max_mb_per_sec=max_mb_per_sec,
+            quiet_mode=quiet,
+        )
+        monitor.run(once=once)
+    except AceException as e:
+        util.exit_message(str(e))
+    except Exception as e:
+        util.exit_message(f"Unexpected error while running the monitor: {e}")
+
+
+"""
+Installs or removes the row-hash index of a table on every node.
+
+A table with a row-hash index on every node is checked by table-diff, and by
+the repset-diffs and monitor that run it, by comparing block summaries that
+the nodes keep up to date on every write, instead of by scanning the table.
+Installing locks the table against writes while the index is backfilled.
+
+Args:
+    action (str): "install" or "remove".
+    cluster_name (str): Name of the cluster.
+    table_name (str): Name of the table, as schema.table.
+    dbname (str, optional): Name of the database. Defaults to None.
+    nodes (str, optional): Nodes to install on or remove from. Defaults to
+        "all".
+    blocks (int, optional): Number of blocks to spread the rows of the table
+        over. Defaults to config.ROW_HASH_BLOCKS_DEFAULT.
+    quiet (bool, optional): Whether to suppress output. Defaults to False.
+
+Raises:
+    AceException: If there's an error specific to the ACE operation.
+    Exception: For any unexpected errors.
+
+Returns:
+    None. All output messages are printed to stdout since it's a CLI function.
+"""
+
+
+def row_hash_cli(
+    action,
+    cluster_name,
+    table_name,
+    dbname=None,
+    nodes="all",
+    blocks=config.ROW_HASH_BLOCKS_DEFAULT,
+    quiet=False,
+):
+
+    ace_connections.enable_persistent_connections()
+
+    try:
+        if action not in ("install", "remove"):
+            raise AceException("Action should be one of install or remove")
+
+        try:
+            blocks = int(blocks)
+        except (TypeError, ValueError):
+            raise AceException("Invalid value for --blocks")
+
+        if blocks < 1 or blocks > config.MAX_ROW_HASH_BLOCKS:
+            raise AceException(
+                f"Blocks should be between 1 and {config.MAX_ROW_HASH_BLOCKS}"
+            )
+
+        raw_args = TableDiffTask(
+            cluster_name=cluster_name,
+            _table_name=table_name,
+            _dbname=dbname,
+            block_rows=config.BLOCK_ROWS_DEFAULT,
+            max_cpu_ratio=config.MAX_CPU_RATIO_DEFAULT,
+            output="json",
+            _nodes=nodes,
+            batch_size=config.BATCH_SIZE_DEFAULT,
+            quiet_mode=quiet,
+        )
+        td_task = ace.table_diff_checks(raw_args)
+
+        if action == "install":
+            ace_core.row_hash_install(td_task, blocks)
+        else:
+            ace_core.row_hash_remove(td_task)
+    except AceException as e:
+        util.exit_message(str(e))
+    except Exception as e:
+        util.exit_message(f"Unexpected error while managing row-hash index: {e}")
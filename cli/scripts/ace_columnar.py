@@ -0,0 +1,115 @@
+"""
+Columnar comparison of mismatched blocks by key and row hashes, used when
+NumPy is installed.
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import psycopg
+from psycopg import sql
+
+COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\0"
+
+
+def available() -> bool:
+    return np is not None
+
+
+def row_key(key_cols) -> sql.Composable:
+    return sql.SQL("ROW({})::text").format(
+        sql.SQL(", ").join(sql.Identifier("t", col) for col in key_cols)
+    )
+
+
+def hashes_sql(select_list, table, where_clause, key_cols) -> sql.Composable:
+    """The COPY that writes out the key hash and row hash of every row"""
+
+    return sql.SQL(
+        "COPY (SELECT hashtextextended({row_key}, 0), "
+        "hashtextextended(t::text, 0) "
+        "FROM (SELECT {select_list} FROM {table} WHERE {where_clause}) t) "
+        "TO STDOUT (FORMAT BINARY)"
+    ).format(
+        row_key=row_key(key_cols),
+        select_list=select_list,
+        table=table,
+        where_clause=where_clause,
+    )
+
+
+def rows_sql(select_list, table, where_clause, key_cols) -> sql.Composable:
+    """The query that fetches the rows with the given key hashes"""
+
+    return sql.SQL(
+        "SELECT * FROM (SELECT {select_list} FROM {table} WHERE {where_clause}) t "
+        "WHERE hashtextextended({row_key}, 0) = ANY(%s)"
+    ).format(
+        row_key=row_key(key_cols),
+        select_list=select_list,
+        table=table,
+        where_clause=where_clause,
+    )
+
+
+def fetch_hashes(conn, query, params) -> tuple:
+    """
+    Runs a COPY from hashes_sql() and returns the key hashes and row hashes
+    as int64 arrays, and the number of bytes copied
+    """
+
+    # COPY takes no bind parameters, so they are merged into the statement
+    query = psycopg.ClientCursor(conn).mogrify(query, params)
+
+    with conn.cursor() as cur:
+        with cur.copy(query) as copy:
+            data = b"".join(copy)
+
+    if not data.startswith(COPY_SIGNATURE):
+        raise ValueError("Unexpected COPY data: bad signature")
+
+    # Signature, flags, header extension length and the extension
+    start = len(COPY_SIGNATURE) + 8 + int.from_bytes(data[15:19], "big")
+
+    # Every tuple is a field count, and a length and value for each field.
+    # Neither hash can be NULL, so every tuple is 26 bytes.
+    layout = np.dtype(
+        [
+            ("fields", ">i2"),
+            ("key_len", ">i4"),
+            ("key", ">i8"),
+            ("row_len", ">i4"),
+            ("row", ">i8"),
+        ]
+    )
+    # The data ends with a field count of -1
+    count, rest = divmod(len(data) - start - 2, layout.itemsize)
+    if rest or data[-2:] != b"\xff\xff":
+        raise ValueError("Unexpected COPY data: bad tuple layout")
+
+    tuples = np.frombuffer(data, dtype=layout, offset=start, count=count)
+
+    return tuples["key"].astype(np.int64), tuples["row"].astype(np.int64), len(data)
+
+
+def diff_hashes(keys1, rows1, keys2, rows2):
+    """
+    Returns the key hashes of the rows that differ on each side: rows whose
+    key is missing from the other side, and rows whose hash differs from the
+    other side's. Returns None if a side has two rows with the same key hash.
+    """
+
+    if len(np.unique(keys1)) != len(keys1) or len(np.unique(keys2)) != len(keys2):
+        return None
+
+    common, idx1, idx2 = np.intersect1d(
+        keys1, keys2, assume_unique=True, return_indices=True
+    )
+    changed = common[rows1[idx1] != rows2[idx2]]
+
+    only1 = np.setdiff1d(keys1, keys2, assume_unique=True)
+    only2 = np.setdiff1d(keys2, keys1, assume_unique=True)
+
+    return np.concatenate([only1, changed]), np.concatenate([only2, changed])
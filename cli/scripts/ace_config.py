@@ -1,17 +1,188 @@
 import os
+from multiprocessing import cpu_count
 
 # Postgres options
 STATEMENT_TIMEOUT = 60000
 
 
 #  Default values for ACE table-diff
-MAX_DIFF_ROWS = 10000
+# Diffs spill to disk, so there is no limit on the rows that differ unless one
+# is set here. A diff that reaches the limit is stopped and written out.
+MAX_DIFF_ROWS = int(os.environ.get("ACE_MAX_DIFF_ROWS", 0))
 MIN_ALLOWED_BLOCK_SIZE = 1000
 MAX_ALLOWED_BLOCK_SIZE = 100000
+# Blocks hashed with Postgres parallel query may be larger, as the hash is
+# spread over the parallel workers of each node
+MAX_ALLOWED_PARALLEL_BLOCK_SIZE = 1000000
 BLOCK_ROWS_DEFAULT = os.environ.get("ACE_BLOCK_ROWS", 10000)
 MAX_CPU_RATIO_DEFAULT = os.environ.get("ACE_MAX_CPU_RATIO", 0.6)
 BATCH_SIZE_DEFAULT = os.environ.get("ACE_BATCH_SIZE", 1)
 MAX_BATCH_SIZE = 1000
+# Block boundaries read from the server-side cursor at a time
+BLOCK_OFFSETS_FETCH_ROWS = 10000
+
+
+# Diff spill files (SQLite), one per table-diff or table-rerun
+DIFF_SPILL_DIR = os.environ.get("ACE_DIFF_SPILL_DIR", "diffs")
+# Rows read back from a spill file at a time while writing out diffs
+DIFF_SPILL_FETCH_ROWS = 1000
+
+# ACE task store (SQLite)
+# Milliseconds a writer waits on a locked database before giving up
+TASK_DB_BUSY_TIMEOUT = int(os.environ.get("ACE_TASK_DB_BUSY_TIMEOUT", 5000))
+TASK_DB_MAX_RETRIES = 5
+# Seconds; doubled after each failed attempt
+TASK_DB_RETRY_DELAY = 0.1
+# Finished tasks older than this are purged by the API server
+TASK_RETENTION_DAYS = int(os.environ.get("ACE_TASK_RETENTION_DAYS", 30))
+TASK_PURGE_INTERVAL_HOURS = int(os.environ.get("ACE_TASK_PURGE_INTERVAL_HOURS", 24))
+
+
+# Live progress of running tasks
+# Seconds between progress snapshots written to the task record
+PROGRESS_PUBLISH_INTERVAL = int(os.environ.get("ACE_PROGRESS_PUBLISH_INTERVAL", 5))
+# A running task whose progress has not been updated for this many seconds
+# is reported as stalled by task-status
+PROGRESS_STALL_SECONDS = int(os.environ.get("ACE_PROGRESS_STALL_SECONDS", 300))
+
+
+# Table metadata cache
+# Seconds for which the cached metadata of a schema is used without checking
+# the tables in it for DDL
+METADATA_CACHE_TTL = int(os.environ.get("ACE_METADATA_CACHE_TTL", 60))
+
+
+# Fingerprint mode
+# Connections per node that fingerprint ranges of tables concurrently
+FINGERPRINT_WORKERS_PER_NODE = int(
+    os.environ.get("ACE_FINGERPRINT_WORKERS_PER_NODE", 4)
+)
+# Tables are split into ranges of at least this many pages (128MB of 8kB
+# pages), up to one range per worker
+FINGERPRINT_RANGE_PAGES = int(os.environ.get("ACE_FINGERPRINT_RANGE_PAGES", 16384))
+
+
+# Parallel block hashing
+# Upper limit for --parallel_workers, the max_parallel_workers_per_gather of
+# each block hash query
+MAX_PARALLEL_HASH_WORKERS = 16
+# Session settings, besides max_parallel_workers_per_gather, that let the
+# planner choose a parallel plan even for a range of a few thousand pages
+PARALLEL_HASH_SETTINGS = {
+    "parallel_setup_cost": 0,
+    "parallel_tuple_cost": 0,
+    "min_parallel_table_scan_size": 0,
+    "min_parallel_index_scan_size": 0,
+}
+
+
+# Large column digests
+# With --digest_large_cols, non-key columns of these types are compared by
+# their md5 digests, and fetched only for rows whose digests differ. Types
+# are matched on their name without type modifiers or schema, e.g. vector(3)
+# and public.vector both match vector.
+DIGEST_COLUMN_TYPES = [
+    "bytea",
+    "json",
+    "jsonb",
+    "text",
+    "xml",
+    "vector",
+    "geometry",
+    "geography",
+    "tsvector",
+]
+
+
+# Columnar comparison of mismatched blocks
+# With NumPy installed, mismatched blocks of at least this many rows are
+# compared by row hashes copied from the nodes in binary, and only the rows
+# that differ are fetched. 0 turns columnar comparison off.
+COLUMNAR_MIN_ROWS = int(os.environ.get("ACE_COLUMNAR_MIN_ROWS", 1000))
+
+# Row-hash indexes
+# Number of blocks the rows of a table are spread over by its row-hash index.
+# A table-diff compares one summary row per block and node.
+ROW_HASH_BLOCKS_DEFAULT = int(os.environ.get("ACE_ROW_HASH_BLOCKS", 4096))
+MAX_ROW_HASH_BLOCKS = 1000000
+
+
+# Cancellation and deadlines
+# Seconds between checks for a cancel request or an expired deadline
+CANCEL_POLL_INTERVAL = int(os.environ.get("ACE_CANCEL_POLL_INTERVAL", 1))
+# Default limit on the run time of a task, in seconds. 0 means no deadline.
+TASK_DEADLINE_DEFAULT = int(os.environ.get("ACE_TASK_DEADLINE", 0))
+# Task types that can be cancelled while they are running. Any task can be
+# cancelled while it waits in the API job queue.
+CANCELLABLE_TASK_TYPES = [
+    "table-diff",
+    "table-rerun",
+    "repset-diff",
+    "cluster-sweep",
+]
+
+
+# Low-impact diff mode
+# Per-node targets used when low_impact is set without explicit rates.
+# 0 means no limit.
+THROTTLE_ROWS_PER_SEC_DEFAULT = int(
+    os.environ.get("ACE_THROTTLE_ROWS_PER_SEC", 50000)
+)
+THROTTLE_MB_PER_SEC_DEFAULT = int(os.environ.get("ACE_THROTTLE_MB_PER_SEC", 0))
+# Seconds between node health checks
+THROTTLE_CHECK_INTERVAL = int(os.environ.get("ACE_THROTTLE_CHECK_INTERVAL", 5))
+# Workers pause while any node is over one of these thresholds
+THROTTLE_MAX_ACTIVE_BACKENDS = int(
+    os.environ.get("ACE_THROTTLE_MAX_ACTIVE_BACKENDS", 32)
+)
+THROTTLE_MAX_LAG_SECONDS = int(os.environ.get("ACE_THROTTLE_MAX_LAG_SECONDS", 30))
+THROTTLE_MAX_QUERY_LATENCY = int(
+    os.environ.get("ACE_THROTTLE_MAX_QUERY_LATENCY", 10)
+)
+# Number of recent block queries per node that the latency p95 is taken over
+THROTTLE_LATENCY_WINDOW = 20
+# The rate is halved on every unhealthy check, down to this fraction of the
+# target, and recovers by THROTTLE_RECOVERY_STEP on every healthy one
+THROTTLE_MIN_FACTOR = 0.1
+THROTTLE_RECOVERY_STEP = 0.1
+# Seconds between checks of a paused worker
+THROTTLE_PAUSE_POLL_INTERVAL = 0.5
+
+
+# Repset repair
+# Rows upserted or deleted on a node per transaction
+REPAIR_BATCH_ROWS = int(os.environ.get("ACE_REPAIR_BATCH_ROWS", 10000))
+
+
+# Consistency monitor
+# Seconds between the start of one monitor cycle and the next
+MONITOR_INTERVAL = int(os.environ.get("ACE_MONITOR_INTERVAL", 3600))
+# Tables with no writes since they were last verified are checked again once
+# their last verification is this many hours old
+MONITOR_REVERIFY_HOURS = int(os.environ.get("ACE_MONITOR_REVERIFY_HOURS", 24))
+
+
+# ACE API server
+API_HOST = os.environ.get("ACE_API_HOST", "127.0.0.1")
+API_PORT = int(os.environ.get("ACE_API_PORT", 5000))
+API_THREADS = int(os.environ.get("ACE_API_THREADS", 16))
+# Seconds an idle keep-alive connection may hold on to a server thread
+API_KEEPALIVE_TIMEOUT = int(os.environ.get("ACE_API_KEEPALIVE_TIMEOUT", 5))
+
+
+# ACE API job queue
+# Jobs beyond these limits wait in the queue until a running job finishes
+MAX_RUNNING_JOBS = int(os.environ.get("ACE_MAX_RUNNING_JOBS", 4))
+MAX_RUNNING_JOBS_PER_CLUSTER = int(
+    os.environ.get("ACE_MAX_RUNNING_JOBS_PER_CLUSTER", 2)
+)
+# Worker processes, and connections per node, shared by all running jobs.
+# Each running job gets an equal share of the smaller of the two.
+JOB_CPU_BUDGET = int(
+    os.environ.get("ACE_JOB_CPU_BUDGET", max(1, int(cpu_count() * 0.6)))
+)
+JOB_CONNECTION_BUDGET = int(os.environ.get("ACE_JOB_CONNECTION_BUDGET", 32))
+JOB_PRIORITY_DEFAULT = 0
 
 
 # Return codes for compare_checksums
@@ -19,3 +190,4 @@ BLOCK_OK = 0
 MAX_DIFFS_EXCEEDED = 1
 BLOCK_MISMATCH = 2
 BLOCK_ERROR = 3
+TASK_CANCELLED = 4
@@ -0,0 +1,64 @@
+"""
+Connections to cluster nodes for the pre-flight checks and catalog queries of
+ACE tasks, optionally kept open and reused.
+"""
+
+import os
+import threading
+
+import psycopg
+
+conn_state = threading.local()
+persistent = False
+
+
+def enable_persistent_connections() -> None:
+    global persistent
+    persistent = True
+
+
+def node_key(params) -> tuple:
+    # Nodes given by DSN may add sslmode and other parameters, which a reused
+    # connection must have been opened with too
+    extra = tuple(
+        sorted(
+            (name, str(value))
+            for name, value in params.items()
+            if name not in ("host", "port", "dbname", "user", "password", "options")
+        )
+    )
+
+    return (
+        params["host"],
+        str(params.get("port", 5432)),
+        params["dbname"],
+        params["user"],
+    ) + extra
+
+
+def get_node_conn(params) -> psycopg.Connection:
+    if not persistent:
+        return psycopg.connect(**params)
+
+    if getattr(conn_state, "pid", None) != os.getpid():
+        # Never reuse connections inherited across a fork
+        conn_state.conns = {}
+        conn_state.pid = os.getpid()
+
+    key = node_key(params)
+    conn = conn_state.conns.get(key)
+
+    if conn is not None and not conn.closed and not conn.broken:
+        return conn
+
+    conn = psycopg.connect(**params, autocommit=True)
+    conn_state.conns[key] = conn
+
+    return conn
+
+
+def close_all() -> None:
+    for conn in getattr(conn_state, "conns", {}).values():
+        conn.close()
+
+    conn_state.conns = {}
@@ -2,10 +2,14 @@ import ast
 import json
 from math import ceil
 import os
+import threading
+import time
 from datetime import datetime
 from itertools import combinations
 from multiprocessing import Manager, cpu_count
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import nullcontext
+from graphlib import CycleError, TopologicalSorter
 
 import psycopg
 from mpire import WorkerPool
@@ -15,70 +19,442 @@ from psycopg import sql
 from psycopg.rows import dict_row
 
 import ace
+import ace_connections
+import ace_columnar
+import ace_diff_index
+import ace_keys
+import ace_nodes
+import ace_fingerprint
+import ace_offsets
+import ace_row_hash
 import ace_db
+import ace_watermarks
 import cluster
 import util
 import ace_config as config
 from ace_data_models import (
+    ClusterSweepTask,
     RepsetDiffTask,
+    RepsetRepairTask,
     SchemaDiffTask,
     SpockDiffTask,
     TableDiffTask,
     TableRepairTask,
 )
 
+from ace_cancel import TaskCanceller
+from ace_diff_store import DiffStore
 from ace_exceptions import AceException
+from ace_progress import TaskProgress
+from ace_throttle import NodeHealthMonitor, RateLimiter
 
 
-def run_query(worker_state, host, query):
+def run_query(worker_state, host, query, params=None):
     cur = worker_state[host]
-    cur.execute(query)
+    cur.execute(query, params)
     results = cur.fetchall()
     return results
 
 
+def run_pipelined_queries(worker_state, host, queries):
+    """
+    Sends (query, params) pairs to a node in one pipeline, each as a
+    statement prepared on the server. Returns the rows of every query and the
+    time taken for all of them.
+    """
+
+    conn = worker_state[host].connection
+    start = time.monotonic()
+
+    with conn.pipeline():
+        cursors = []
+        for query, params in queries:
+            cur = conn.cursor()
+            cur.execute(query, params, prepare=True)
+            cursors.append(cur)
+
+    results = [cur.fetchall() for cur in cursors]
+    return results, time.monotonic() - start
+
+
+def hash_blocks(worker_state, nodes, queries):
+    """
+    Runs the hash queries of a batch of blocks on all nodes in parallel.
+
+    Returns:
+        {node: [((hash, row count), latency) for every query]}, with the time
+        taken by the pipeline shared evenly between its queries, and the list
+        of errors raised
+    """
+
+    with ThreadPoolExecutor(max_workers=len(nodes)) as executor:
+        futures = {
+            node: executor.submit(run_pipelined_queries, worker_state, node, queries)
+            for node in nodes
+        }
+
+    hashes = {}
+    errors = []
+    for node, future in futures.items():
+        if future.exception():
+            errors.append(future.exception())
+            continue
+
+        results, elapsed = future.result()
+        hashes[node] = [(rows[0], elapsed / len(queries)) for rows in results]
+
+    return hashes, errors
+
+
+def get_range_filter(p_key, pkey1, pkey2) -> tuple:
+    """
+    Returns a WHERE condition for the primary key range [pkey1, pkey2), with
+    the bounds as parameters, and the parameters. A missing bound leaves the
+    range open, so every table has at most four shapes of block query.
+    """
+
+    keys = [col.strip() for col in p_key.split(",")]
+    cols = sql.SQL(", ").join(sql.Identifier(col) for col in keys)
+    placeholders = sql.SQL(", ").join(sql.Placeholder() * len(keys))
+
+    conditions = []
+    params = []
+    for bound, op in ((pkey1, ">="), (pkey2, "<")):
+        if bound is None:
+            continue
+
+        conditions.append(
+            sql.SQL("({cols}) {op} ({placeholders})").format(
+                cols=cols, op=sql.SQL(op), placeholders=placeholders
+            )
+        )
+        params += [bound] if len(keys) == 1 else list(bound)
+
+    if not conditions:
+        return sql.SQL("true"), params
+
+    return sql.SQL(" AND ").join(conditions), params
+
+
+def get_hash_sql(shared_objects, select_list, table, where_clause):
+    """The query that hashes the rows of one block and counts them"""
+
+    if shared_objects["mode"] == "diff" and shared_objects.get("parallel_workers"):
+        # array_agg(... ORDER BY) cannot be split between parallel workers.
+        # Sums of row hashes can, and are equal whenever the rows are.
+        return sql.SQL(
+            "SELECT concat_ws(':', "
+            "sum(hashtextextended(t::text, 0)::numeric), "
+            "sum(hashtextextended(t::text, 1)::numeric)), count(*) "
+            "FROM (SELECT {select_list} FROM {table_name} "
+            "WHERE {where_clause}) t"
+        ).format(select_list=select_list, table_name=table, where_clause=where_clause)
+
+    return sql.SQL(
+        "SELECT md5(cast(array_agg(t.* ORDER BY {p_key}) AS text)), count(*) "
+        "FROM (SELECT {select_list} FROM {table_name} "
+        "WHERE {where_clause}) t"
+    ).format(
+        select_list=select_list,
+        p_key=sql.SQL(", ").join(
+            [sql.Identifier(col.strip()) for col in shared_objects["p_key"].split(",")]
+        ),
+        table_name=table,
+        where_clause=where_clause,
+    )
+
+
 def init_db_connection(shared_objects, worker_state):
-    db, pg, node_info = cluster.load_json(shared_objects["cluster_name"])
+    # The nodes of the task include those it diffs from outside the cluster
+    cluster_nodes = shared_objects.get("cluster_nodes")
 
-    cluster_nodes = []
-    database = shared_objects["database"]
+    if not cluster_nodes:
+        db, pg, node_info = cluster.load_json(shared_objects["cluster_name"])
+        database = shared_objects["database"]
 
-    # Combine db and cluster_nodes into a single json
-    for node in node_info:
-        combined_json = {**database, **node}
-        cluster_nodes.append(combined_json)
+        # Combine db and cluster_nodes into a single json
+        cluster_nodes = [{**database, **node} for node in node_info]
 
-    for node in cluster_nodes:
-        params = {
-            "dbname": node["db_name"],
-            "user": node["db_user"],
-            "password": node["db_password"],
-            "host": node["public_ip"],
-            "port": node.get("port", 5432),
-            "options": f"-c statement_timeout={config.STATEMENT_TIMEOUT}",
+    options = f"-c statement_timeout={config.STATEMENT_TIMEOUT}"
+
+    parallel_workers = shared_objects.get("parallel_workers")
+    if parallel_workers:
+        settings = {
+            "max_parallel_workers_per_gather": parallel_workers,
+            **config.PARALLEL_HASH_SETTINGS,
         }
+        options += "".join(f" -c {name}={value}" for name, value in settings.items())
 
-        worker_state[node["name"]] = psycopg.connect(**params).cursor()
+    for node in cluster_nodes:
+        params = ace_nodes.conn_params(
+            node,
+            {
+                "dbname": node["db_name"],
+                "user": node["db_user"],
+                "password": node["db_password"],
+                "host": node["public_ip"],
+                "port": node.get("port", 5432),
+                "options": options,
+            },
+        )
 
+        worker_state[node["name"]] = psycopg.connect(**params).cursor()
 
-# Accepts list of pkeys and values and generates a where clause that in the form
-# `(pkey1name, pkey2name ...) in ( (pkey1val1, pkey2val1 ...),
-#                                 (pkey1val2, pkey2val2 ...) ... )`
-def generate_where_clause(primary_keys, id_values):
-    if len(primary_keys) == 1:
-        # Single primary key
-        id_values_list = ", ".join(repr(val) for val in id_values)
-        query = f"{primary_keys[0]} IN ({id_values_list})"
+        # Lets the task cancel this worker's in-flight queries
+        if "backend_pids" in shared_objects:
+            info = worker_state[node["name"]].connection.info
+            shared_objects["backend_pids"].append(
+                (info.host, str(info.port), info.backend_pid)
+            )
 
-    else:
-        # Composite primary key
-        conditions = ", ".join(
-            f"({', '.join(repr(val) for val in id_tuple)})" for id_tuple in id_values
+    throttle = shared_objects.get("throttle")
+    if throttle:
+        worker_state["rate_limiter"] = RateLimiter(
+            throttle["rows_per_sec"],
+            throttle["bytes_per_sec"],
+            throttle["state"],
+            shared_objects["cancel_event"],
         )
-        key_columns = ", ".join(primary_keys)
-        query = f"({key_columns}) IN ({conditions})"
 
-    return query
+
+def load_diff_keys(shared_objects, worker_state, keys, batch, nodes=None):
+    """
+    Copies a batch of primary keys into the temp key table of every node (or
+    of the given nodes), creating the tables on first use
+    """
+
+    key_oids = worker_state.setdefault("key_oids", {})
+
+    for node in nodes or shared_objects["node_list"]:
+        conn = worker_state[node].connection
+
+        if node not in key_oids:
+            key_oids[node] = ace_keys.create_key_table(
+                conn, keys, shared_objects["key_types"]
+            )
+
+        ace_keys.load_keys(conn, keys, key_oids[node], batch)
+
+
+def diff_key_filter(shared_objects, worker_state, keys, batch, nodes=None):
+    """
+    Returns a WHERE condition matching the rows with the keys of a batch, and
+    its parameters. The keys are passed as arrays if any node of the task is
+    read-only, and are loaded into the temp key tables otherwise.
+    """
+
+    if shared_objects.get("read_only_nodes"):
+        return ace_keys.key_array_filter(keys, shared_objects["key_types"], batch)
+
+    load_diff_keys(shared_objects, worker_state, keys, batch, nodes)
+
+    return ace_keys.key_filter(keys), []
+
+
+def get_digest_cols(cols_list, key, table_types) -> dict:
+    """
+    Returns {column: type name} of the non-key columns whose values are
+    compared by digest under --digest_large_cols
+    """
+
+    digest_cols = {}
+    for col in cols_list:
+        type_name = table_types.get(col, "").split("(")[0].split(".")[-1]
+        type_name = type_name.strip().strip('"')
+        if col not in key and type_name in config.DIGEST_COLUMN_TYPES:
+            digest_cols[col] = type_name
+
+    return digest_cols
+
+
+def digest_expr(col, type_name) -> sql.Composable:
+    if type_name == "bytea":
+        return sql.SQL("md5({})").format(sql.Identifier(col))
+
+    return sql.SQL("md5({}::text)").format(sql.Identifier(col))
+
+
+def get_select_list(cols, digest_cols) -> sql.Composable:
+    """
+    The select list of the rows of a block: every column, with large columns
+    replaced by their md5 digests under the same names
+    """
+
+    if not digest_cols:
+        return sql.SQL("*")
+
+    items = []
+    for col in cols:
+        if col not in digest_cols:
+            items.append(sql.Identifier(col))
+        else:
+            items.append(
+                sql.SQL("{} AS {}").format(
+                    digest_expr(col, digest_cols[col]), sql.Identifier(col)
+                )
+            )
+
+    return sql.SQL(", ").join(items)
+
+
+def fetch_digested_cols(shared_objects, worker_state, host, needed):
+    """
+    Fetches the values of large columns from a node, with their current
+    digests.
+
+    Args:
+        needed: {primary key: indexes into cols_list of the columns to fetch}
+
+    Returns:
+        {primary key: {column index: (value, digest) as strings}} for the rows
+        that still exist, and the number of bytes fetched
+    """
+
+    if not needed:
+        return {}, 0
+
+    cols = shared_objects["cols_list"]
+    digest_cols = shared_objects["digest_cols"]
+    keys = shared_objects["p_key"].split(",")
+    fetch_idx = sorted(set().union(*needed.values()))
+
+    key_filter, params = diff_key_filter(
+        shared_objects, worker_state, keys, list(needed), nodes=[host]
+    )
+
+    items = [sql.Identifier(key) for key in keys]
+    for i in fetch_idx:
+        items.append(sql.Identifier(cols[i]))
+        items.append(digest_expr(cols[i], digest_cols[cols[i]]))
+
+    fetch_sql = sql.SQL("SELECT {items} FROM {table} WHERE {filter}").format(
+        items=sql.SQL(", ").join(items),
+        table=sql.SQL("{}.{}").format(
+            sql.Identifier(shared_objects["schema_name"]),
+            sql.Identifier(shared_objects["table_name"]),
+        ),
+        filter=key_filter,
+    )
+
+    values = {}
+    fetched_bytes = 0
+    for row in run_query(worker_state, host, fetch_sql, params):
+        row = [str(x) for x in row]
+        key = row[0] if len(keys) == 1 else tuple(row[: len(keys)])
+        fetched = row[len(keys) :]
+        values[key] = {
+            i: (fetched[2 * j], fetched[2 * j + 1]) for j, i in enumerate(fetch_idx)
+        }
+        fetched_bytes += sum(len(x) for x in row)
+
+    return values, fetched_bytes
+
+
+def fill_digested_cols(shared_objects, worker_state, host1, host2, diff1, diff2):
+    """
+    Replaces the digests in the rows that differ between two nodes with the
+    values of their large columns. Values are fetched only for these rows, and
+    from host2 only for the columns whose digests differ from the current ones
+    on host1.
+
+    Rows deleted since the block was read are dropped, as there is no value to
+    report for them.
+
+    Returns the filled rows of host1 and host2, and the number of bytes fetched.
+    """
+
+    cols = shared_objects["cols_list"]
+    keys = shared_objects["p_key"].split(",")
+    key_idx = [cols.index(key) for key in keys]
+    digest_idx = [cols.index(col) for col in shared_objects["digest_cols"]]
+
+    def pkey(row):
+        return row[key_idx[0]] if len(keys) == 1 else tuple(row[i] for i in key_idx)
+
+    rows1 = {pkey(row): list(row) for row in diff1}
+    rows2 = {pkey(row): list(row) for row in diff2}
+
+    needed1 = {key: digest_idx for key in rows1}
+    values1, bytes1 = fetch_digested_cols(shared_objects, worker_state, host1, needed1)
+
+    # A value of host1 is copied into host2's row only if its current digest on
+    # host1 is the one read from host2. Every row of host2 is still fetched, if
+    # only by its key, to find the rows deleted since.
+    def digest1(key, i):
+        return values1[key][i][1] if key in values1 else None
+
+    needed2 = {
+        key: [i for i in digest_idx if digest1(key, i) != row[i]]
+        for key, row in rows2.items()
+    }
+    values2, bytes2 = fetch_digested_cols(shared_objects, worker_state, host2, needed2)
+
+    filled1 = []
+    for key, row in rows1.items():
+        if key not in values1:
+            continue
+        for i, (value, _) in values1[key].items():
+            row[i] = value
+        filled1.append(tuple(row))
+
+    filled2 = []
+    for key, row in rows2.items():
+        if key not in values2:
+            continue
+        for i in digest_idx:
+            if i in values2[key]:
+                row[i] = values2[key][i][0]
+            else:
+                row[i] = values1[key][i][0]
+        filled2.append(tuple(row))
+
+    return filled1, filled2, bytes1 + bytes2
+
+
+def get_worker_count(task, total_blocks):
+    """
+    Returns the number of worker processes to use for a task. This is bounded by
+    the max_cpu_ratio of the task, the worker budget handed out by the API job
+    queue (if any), and the number of blocks to process.
+    """
+
+    cpus = cpu_count()
+    max_procs = int(cpus * task.max_cpu_ratio) if cpus > 1 else 1
+
+    if task.scheduler.worker_budget:
+        max_procs = min(max_procs, task.scheduler.worker_budget)
+
+    # With parallel hashing, every block query already keeps a leader and its
+    # parallel workers busy on each node
+    parallel_workers = getattr(task, "parallel_workers", 0)
+    if parallel_workers:
+        max_procs = max_procs // (parallel_workers + 1)
+
+    max_procs = max(max_procs, 1)
+
+    # If we don't have enough blocks to keep all CPUs busy, use fewer processes
+    return max_procs if total_blocks > max_procs else total_blocks
+
+
+def get_throttle(task, procs, throttle_state):
+    """
+    Splits the per-node rate targets of a low-impact diff between its worker
+    processes. Returns None if the task is not in low-impact mode.
+    """
+
+    if not task.low_impact:
+        return None
+
+    # Every node takes part in the comparisons of (nodes - 1) node pairs, and
+    # every worker compares blocks for all of them
+    shares = procs * max(len(task.fields.node_list) - 1, 1)
+    mb_per_sec = task.max_mb_per_sec
+
+    return {
+        "rows_per_sec": task.max_rows_per_sec / shares if task.max_rows_per_sec else 0,
+        "bytes_per_sec": mb_per_sec * 1024 * 1024 / shares if mb_per_sec else 0,
+        "state": throttle_state,
+    }
 
 
 def create_result_dict(
@@ -88,6 +464,7 @@ def create_result_dict(
     status_message,
     errors=False,
     error_messages=None,
+    stats=None,
 ):
     return {
         "node_pair": node_pair,
@@ -96,17 +473,121 @@ def create_result_dict(
         "status_message": status_message,
         "errors": errors,
         "error_messages": error_messages or [],
+        # Rows hashed and query latency per node, and bytes fetched, for the
+        # live progress of the task
+        "stats": stats,
     }
 
 
+def get_row_counts(td_task) -> list:
+    """
+    Returns the number of rows of the table on every node, in the order of
+    td_task.fields.conn_params. The counts only pick the node to read block
+    boundaries from and size the worker pool, so planner estimates are used
+    unless the task asks for exact counts. Exact counts scan the table, and run
+    concurrently on all nodes.
+    """
+
+    schema_name = td_task.fields.l_schema
+    table_name = td_task.fields.l_table
+
+    def count_rows(params):
+        with psycopg.connect(**params) as conn:
+            return ace.get_row_count(conn, schema_name, table_name)
+
+    row_counts = [None] * len(td_task.fields.conn_params)
+
+    if not td_task.exact_counts:
+        for i, params in enumerate(td_task.fields.conn_params):
+            conn = ace_connections.get_node_conn(params)
+            row_counts[i] = ace.get_row_estimate(conn, schema_name, table_name)
+
+    # Tables without statistics are counted as well
+    to_count = [i for i, rows in enumerate(row_counts) if rows is None]
+
+    if to_count:
+        with ThreadPoolExecutor(max_workers=len(to_count)) as executor:
+            counts = executor.map(
+                count_rows, [td_task.fields.conn_params[i] for i in to_count]
+            )
+            for i, rows in zip(to_count, counts):
+                row_counts[i] = rows
+
+    return row_counts
+
+
+def compare_block_columnar(
+    shared_objects, worker_state, host1, host2, select_list, where_clause, params
+):
+    """
+    Compares a mismatched block by the hashes of its rows, and fetches only
+    the rows that differ. Returns the rows found only on host1 and only on
+    host2, as tuples of strings, and the bytes fetched, or None if the block
+    has to be compared row by row.
+    """
+
+    keys = shared_objects["p_key"].split(",")
+    table = sql.SQL("{}.{}").format(
+        sql.Identifier(shared_objects["schema_name"]),
+        sql.Identifier(shared_objects["table_name"]),
+    )
+    hosts = (host1, host2)
+
+    copy_sql = ace_columnar.hashes_sql(select_list, table, where_clause, keys)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(
+                ace_columnar.fetch_hashes,
+                worker_state[host].connection,
+                copy_sql,
+                params,
+            )
+            for host in hosts
+        ]
+    (keys1, rows1, bytes1), (keys2, rows2, bytes2) = [f.result() for f in futures]
+
+    diff = ace_columnar.diff_hashes(keys1, rows1, keys2, rows2)
+
+    # Duplicate key hashes, or row hashes that collide: leave it to the rows
+    if diff is None or not (len(diff[0]) or len(diff[1])):
+        return None
+
+    rows_sql = ace_columnar.rows_sql(select_list, table, where_clause, keys)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(
+                run_query, worker_state, host, rows_sql, [*params, hashes.tolist()]
+            )
+            for host, hashes in zip(hosts, diff)
+            if len(hashes)
+        ]
+    results = iter([f.result() for f in futures])
+
+    diffs = [
+        [tuple(str(x) for x in row) for row in next(results)] if len(hashes) else []
+        for hashes in diff
+    ]
+    fetched_bytes = bytes1 + bytes2 + sum(
+        len(x) for rows in diffs for row in rows for x in row
+    )
+
+    return diffs[0], diffs[1], fetched_bytes
+
+
+def diff_limit_reached(row_diff_count) -> bool:
+    """True if a limit on the rows that differ is set, and has been reached"""
+
+    return 0 < config.MAX_DIFF_ROWS <= row_diff_count.value
+
+
 def compare_checksums(shared_objects, worker_state, batches):
 
     result_queue = shared_objects["result_queue"]
-    diff_dict = shared_objects["diff_dict"]
+    diff_store = shared_objects["diff_store"]
     row_diff_count = shared_objects["row_diff_count"]
     lock = shared_objects["lock"]
 
-    if row_diff_count.value >= config.MAX_DIFF_ROWS:
+    if diff_limit_reached(row_diff_count):
         return
 
     p_key = shared_objects["p_key"]
@@ -114,141 +595,96 @@ def compare_checksums(shared_objects, worker_state, batches):
     table_name = shared_objects["table_name"]
     node_list = shared_objects["node_list"]
     cols = shared_objects["cols_list"]
-    simple_primary_key = shared_objects["simple_primary_key"]
     mode = shared_objects["mode"]
+    cancel_event = shared_objects["cancel_event"]
+    digest_cols = shared_objects.get("digest_cols")
+    select_list = get_select_list(cols, digest_cols)
+    use_columnar = config.COLUMNAR_MIN_ROWS > 0 and ace_columnar.available()
 
-    for batch in batches:
-        where_clause = str()
-        where_clause_temp = list()
-
-        if mode == "diff":
-            pkey1, pkey2 = batch
-            if simple_primary_key:
-                if pkey1 is not None:
-                    where_clause_temp.append(
-                        sql.SQL("{p_key} >= {pkey1}").format(
-                            p_key=sql.Identifier(p_key), pkey1=sql.Literal(pkey1)
-                        )
-                    )
-                if pkey2 is not None:
-                    where_clause_temp.append(
-                        sql.SQL("{p_key} < {pkey2}").format(
-                            p_key=sql.Identifier(p_key), pkey2=sql.Literal(pkey2)
-                        )
-                    )
-            else:
-                """
-                This is a slightly more complicated case since we have to split up
-                the primary key and compare them with split values of pkey1 and pkey2
-                """
-
-                if pkey1 is not None:
-                    where_clause_temp.append(
-                        sql.SQL("({p_key}) >= ({pkey1})").format(
-                            p_key=sql.SQL(", ").join(
-                                [
-                                    sql.Identifier(col.strip())
-                                    for col in p_key.split(",")
-                                ]
-                            ),
-                            pkey1=sql.SQL(", ").join(
-                                [sql.Literal(val) for val in pkey1]
-                            ),
-                        )
-                    )
-
-                if pkey2 is not None:
-                    where_clause_temp.append(
-                        sql.SQL("({p_key}) < ({pkey2})").format(
-                            p_key=sql.SQL(", ").join(
-                                [
-                                    sql.Identifier(col.strip())
-                                    for col in p_key.split(",")
-                                ]
-                            ),
-                            pkey2=sql.SQL(", ").join(
-                                [sql.Literal(val) for val in pkey2]
-                            ),
-                        )
-                    )
+    table = sql.SQL("{}.{}").format(
+        sql.Identifier(schema_name), sql.Identifier(table_name)
+    )
 
-            where_clause = sql.SQL(" AND ").join(where_clause_temp)
+    # In diff mode, a batch is a range of block numbers
+    if mode == "diff":
+        block_offsets = shared_objects["block_offsets"]
+        batches = [block_offsets.block(i) for i in range(*batches)]
 
+    blocks = []
+    for batch in batches:
+        if mode == "diff":
+            where_clause, params = get_range_filter(p_key, *batch)
+        elif mode == "rerun" and shared_objects.get("read_only_nodes"):
+            where_clause, params = ace_keys.key_array_filter(
+                p_key.split(","), shared_objects["key_types"], batch
+            )
         elif mode == "rerun":
-            keys = p_key.split(",")
-            where_clause = sql.SQL(generate_where_clause(keys, batch))
-
+            where_clause, params = ace_keys.key_filter(p_key.split(",")), []
         else:
             raise Exception(f"Mode {mode} not recognized in compare_checksums")
 
-        if simple_primary_key:
-            hash_sql = sql.SQL(
-                "SELECT md5(cast(array_agg(t.* ORDER BY {p_key}) AS text)) FROM"
-                "(SELECT * FROM {table_name} WHERE {where_clause}) t"
-            ).format(
-                p_key=sql.Identifier(p_key),
-                table_name=sql.SQL("{}.{}").format(
-                    sql.Identifier(schema_name),
-                    sql.Identifier(table_name),
-                ),
-                where_clause=where_clause,
-            )
-        else:
-            hash_sql = sql.SQL(
-                "SELECT md5(cast(array_agg(t.* ORDER BY {p_key}) AS text)) FROM"
-                "(SELECT * FROM {table_name} WHERE {where_clause}) t"
-            ).format(
-                p_key=sql.SQL(", ").join(
-                    [sql.Identifier(col.strip()) for col in p_key.split(",")]
-                ),
-                table_name=sql.SQL("{}.{}").format(
-                    sql.Identifier(schema_name),
-                    sql.Identifier(table_name),
-                ),
-                where_clause=where_clause,
+        hash_sql = get_hash_sql(shared_objects, select_list, table, where_clause)
+        block_sql = sql.SQL(
+            "SELECT {select_list} FROM {table_name} WHERE {where_clause}"
+        ).format(select_list=select_list, table_name=table, where_clause=where_clause)
+
+        blocks.append((batch, where_clause, hash_sql, block_sql, params))
+
+    # In diff mode, the hashes of every block in the batch are sent to each
+    # node in one pipeline. In rerun mode, the key table is reloaded for each
+    # batch, and its hash query can only follow the load.
+    if mode == "diff":
+        queries = [(hash_sql, params) for _, _, hash_sql, _, params in blocks]
+        hashes, errors = hash_blocks(worker_state, node_list, queries)
+
+        if errors and cancel_event.is_set():
+            return config.TASK_CANCELLED
+
+        if errors:
+            result_dict = create_result_dict(
+                tuple(node_list),
+                batches[0],
+                config.BLOCK_ERROR,
+                "BLOCK_ERROR",
+                errors=True,
+                error_messages=[str(error) for error in errors],
             )
+            result_queue.append(result_dict)
+            return config.BLOCK_ERROR
 
-        block_sql = sql.SQL("SELECT * FROM {table_name} WHERE {where_clause}").format(
-            table_name=sql.SQL("{}.{}").format(
-                sql.Identifier(schema_name),
-                sql.Identifier(table_name),
-            ),
-            where_clause=where_clause,
-        )
+    for i, (batch, where_clause, hash_sql, block_sql, params) in enumerate(blocks):
+        # Index of the block's hash among the hashes fetched
+        slot = i
 
-        for node_pair in combinations(node_list, 2):
-            host1 = node_pair[0]
-            host2 = node_pair[1]
+        if mode == "rerun":
+            keys = p_key.split(",")
+            try:
+                # Read-only nodes take the keys as arrays in the queries
+                if not shared_objects.get("read_only_nodes"):
+                    load_diff_keys(shared_objects, worker_state, keys, batch)
+            except Exception as e:
+                if cancel_event.is_set():
+                    return config.TASK_CANCELLED
 
-            # Return early if we have already exceeded the max number of diffs
-            if row_diff_count.value >= config.MAX_DIFF_ROWS:
                 result_dict = create_result_dict(
-                    node_pair,
+                    tuple(node_list),
                     batch,
-                    config.MAX_DIFFS_EXCEEDED,
-                    "MAX_DIFFS_EXCEEDED",
+                    config.BLOCK_ERROR,
+                    "BLOCK_ERROR",
                     errors=True,
-                    error_messages=[
-                        f"Diffs have exceeded the maximum allowed number of diffs:"
-                        f"{config.MAX_DIFF_ROWS}"
-                    ],
+                    error_messages=[f"Could not load diff keys: {str(e)}"],
                 )
                 result_queue.append(result_dict)
-                return config.MAX_DIFFS_EXCEEDED
+                return config.BLOCK_ERROR
 
-            # Run the checksum query on both nodes in parallel
-            with ThreadPoolExecutor(max_workers=2) as executor:
-                futures = [
-                    executor.submit(run_query, worker_state, host1, hash_sql),
-                    executor.submit(run_query, worker_state, host2, hash_sql),
-                ]
-                results = [f.result() for f in futures if not f.exception()]
+            hashes, errors = hash_blocks(worker_state, node_list, [(hash_sql, params)])
 
-            errors = [f.exception() for f in futures if f.exception()]
+            if errors and cancel_event.is_set():
+                return config.TASK_CANCELLED
 
             if errors:
                 result_dict = create_result_dict(
-                    node_pair,
+                    tuple(node_list),
                     batch,
                     config.BLOCK_ERROR,
                     "BLOCK_ERROR",
@@ -258,73 +694,158 @@ def compare_checksums(shared_objects, worker_state, batches):
                 result_queue.append(result_dict)
                 return config.BLOCK_ERROR
 
-            hash1, hash2 = results[0][0][0], results[1][0][0]
+            slot = 0
 
-            if hash1 != hash2:
-                # Run the block query on both nodes in parallel
-                with ThreadPoolExecutor(max_workers=2) as executor:
-                    futures = [
-                        executor.submit(run_query, worker_state, host1, block_sql),
-                        executor.submit(run_query, worker_state, host2, block_sql),
-                    ]
-                    results = [f.result() for f in futures if not f.exception()]
+        for node_pair in combinations(node_list, 2):
+            host1 = node_pair[0]
+            host2 = node_pair[1]
 
-                errors = [f.exception() for f in futures if f.exception()]
+            if cancel_event.is_set():
+                return config.TASK_CANCELLED
 
-                if errors:
-                    result_dict = create_result_dict(
-                        node_pair,
-                        batch,
-                        config.BLOCK_ERROR,
-                        "BLOCK_ERROR",
-                        errors=True,
-                        error_messages=[str(error) for error in errors],
+            # Return early if we have already exceeded the max number of diffs
+            if diff_limit_reached(row_diff_count):
+                result_dict = create_result_dict(
+                    node_pair,
+                    batch,
+                    config.MAX_DIFFS_EXCEEDED,
+                    "MAX_DIFFS_EXCEEDED",
+                    errors=True,
+                    error_messages=[
+                        f"Diffs have exceeded the maximum allowed number of diffs:"
+                        f"{config.MAX_DIFF_ROWS}"
+                    ],
+                )
+                result_queue.append(result_dict)
+                return config.MAX_DIFFS_EXCEEDED
+
+            (hash1, rows1), latency1 = hashes[host1][slot]
+            (hash2, rows2), latency2 = hashes[host2][slot]
+            stats = {
+                "rows": {host1: rows1, host2: rows2},
+                "latency": {host1: latency1, host2: latency2},
+                # md5 digest and row count from each node
+                "bytes": 2 * (32 + 8),
+            }
+
+            if hash1 != hash2:
+                columnar = None
+                if use_columnar and max(rows1, rows2) >= config.COLUMNAR_MIN_ROWS:
+                    try:
+                        columnar = compare_block_columnar(
+                            shared_objects,
+                            worker_state,
+                            host1,
+                            host2,
+                            select_list,
+                            where_clause,
+                            params,
+                        )
+                    except Exception as e:
+                        if cancel_event.is_set():
+                            return config.TASK_CANCELLED
+
+                        result_dict = create_result_dict(
+                            node_pair,
+                            batch,
+                            config.BLOCK_ERROR,
+                            "BLOCK_ERROR",
+                            errors=True,
+                            error_messages=[str(e)],
+                        )
+                        result_queue.append(result_dict)
+                        return config.BLOCK_ERROR
+
+                if columnar:
+                    t1_diff, t2_diff, fetched_bytes = columnar
+                    stats["bytes"] += fetched_bytes
+                else:
+                    # Run the block query on both nodes in parallel
+                    with ThreadPoolExecutor(max_workers=2) as executor:
+                        futures = [
+                            executor.submit(
+                                run_query, worker_state, host1, block_sql, params
+                            ),
+                            executor.submit(
+                                run_query, worker_state, host2, block_sql, params
+                            ),
+                        ]
+                        results = [f.result() for f in futures if not f.exception()]
+
+                    errors = [f.exception() for f in futures if f.exception()]
+
+                    if errors and cancel_event.is_set():
+                        return config.TASK_CANCELLED
+
+                    if errors:
+                        result_dict = create_result_dict(
+                            node_pair,
+                            batch,
+                            config.BLOCK_ERROR,
+                            "BLOCK_ERROR",
+                            errors=True,
+                            error_messages=[str(error) for error in errors],
+                        )
+                        result_queue.append(result_dict)
+                        return config.BLOCK_ERROR
+
+                    t1_result, t2_result = results
+
+                    # Transform all elements in t1_result and t2_result into strings
+                    # before consolidating them into a set
+                    # TODO: Test and add support for different datatypes here
+                    t1_result = [tuple(str(x) for x in row) for row in t1_result]
+                    t2_result = [tuple(str(x) for x in row) for row in t2_result]
+                    stats["bytes"] += sum(
+                        len(x) for row in t1_result + t2_result for x in row
                     )
-                    result_queue.append(result_dict)
-                    return config.BLOCK_ERROR
 
-                t1_result, t2_result = results
+                    # Collect results into OrderedSets for comparison
+                    t1_set = OrderedSet(t1_result)
+                    t2_set = OrderedSet(t2_result)
 
-                # Transform all elements in t1_result and t2_result into strings before
-                # consolidating them into a set
-                # TODO: Test and add support for different datatypes here
-                t1_result = [tuple(str(x) for x in row) for row in t1_result]
-                t2_result = [tuple(str(x) for x in row) for row in t2_result]
+                    t1_diff = t1_set - t2_set
+                    t2_diff = t2_set - t1_set
 
-                # Collect results into OrderedSets for comparison
-                t1_set = OrderedSet(t1_result)
-                t2_set = OrderedSet(t2_result)
+                if digest_cols and (t1_diff or t2_diff):
+                    try:
+                        t1_diff, t2_diff, fetched_bytes = fill_digested_cols(
+                            shared_objects, worker_state, host1, host2, t1_diff, t2_diff
+                        )
+                    except Exception as e:
+                        if cancel_event.is_set():
+                            return config.TASK_CANCELLED
+
+                        result_dict = create_result_dict(
+                            node_pair,
+                            batch,
+                            config.BLOCK_ERROR,
+                            "BLOCK_ERROR",
+                            errors=True,
+                            error_messages=[str(e)],
+                        )
+                        result_queue.append(result_dict)
+                        return config.BLOCK_ERROR
 
-                t1_diff = t1_set - t2_set
-                t2_diff = t2_set - t1_set
+                    stats["bytes"] += fetched_bytes
 
                 node_pair_key = f"{host1}/{host2}"
 
-                if node_pair_key not in diff_dict:
-                    diff_dict[node_pair_key] = {}
-
                 with lock:
-                    # Update diff_dict with the results of the diff
+                    # Spill the rows that differ to the diff store of the task
                     if len(t1_diff) > 0 or len(t2_diff) > 0:
-                        temp_dict = {}
-                        if host1 in diff_dict[node_pair_key]:
-                            temp_dict[host1] = diff_dict[node_pair_key][host1]
-                        else:
-                            temp_dict[host1] = []
-                        if host2 in diff_dict[node_pair_key]:
-                            temp_dict[host2] = diff_dict[node_pair_key][host2]
-                        else:
-                            temp_dict[host2] = []
-
-                        temp_dict[host1] += [dict(zip(cols, row)) for row in t1_diff]
-                        temp_dict[host2] += [dict(zip(cols, row)) for row in t2_diff]
-
-                        diff_dict[node_pair_key] = temp_dict
+                        diff_store.add(
+                            node_pair_key,
+                            host1,
+                            [dict(zip(cols, row)) for row in t1_diff],
+                            host2,
+                            [dict(zip(cols, row)) for row in t2_diff],
+                        )
 
                     # Update row_diff_count with the number of diffs
                     row_diff_count.value += max(len(t1_diff), len(t2_diff))
 
-                if row_diff_count.value >= config.MAX_DIFF_ROWS:
+                if diff_limit_reached(row_diff_count):
                     result_dict = create_result_dict(
                         node_pair,
                         batch,
@@ -335,27 +856,90 @@ def compare_checksums(shared_objects, worker_state, batches):
                             f"Diffs have exceeded the maximum allowed number of diffs:"
                             f"{config.MAX_DIFF_ROWS}"
                         ],
+                        stats=stats,
                     )
                     result_queue.append(result_dict)
                     return config.MAX_DIFFS_EXCEEDED
                 else:
                     result_dict = create_result_dict(
-                        node_pair, batch, config.BLOCK_MISMATCH, "BLOCK_MISMATCH"
+                        node_pair,
+                        batch,
+                        config.BLOCK_MISMATCH,
+                        "BLOCK_MISMATCH",
+                        stats=stats,
                     )
                     result_queue.append(result_dict)
             else:
                 result_dict = create_result_dict(
-                    node_pair, batch, config.BLOCK_OK, "BLOCK_OK"
+                    node_pair, batch, config.BLOCK_OK, "BLOCK_OK", stats=stats
                 )
                 result_queue.append(result_dict)
 
+            if "rate_limiter" in worker_state:
+                # Rows and bytes read from each of the two nodes
+                worker_state["rate_limiter"].pace(
+                    max(stats["rows"].values()), stats["bytes"] / 2
+                )
 
-def table_diff(td_task: TableDiffTask):
-    """Efficiently compare tables across cluster using checksums and blocks of rows"""
 
-    global result_queue, diff_dict, row_diff_count
+def finish_cancelled_diff(
+    td_task, canceller, progress, diff_store, table_types, context
+):
+    """
+    Records a cancelled table-diff or table-rerun, along with the diffs that
+    were found in the blocks compared before it was cancelled
+    """
 
-    simple_primary_key = True
+    snapshot = progress.snapshot()
+    context["blocks_done"] = snapshot["blocks_done"]
+    context["blocks_total"] = snapshot["blocks_total"]
+    context.setdefault("errors", [])
+
+    if diff_store:
+        context["mismatch"] = True
+        try:
+            if td_task.output == "json":
+                td_task.diff_file_path = ace.write_diffs_json(
+                    diff_store,
+                    table_types,
+                    quiet_mode=td_task.quiet_mode,
+                    key=td_task.fields.key,
+                )
+            else:
+                ace.write_diffs_csv(
+                    diff_store, quiet_mode=td_task.quiet_mode, output=td_task.output
+                )
+            context["diff_file_path"] = td_task.diff_file_path
+        except Exception as e:
+            context["errors"].append(f"Could not write partial diffs: {str(e)}")
+
+    ace.handle_task_cancellation(td_task, canceller.reason, context)
+    return td_task
+
+
+def table_diff(td_task: TableDiffTask):
+    """Efficiently compare tables across cluster using checksums and blocks of rows"""
+
+    if td_task.fingerprint:
+        return table_fingerprint(td_task)
+
+    if table_row_hash_check(td_task):
+        return td_task
+
+    # The rows that differ spill to disk until they are written out
+    diff_store = DiffStore.create(td_task.fields.key.split(","))
+    try:
+        return table_diff_blocks(td_task, diff_store)
+    finally:
+        diff_store.remove()
+
+
+def table_diff_blocks(td_task: TableDiffTask, diff_store: DiffStore):
+    """Compares a table block by block, collecting the rows that differ"""
+
+    global result_queue, row_diff_count
+
+    simple_primary_key = True
     if len(td_task.fields.key.split(",")) > 1:
         simple_primary_key = False
 
@@ -365,93 +949,56 @@ def table_diff(td_task: TableDiffTask):
     table_types = None
 
     try:
-        for params in td_task.fields.conn_params:
-            conn = psycopg.connect(**params)
-            if not table_types:
-                table_types = ace.get_row_types(conn, td_task.fields.l_table)
+        conn = ace_connections.get_node_conn(td_task.fields.conn_params[0])
+        table_types = ace.get_row_types(
+            conn, td_task.fields.l_schema, td_task.fields.l_table
+        )
 
-            rows = ace.get_row_count(
-                conn, td_task.fields.l_schema, td_task.fields.l_table
+        row_counts = get_row_counts(td_task)
+        total_rows = sum(row_counts)
+        row_count = max(row_counts)
+
+        if row_count > 0:
+            conn_with_max_rows = ace_connections.get_node_conn(
+                td_task.fields.conn_params[row_counts.index(row_count)]
             )
-            total_rows += rows
-            if rows > row_count:
-                row_count = rows
-                conn_with_max_rows = conn
     except Exception as e:
         context = {"total_rows": total_rows, "mismatch": False, "errors": [str(e)]}
         ace.handle_task_exception(td_task, context)
         raise e
 
-    pkey_offsets = []
-
     if not conn_with_max_rows:
         util.message(
             "ALL TABLES ARE EMPTY",
             p_state="warning",
             quiet_mode=td_task.quiet_mode,
         )
-        return
 
-    # Use conn_with_max_rows to get the first and last primary key values
-    # of every block row. Repeat until we no longer have any more rows.
-    # Store results in pkey_offsets.
-
-    if simple_primary_key:
-        pkey_sql = sql.SQL("SELECT {key} FROM {table_name} ORDER BY {key}").format(
-            key=sql.Identifier(td_task.fields.key),
-            table_name=sql.SQL("{}.{}").format(
-                sql.Identifier(td_task.fields.l_schema),
-                sql.Identifier(td_task.fields.l_table),
-            ),
-        )
-    else:
-        pkey_sql = sql.SQL("SELECT {key} FROM {table_name} ORDER BY {key}").format(
-            key=sql.SQL(", ").join(
-                [sql.Identifier(col) for col in td_task.fields.key.split(",")]
-            ),
-            table_name=sql.SQL("{}.{}").format(
-                sql.Identifier(td_task.fields.l_schema),
-                sql.Identifier(td_task.fields.l_table),
-            ),
-        )
-
-    def get_pkey_offsets(conn, pkey_sql, block_rows):
-        pkey_offsets = []
-        cur = conn.cursor()
-        cur.execute(pkey_sql)
-        rows = cur.fetchmany(block_rows)
-
-        if simple_primary_key:
-            rows[:] = [str(x[0]) for x in rows]
-            pkey_offsets.append((None, str(rows[0])))
-            prev_min_offset = str(rows[0])
-            prev_max_offset = str(rows[-1])
-        else:
-            rows[:] = [tuple(str(i) for i in x) for x in rows]
-            pkey_offsets.append((None, rows[0]))
-            prev_min_offset = rows[0]
-            prev_max_offset = rows[-1]
-
-        while rows:
-            rows = cur.fetchmany(block_rows)
-            if simple_primary_key:
-                rows[:] = [str(x[0]) for x in rows]
-            else:
-                rows[:] = [tuple(str(i) for i in x) for x in rows]
+        td_task.scheduler.task_status = "COMPLETED"
+        td_task.scheduler.finished_at = datetime.now()
+        td_task.scheduler.time_taken = util.round_timedelta(
+            td_task.scheduler.finished_at - td_task.scheduler.started_at
+        ).total_seconds()
+        td_task.scheduler.task_context = {
+            "total_rows": 0,
+            "mismatch": False,
+            "diff_rows": 0,
+            "errors": [],
+        }
 
-            if not rows:
-                if prev_max_offset != prev_min_offset:
-                    pkey_offsets.append((prev_min_offset, prev_max_offset))
-                pkey_offsets.append((prev_max_offset, None))
-                break
+        if not td_task.skip_db_update:
+            ace_db.update_ace_task(td_task)
 
-            curr_min_offset = rows[0]
-            pkey_offsets.append((prev_min_offset, curr_min_offset))
-            prev_min_offset = curr_min_offset
-            prev_max_offset = rows[-1]
+        return td_task
 
-        cur.close()
-        return pkey_offsets
+    # From here on, the task can be cancelled, or stopped by its deadline
+    cancel_event = Manager().Event()
+    backend_pids = Manager().list()
+    canceller = TaskCanceller(
+        td_task, cancel_event, backend_pids, td_task.fields.conn_params
+    )
+    canceller.register_conn(conn_with_max_rows)
+    canceller.start()
 
     util.message(
         "Getting primary key offsets for table...",
@@ -459,11 +1006,25 @@ def table_diff(td_task: TableDiffTask):
         quiet_mode=td_task.quiet_mode,
     )
 
-    future = ThreadPoolExecutor().submit(
-        get_pkey_offsets, conn_with_max_rows, pkey_sql, td_task.block_rows
-    )
-    pkey_offsets = future.result() if not future.exception() else []
+    if not canceller.cancelled:
+        future = ThreadPoolExecutor().submit(
+            ace_offsets.get_block_offsets,
+            conn_with_max_rows,
+            td_task.fields.l_schema,
+            td_task.fields.l_table,
+            td_task.fields.key.split(","),
+            td_task.block_rows,
+        )
+        block_offsets = future.result() if not future.exception() else None
+
+    if canceller.cancelled:
+        canceller.stop()
+        context = {"total_rows": total_rows, "mismatch": False, "errors": []}
+        ace.handle_task_cancellation(td_task, canceller.reason, context)
+        return td_task
+
     if future.exception():
+        canceller.stop()
         context = {
             "total_rows": total_rows,
             "mismatch": False,
@@ -472,13 +1033,9 @@ def table_diff(td_task: TableDiffTask):
         ace.handle_task_exception(td_task, context)
         raise future.exception()
 
-    total_blocks = row_count // td_task.block_rows
-    total_blocks = total_blocks if total_blocks > 0 else 1
-    cpus = cpu_count()
-    max_procs = int(cpus * td_task.max_cpu_ratio) if cpus > 1 else 1
-
-    # If we don't have enough blocks to keep all CPUs busy, use fewer processes
-    procs = max_procs if total_blocks > max_procs else total_blocks
+    # The block boundaries are exact even where the row counts were estimates
+    total_blocks = block_offsets.blocks
+    procs = get_worker_count(td_task, total_blocks)
 
     start_time = datetime.now()
 
@@ -491,16 +1048,22 @@ def table_diff(td_task: TableDiffTask):
     cols_list = td_task.fields.cols.split(",")
     cols_list = [col for col in cols_list if not col.startswith("_Spock_")]
 
+    key = td_task.fields.key.split(",")
+    digest_cols = {}
+    if td_task.digest_large_cols:
+        digest_cols = get_digest_cols(cols_list, key, table_types)
+
     # Shared multiprocessing data structures
     result_queue = Manager().list()
-    diff_dict = Manager().dict()
     row_diff_count = Manager().Value("I", 0)
     lock = Manager().Lock()
+    throttle_state = Manager().dict({"factor": 1.0, "paused": False})
 
     # Shared variables needed by all workers
     shared_objects = {
         "cluster_name": td_task.cluster_name,
         "database": td_task.fields.database,
+        "cluster_nodes": td_task.fields.cluster_nodes,
         "node_list": td_task.fields.node_list,
         "schema_name": td_task.fields.l_schema,
         "table_name": td_task.fields.l_table,
@@ -509,10 +1072,18 @@ def table_diff(td_task: TableDiffTask):
         "block_rows": td_task.block_rows,
         "simple_primary_key": simple_primary_key,
         "mode": "diff",
+        "block_offsets": block_offsets,
         "result_queue": result_queue,
-        "diff_dict": diff_dict,
+        "diff_store": diff_store,
         "row_diff_count": row_diff_count,
         "lock": lock,
+        "cancel_event": cancel_event,
+        "backend_pids": backend_pids,
+        "throttle": get_throttle(td_task, procs, throttle_state),
+        "parallel_workers": td_task.parallel_workers,
+        "digest_cols": digest_cols,
+        "key_types": {col: table_types[col] for col in key},
+        "read_only_nodes": td_task.fields.read_only_nodes,
     }
 
     util.message(
@@ -521,18 +1092,27 @@ def table_diff(td_task: TableDiffTask):
         quiet_mode=td_task.quiet_mode,
     )
 
-    batches = [
-        pkey_offsets[i : i + td_task.batch_size]
-        for i in range(0, len(pkey_offsets), td_task.batch_size)
-    ]
+    batches = block_offsets.batches(td_task.batch_size)
 
     mismatch = False
     diffs_exceeded = False
     errors = False
     error_list = []
 
+    progress = TaskProgress(
+        td_task,
+        blocks_total=block_offsets.blocks,
+        node_pairs=len(list(combinations(td_task.fields.node_list, 2))),
+    )
+
+    health_monitor = nullcontext()
+    if td_task.low_impact:
+        health_monitor = NodeHealthMonitor(
+            td_task, throttle_state, backend_pids, td_task.fields.conn_params, progress
+        )
+
     try:
-        with WorkerPool(
+        with health_monitor, WorkerPool(
             n_jobs=procs,
             shared_objects=shared_objects,
             use_worker_state=True,
@@ -545,7 +1125,12 @@ def table_diff(td_task: TableDiffTask):
                 iterable_len=len(batches),
                 progress_bar_style="rich",
             ):
-                if result == config.MAX_DIFFS_EXCEEDED:
+                progress.consume(result_queue)
+                progress.publish()
+
+                if result == config.TASK_CANCELLED or canceller.cancelled:
+                    break
+                elif result == config.MAX_DIFFS_EXCEEDED:
                     diffs_exceeded = True
                     mismatch = True
                     break
@@ -553,6 +1138,9 @@ def table_diff(td_task: TableDiffTask):
                     errors = True
                     break
 
+            progress.consume(result_queue)
+            progress.publish(force=True)
+
             if diffs_exceeded:
                 util.message(
                     "Prematurely terminated jobs since diffs have"
@@ -561,10 +1149,27 @@ def table_diff(td_task: TableDiffTask):
                     quiet_mode=td_task.quiet_mode,
                 )
     except Exception as e:
+        canceller.stop()
         context = {"total_rows": total_rows, "mismatch": mismatch, "errors": [str(e)]}
         ace.handle_task_exception(td_task, context)
         raise e
 
+    canceller.stop()
+
+    # The row counts taken before the diff may have been estimates. Report the
+    # rows that were actually hashed; every node is part of (nodes - 1) pairs.
+    pairs_per_node = max(len(td_task.fields.node_list) - 1, 1)
+    total_rows = sum(progress.node_rows.values()) // pairs_per_node
+
+    # A cancel request that arrives after the last block has been compared
+    # does not make the results partial
+    blocks_done = progress.snapshot()["blocks_done"]
+    if canceller.cancelled and blocks_done < progress.blocks_total:
+        context = {"total_rows": total_rows, "mismatch": mismatch}
+        return finish_cancelled_diff(
+            td_task, canceller, progress, diff_store, table_types, context
+        )
+
     for result in result_queue:
         if result["status_code"] == config.BLOCK_MISMATCH:
             mismatch = True
@@ -602,64 +1207,496 @@ def table_diff(td_task: TableDiffTask):
             )
 
         """
-        Read the result queue and count differences between each node pair
-        in the cluster
+        Read the result queue and count differences between each node pair
+        in the cluster
+        """
+
+        for node_pair, node_rows in diff_store.counts().items():
+            node1, node2 = node_pair.split("/")
+            diff_count = max(node_rows.values())
+            util.message(
+                f"FOUND {diff_count} DIFFS BETWEEN {node1} AND {node2}",
+                p_state="warning",
+                quiet_mode=td_task.quiet_mode,
+            )
+
+        try:
+            if td_task.output == "json":
+                td_task.diff_file_path = ace.write_diffs_json(
+                    diff_store,
+                    table_types,
+                    quiet_mode=td_task.quiet_mode,
+                    key=td_task.fields.key,
+                )
+            else:
+                ace.write_diffs_csv(
+                    diff_store, quiet_mode=td_task.quiet_mode, output=td_task.output
+                )
+        except Exception as e:
+            context = {
+                "total_rows": total_rows,
+                "mismatch": mismatch,
+                "errors": [str(e)],
+            }
+            ace.handle_task_exception(td_task, context)
+            raise e
+
+    else:
+        util.message(
+            "TABLES MATCH OK\n", p_state="success", quiet_mode=td_task.quiet_mode
+        )
+
+    run_time = util.round_timedelta(datetime.now() - start_time).total_seconds()
+    run_time_str = f"{run_time:.2f}"
+
+    util.message(
+        f"TOTAL ROWS CHECKED = {total_rows}\nRUN TIME = {run_time_str} seconds",
+        p_state="info",
+        quiet_mode=td_task.quiet_mode,
+    )
+
+    td_task.scheduler.task_status = "COMPLETED"
+    td_task.scheduler.finished_at = datetime.now()
+    td_task.scheduler.time_taken = run_time
+    td_task.scheduler.task_context = {
+        "total_rows": total_rows,
+        "mismatch": mismatch,
+        "diff_rows": row_diff_count.value,
+        "errors": [],
+    }
+
+    if not td_task.skip_db_update:
+        ace_db.update_ace_task(td_task)
+
+    return td_task
+
+
+def table_fingerprint(td_task: TableDiffTask) -> TableDiffTask:
+    """
+    Compares one order-independent hash of the whole table across nodes. Says
+    whether the tables match, but not which rows differ.
+    """
+
+    table = f"{td_task.fields.l_schema}.{td_task.fields.l_table}"
+    node_params = ace_fingerprint.get_node_params(
+        td_task.cluster_name,
+        td_task.fields.database,
+        td_task.fields.node_list,
+        td_task.fields.cluster_nodes,
+    )
+
+    start_time = datetime.now()
+    cancel_event = threading.Event()
+    backend_pids = []
+    canceller = TaskCanceller(
+        td_task, cancel_event, backend_pids, list(node_params.values())
+    )
+    progress = TaskProgress(td_task, blocks_total=0, phase="fingerprint")
+
+    try:
+        with canceller:
+            fingerprints = ace_fingerprint.fingerprint_tables(
+                td_task, [table], node_params, cancel_event, backend_pids, progress
+            )[table]
+    except Exception as e:
+        context = {"total_rows": 0, "mismatch": False, "errors": [str(e)]}
+        ace.handle_task_exception(td_task, context)
+        raise e
+
+    if canceller.cancelled:
+        context = {"total_rows": progress.rows_checked, "mismatch": False}
+        ace.handle_task_cancellation(td_task, canceller.reason, context)
+        return td_task
+
+    errors = [
+        f"{node}: {fp['error']}" for node, fp in fingerprints.items() if "error" in fp
+    ]
+    total_rows = sum(fp.get("rows", 0) for fp in fingerprints.values())
+
+    if errors:
+        context = {"total_rows": total_rows, "mismatch": False, "errors": errors}
+        ace.handle_task_exception(td_task, context)
+        raise AceException(f"Could not fingerprint {table}: {errors}")
+
+    mismatch = not ace_fingerprint.fingerprints_match(fingerprints)
+
+    for node, fp in fingerprints.items():
+        util.message(
+            f"{node}: {fp['rows']} rows, fingerprint {fp['fingerprint']}",
+            p_state="info",
+            quiet_mode=td_task.quiet_mode,
+        )
+
+    if mismatch:
+        util.message(
+            "TABLES DO NOT MATCH. Run table-diff without --fingerprint to find"
+            " the rows that differ",
+            p_state="warning",
+            quiet_mode=td_task.quiet_mode,
+        )
+    else:
+        util.message(
+            "TABLES MATCH OK\n", p_state="success", quiet_mode=td_task.quiet_mode
+        )
+
+    run_time = util.round_timedelta(datetime.now() - start_time).total_seconds()
+    util.message(
+        f"TOTAL ROWS CHECKED = {total_rows}\nRUN TIME = {run_time:.2f} seconds",
+        p_state="info",
+        quiet_mode=td_task.quiet_mode,
+    )
+
+    td_task.scheduler.task_status = "COMPLETED"
+    td_task.scheduler.finished_at = datetime.now()
+    td_task.scheduler.time_taken = run_time
+    td_task.scheduler.task_context = {
+        "total_rows": total_rows,
+        "mismatch": mismatch,
+        "fingerprints": fingerprints,
+        "errors": [],
+    }
+
+    if not td_task.skip_db_update:
+        ace_db.update_ace_task(td_task)
+
+    return td_task
+
+
+def table_row_hash_check(td_task: TableDiffTask) -> bool:
+    """
+    Compares the row-hash block summaries of a table across nodes, if it has a
+    row-hash index on every node. Completes the task and returns True if they
+    all match, and returns False if the table needs to be diffed block by block.
+    """
+
+    # Most nodes have no row-hash index at all
+    if not set(td_task.fields.node_list) <= set(td_task.fields.row_hash_nodes):
+        return False
+
+    table = f"{td_task.fields.l_schema}.{td_task.fields.l_table}"
+    node_params = ace_fingerprint.get_node_params(
+        td_task.cluster_name,
+        td_task.fields.database,
+        td_task.fields.node_list,
+        td_task.fields.cluster_nodes,
+    )
+
+    start_time = datetime.now()
+    summaries = {}
+    block_counts = set()
+
+    try:
+        for node, params in node_params.items():
+            conn = ace_connections.get_node_conn(params)
+            try:
+                blocks = ace_row_hash.installed(conn, table)
+                if blocks is None:
+                    return False
+
+                block_counts.add(blocks)
+                summaries[node] = ace_row_hash.get_summaries(conn, table)
+            finally:
+                if not ace_connections.persistent:
+                    conn.close()
+    except Exception as e:
+        util.message(
+            f"Could not read row-hash summaries of {table}: {str(e)}",
+            p_state="warning",
+            quiet_mode=td_task.quiet_mode,
+        )
+        return False
+
+    if len(block_counts) > 1:
+        util.message(
+            f"Row-hash indexes of {table} differ in block count across nodes",
+            p_state="warning",
+            quiet_mode=td_task.quiet_mode,
+        )
+        return False
+
+    block_ids = set().union(*summaries.values())
+    mismatched = [
+        block
+        for block in block_ids
+        if len({summary.get(block) for summary in summaries.values()}) > 1
+    ]
+    total_rows = sum(
+        count for summary in summaries.values() for count, _ in summary.values()
+    )
+
+    if mismatched:
+        util.message(
+            f"{len(mismatched)} OF {len(block_ids)} ROW-HASH BLOCKS DIFFER. "
+            "DIFFING THE TABLE BLOCK BY BLOCK",
+            p_state="warning",
+            quiet_mode=td_task.quiet_mode,
+        )
+        return False
+
+    run_time = util.round_timedelta(datetime.now() - start_time).total_seconds()
+    util.message(
+        f"ALL {len(block_ids)} ROW-HASH BLOCKS MATCH",
+        p_state="info",
+        quiet_mode=td_task.quiet_mode,
+    )
+    util.message("TABLES MATCH OK\n", p_state="success", quiet_mode=td_task.quiet_mode)
+    util.message(
+        f"TOTAL ROWS CHECKED = {total_rows}\nRUN TIME = {run_time:.2f} seconds",
+        p_state="info",
+        quiet_mode=td_task.quiet_mode,
+    )
+
+    td_task.scheduler.task_status = "COMPLETED"
+    td_task.scheduler.finished_at = datetime.now()
+    td_task.scheduler.time_taken = run_time
+    td_task.scheduler.task_context = {
+        "total_rows": total_rows,
+        "mismatch": False,
+        "row_hash_blocks": len(block_ids),
+        "diff_rows": 0,
+        "errors": [],
+    }
+
+    if not td_task.skip_db_update:
+        ace_db.update_ace_task(td_task)
+
+    return True
+
+
+def row_hash_install(td_task: TableDiffTask, blocks: int) -> None:
+    """Installs and backfills the row-hash index of a table on every node"""
+
+    table = f"{td_task.fields.l_schema}.{td_task.fields.l_table}"
+    node_params = ace_fingerprint.get_node_params(
+        td_task.cluster_name,
+        td_task.fields.database,
+        td_task.fields.node_list,
+        td_task.fields.cluster_nodes,
+    )
+
+    for node, params in node_params.items():
+        conn = ace_connections.get_node_conn(params)
+        try:
+            rows = ace_row_hash.install(
+                conn,
+                td_task.fields.l_schema,
+                td_task.fields.l_table,
+                td_task.fields.key.split(","),
+                blocks,
+            )
+        except Exception as e:
+            raise AceException(f"Could not install row-hash index on {node}: {e}")
+        finally:
+            if not ace_connections.persistent:
+                conn.close()
+
+        util.message(
+            f"Installed row-hash index of {table} on {node}: {rows} rows in "
+            f"{blocks} blocks",
+            p_state="success",
+            quiet_mode=td_task.quiet_mode,
+        )
+
+
+def row_hash_remove(td_task: TableDiffTask) -> None:
+    """Removes the row-hash index of a table from every node"""
+
+    table = f"{td_task.fields.l_schema}.{td_task.fields.l_table}"
+    node_params = ace_fingerprint.get_node_params(
+        td_task.cluster_name,
+        td_task.fields.database,
+        td_task.fields.node_list,
+        td_task.fields.cluster_nodes,
+    )
+
+    for node, params in node_params.items():
+        conn = ace_connections.get_node_conn(params)
+        try:
+            removed = ace_row_hash.remove(
+                conn, td_task.fields.l_schema, td_task.fields.l_table
+            )
+        except Exception as e:
+            raise AceException(f"Could not remove row-hash index on {node}: {e}")
+        finally:
+            if not ace_connections.persistent:
+                conn.close()
+
+        if removed:
+            util.message(
+                f"Removed row-hash index of {table} from {node}",
+                p_state="success",
+                quiet_mode=td_task.quiet_mode,
+            )
+        else:
+            util.message(
+                f"{table} has no row-hash index on {node}",
+                p_state="info",
+                quiet_mode=td_task.quiet_mode,
+            )
+
+
+def load_repair_diff(diff_file_path, key, source_of_truth) -> dict:
+    """
+    Reads the node pairs of a diff file that include the source of truth, with
+    all values as strings. Only these node pairs are repaired, and the key
+    index of the diff file, if it has one, lets us parse just those.
+    """
+
+    diff_json = ace_diff_index.read_rows(
+        diff_file_path, key.split(","), source_of_truth
+    )
+    if diff_json is None:
+        diff_json = json.loads(open(diff_file_path, "r").read())
+
+    if any(
+        [set(list(diff_json[k].keys())) != set(k.split("/")) for k in diff_json.keys()]
+    ):
+        raise AceException("Contents of diff file improperly formatted")
+
+    return {
+        node_pair: {
+            node: [{key: str(val) for key, val in row.items()} for row in rows]
+            for node, rows in nodes_data.items()
+        }
+        for node_pair, nodes_data in diff_json.items()
+    }
+
+
+def get_repair_rows(diff_json, source_of_truth, keys_list, cols_list) -> tuple:
+    """
+    Returns the rows to upsert and the rows to delete on every node that
+    differs from the source of truth, as {node: {pkey: row}}, the set of
+    those nodes, and the columns that differ in the rows that the nodes do
+    have, as {node: {pkey: columns}}
+    """
+
+    full_rows_to_upsert = dict()
+    full_rows_to_delete = dict()
+    changed_cols = dict()
+    other_nodes = set()
+
+    for node_pair, node_data in diff_json.items():
+        node1, node2 = node_pair.split("/")
+
+        if node1 == source_of_truth:
+            pass
+        elif node2 == source_of_truth:
+            node2 = node1
+            node1 = source_of_truth
+        else:
+            continue
+
+        other_nodes.add(node2)
+        main_rows = {
+            tuple(row[key] for key in keys_list): row for row in node_data[node1]
+        }
+        side_rows = {
+            tuple(row[key] for key in keys_list): row for row in node_data[node2]
+        }
+
+        full_rows_to_upsert[node2] = main_rows
+        full_rows_to_delete[node2] = {
+            key: val for key, val in side_rows.items() if key not in main_rows
+        }
+        changed_cols[node2] = {
+            key: tuple(col for col in cols_list if row[col] != side_rows[key][col])
+            for key, row in main_rows.items()
+            if key in side_rows
+        }
+
+    return full_rows_to_upsert, full_rows_to_delete, other_nodes, changed_cols
+
+
+def group_repair_rows(rows_to_upsert, changed_cols, cols_list) -> dict:
+    """
+    Groups the rows to upsert on a node by the columns that their upserts
+    set: every column for rows the node does not have, and only the columns
+    that differ for rows it does. Columns left out of the SET list keep their
+    stored values, so unchanged TOAST values are neither rewritten nor
+    replicated.
+
+    Returns:
+        {columns to set: [rows]}
+    """
+
+    groups = {}
+    for pkey, row in rows_to_upsert.items():
+        update_cols = changed_cols.get(pkey) or tuple(cols_list)
+        groups.setdefault(update_cols, []).append(row)
+
+    return groups
+
+
+def get_repair_sql(l_schema, l_table, cols_list, keys_list, update_cols=None) -> tuple:
+    """
+    Returns the upsert and delete statements that repair a table. The upsert
+    sets update_cols of an existing row, or all columns if not given.
+    """
+
+    table_name_sql = f'{l_schema}."{l_table}"'
+    if len(keys_list) == 1:
+        update_sql = f"""
+        INSERT INTO {table_name_sql}
+        VALUES ({','.join(['%s'] * len(cols_list))})
+        ON CONFLICT ("{keys_list[0]}") DO UPDATE SET
+        """
+    else:
+        update_sql = f"""
+        INSERT INTO {table_name_sql}
+        VALUES ({','.join(['%s'] * len(cols_list))})
+        ON CONFLICT
+        ({','.join(['"' + col + '"' for col in keys_list])}) DO UPDATE SET
         """
 
-        for node_pair in diff_dict.keys():
-            node1, node2 = node_pair.split("/")
-            diff_count = max(
-                len(diff_dict[node_pair][node1]), len(diff_dict[node_pair][node2])
-            )
-            util.message(
-                f"FOUND {diff_count} DIFFS BETWEEN {node1} AND {node2}",
-                p_state="warning",
-                quiet_mode=td_task.quiet_mode,
-            )
+    for col in update_cols or cols_list:
+        update_sql += f'"{col}" = EXCLUDED."{col}", '
 
-        try:
-            if td_task.output == "json":
-                td_task.diff_file_path = ace.write_diffs_json(
-                    diff_dict, table_types, quiet_mode=td_task.quiet_mode
-                )
-            elif td_task.output == "csv":
-                ace.write_diffs_csv(diff_dict)
-        except Exception as e:
-            context = {
-                "total_rows": total_rows,
-                "mismatch": mismatch,
-                "errors": [str(e)],
-            }
-            ace.handle_task_exception(td_task, context)
-            raise e
+    update_sql = update_sql[:-2] + ";"
+
+    delete_sql = None
 
+    if len(keys_list) == 1:
+        delete_sql = f"""
+        DELETE FROM {table_name_sql}
+        WHERE "{keys_list[0]}" = %s;
+        """
     else:
-        util.message(
-            "TABLES MATCH OK\n", p_state="success", quiet_mode=td_task.quiet_mode
-        )
+        delete_sql = f"""
+        DELETE FROM {table_name_sql}
+        WHERE
+        """
 
-    run_time = util.round_timedelta(datetime.now() - start_time).total_seconds()
-    run_time_str = f"{run_time:.2f}"
+        for k in keys_list:
+            delete_sql += f' "{k}" = %s AND'
 
-    util.message(
-        f"TOTAL ROWS CHECKED = {total_rows}\nRUN TIME = {run_time_str} seconds",
-        p_state="info",
-        quiet_mode=td_task.quiet_mode,
-    )
+        delete_sql = delete_sql[:-3] + ";"
 
-    td_task.scheduler.task_status = "COMPLETED"
-    td_task.scheduler.finished_at = datetime.now()
-    td_task.scheduler.time_taken = run_time
-    td_task.scheduler.task_context = {
-        "total_rows": total_rows,
-        "mismatch": mismatch,
-        "errors": [],
-    }
+    return update_sql, delete_sql
 
-    if not td_task.skip_db_update:
-        ace_db.update_ace_task(td_task)
 
-    return td_task
+def convert_repair_row(row, cols_list, table_types) -> tuple:
+    """
+    Converts a row of a diff file, with all values as strings, back into
+    values of the column types
+    """
+
+    modified_row = tuple()
+    for col_name in cols_list:
+        col_type = table_types[col_name]
+        elem = row[col_name]
+        try:
+            if any([s in col_type for s in ["char", "text", "vector"]]):
+                modified_row += (elem,)
+            else:
+                item = ast.literal_eval(elem)
+                if col_type == "jsonb":
+                    item = json.dumps(item)
+                modified_row += (item,)
+
+        except (ValueError, SyntaxError):
+            modified_row += (elem,)
+
+    return modified_row
 
 
 def table_repair(tr_task: TableRepairTask):
@@ -727,28 +1764,9 @@ def table_repair(tr_task: TableRepairTask):
     target table. We need to handle this case.
     """
     try:
-        diff_json = json.loads(open(tr_task.diff_file_path, "r").read())
-    except Exception as e:
-        context = {"errors": [f"Could not load diff file as JSON: {str(e)}"]}
-        ace.handle_task_exception(tr_task, context)
-        raise e
-
-    try:
-        if any(
-            [
-                set(list(diff_json[k].keys())) != set(k.split("/"))
-                for k in diff_json.keys()
-            ]
-        ):
-            raise AceException("Contents of diff file improperly formatted")
-
-        diff_json = {
-            node_pair: {
-                node: [{key: str(val) for key, val in row.items()} for row in rows]
-                for node, rows in nodes_data.items()
-            }
-            for node_pair, nodes_data in diff_json.items()
-        }
+        diff_json = load_repair_diff(
+            tr_task.diff_file_path, tr_task.fields.key, tr_task.source_of_truth
+        )
     except Exception as e:
         context = {"errors": [f"Could not read diff file: {str(e)}"]}
         ace.handle_task_exception(tr_task, context)
@@ -821,33 +1839,9 @@ def table_repair(tr_task: TableRepairTask):
 
     """
 
-    full_rows_to_upsert = dict()
-    full_rows_to_delete = dict()
-    other_nodes = set()
-
-    for node_pair, node_data in diff_json.items():
-        node1, node2 = node_pair.split("/")
-
-        if node1 == tr_task.source_of_truth:
-            pass
-        elif node2 == tr_task.source_of_truth:
-            node2 = node1
-            node1 = tr_task.source_of_truth
-        else:
-            continue
-
-        other_nodes.add(node2)
-        main_rows = {
-            tuple(row[key] for key in keys_list): row for row in node_data[node1]
-        }
-        side_rows = {
-            tuple(row[key] for key in keys_list): row for row in node_data[node2]
-        }
-
-        full_rows_to_upsert[node2] = main_rows
-        full_rows_to_delete[node2] = {
-            key: val for key, val in side_rows.items() if key not in main_rows
-        }
+    full_rows_to_upsert, full_rows_to_delete, other_nodes, changed_cols = (
+        get_repair_rows(diff_json, tr_task.source_of_truth, keys_list, cols_list)
+    )
 
     """
     Format of full_rows_to_upsert = {
@@ -907,6 +1901,7 @@ def table_repair(tr_task: TableRepairTask):
     try:
         table_types = ace.get_row_types(
             conns[tr_task.source_of_truth],
+            tr_task.fields.l_schema,
             tr_task.fields.l_table,
         )
     except Exception as e:
@@ -917,53 +1912,25 @@ def table_repair(tr_task: TableRepairTask):
     if tr_task.upsert_only:
         deletes_skipped = dict()
 
+    progress = TaskProgress(tr_task, blocks_total=len(other_nodes), phase="repair")
+
     for divergent_node in other_nodes:
 
-        rows_to_upsert_json = full_rows_to_upsert[divergent_node].values()
+        upsert_groups = group_repair_rows(
+            full_rows_to_upsert[divergent_node],
+            changed_cols[divergent_node],
+            cols_list,
+        )
         delete_keys = list(full_rows_to_delete[divergent_node].keys())
 
         """
         Here we are constructing an UPSERT query from true_rows and
-        applying it to all nodes
+        applying it to all nodes, one for every set of columns that differ
         """
 
-        table_name_sql = f'{tr_task.fields.l_schema}."{tr_task.fields.l_table}"'
-        if simple_primary_key:
-            update_sql = f"""
-            INSERT INTO {table_name_sql}
-            VALUES ({','.join(['%s'] * len(cols_list))})
-            ON CONFLICT ("{tr_task.fields.key}") DO UPDATE SET
-            """
-        else:
-            update_sql = f"""
-            INSERT INTO {table_name_sql}
-            VALUES ({','.join(['%s'] * len(cols_list))})
-            ON CONFLICT
-            ({','.join(['"' + col + '"' for col in keys_list])}) DO UPDATE SET
-            """
-
-        for col in cols_list:
-            update_sql += f'"{col}" = EXCLUDED."{col}", '
-
-        update_sql = update_sql[:-2] + ";"
-
-        delete_sql = None
-
-        if simple_primary_key:
-            delete_sql = f"""
-            DELETE FROM {table_name_sql}
-            WHERE "{tr_task.fields.key}" = %s;
-            """
-        else:
-            delete_sql = f"""
-            DELETE FROM {table_name_sql}
-            WHERE
-            """
-
-            for k in keys_list:
-                delete_sql += f' "{k}" = %s AND'
-
-            delete_sql = delete_sql[:-3] + ";"
+        _, delete_sql = get_repair_sql(
+            tr_task.fields.l_schema, tr_task.fields.l_table, cols_list, keys_list
+        )
 
         try:
             conn = conns[divergent_node]
@@ -995,28 +1962,23 @@ def table_repair(tr_task: TableRepairTask):
         [1, 2, 3] respectively.
         """
         upsert_tuples = []
-        for row in rows_to_upsert_json:
-            modified_row = tuple()
-            for col_name in cols_list:
-                col_type = table_types[col_name]
-                elem = row[col_name]
-                try:
-                    if any([s in col_type for s in ["char", "text", "vector"]]):
-                        modified_row += (elem,)
-                    else:
-                        item = ast.literal_eval(elem)
-                        if col_type == "jsonb":
-                            item = json.dumps(item)
-                        modified_row += (item,)
-
-                except (ValueError, SyntaxError):
-                    modified_row += (elem,)
 
-            upsert_tuples.append(modified_row)
-
-        # Performing the upsert
+        # Performing the upserts
         try:
-            cur.executemany(update_sql, upsert_tuples)
+            for update_cols, rows in upsert_groups.items():
+                update_sql, _ = get_repair_sql(
+                    tr_task.fields.l_schema,
+                    tr_task.fields.l_table,
+                    cols_list,
+                    keys_list,
+                    update_cols,
+                )
+                tuples = [
+                    convert_repair_row(row, cols_list, table_types) for row in rows
+                ]
+                cur.executemany(update_sql, tuples)
+                upsert_tuples += tuples
+
             if tr_task.generate_report:
                 report["changes"][divergent_node]["upserted_rows"] = [
                     dict(zip(cols_list, tup)) for tup in upsert_tuples
@@ -1039,6 +2001,20 @@ def table_repair(tr_task: TableRepairTask):
             ace.handle_task_exception(tr_task, context)
             raise e
 
+        total_upserted[divergent_node] = len(upsert_tuples)
+        total_deleted[divergent_node] = (
+            len(delete_keys) if not tr_task.upsert_only else 0
+        )
+
+        progress.advance()
+        progress.add(
+            rows_upserted=total_upserted[divergent_node],
+            rows_deleted=total_deleted[divergent_node],
+        )
+        progress.publish()
+
+    progress.publish(force=True)
+
     if tr_task.upsert_only:
 
         def compare_values(val1: dict, val2: dict) -> bool:
@@ -1090,112 +2066,421 @@ def table_repair(tr_task: TableRepairTask):
     run_time = util.round_timedelta(datetime.now() - start_time).total_seconds()
     run_time_str = f"{run_time:.2f}"
 
-    util.message(
-        f"Successfully applied diffs to {tr_task._table_name} in cluster "
-        f"{tr_task.cluster_name}\n",
-        p_state="success",
-        quiet_mode=tr_task.quiet_mode,
-    )
+    util.message(
+        f"Successfully applied diffs to {tr_task._table_name} in cluster "
+        f"{tr_task.cluster_name}\n",
+        p_state="success",
+        quiet_mode=tr_task.quiet_mode,
+    )
+
+    if tr_task.generate_report:
+        now = datetime.now()
+        report_folder = "reports"
+        report["run_time"] = run_time
+
+        if not os.path.exists(report_folder):
+            os.mkdir(report_folder)
+
+        dirname = now.strftime("%Y-%m-%d")
+        diff_file_suffix = now.strftime("%H%M%S") + f"{now.microsecond // 1000:03d}"
+        diff_filename = "report_" + diff_file_suffix + ".json"
+
+        dirname = os.path.join(report_folder, dirname)
+
+        if not os.path.exists(dirname):
+            os.mkdir(dirname)
+
+        filename = os.path.join(dirname, diff_filename)
+
+        try:
+            json.dump(report, open(filename, "w"), default=str, indent=2)
+        except Exception as e:
+            context = {"errors": [f"Could not write report: {str(e)}"]}
+            ace.handle_task_exception(tr_task, context)
+            raise e
+
+        print(f"Wrote report to {filename}")
+
+    util.message("*** SUMMARY ***\n", p_state="info", quiet_mode=tr_task.quiet_mode)
+
+    for node in other_nodes:
+        util.message(
+            f"{node} UPSERTED = {len(full_rows_to_upsert[node])} rows",
+            p_state="info",
+            quiet_mode=tr_task.quiet_mode,
+        )
+
+    print()
+
+    for node in other_nodes:
+        util.message(
+            f"{node} DELETED = {len(full_rows_to_delete[node])} rows",
+            p_state="info",
+            quiet_mode=tr_task.quiet_mode,
+        )
+
+    util.message(
+        f"RUN TIME = {run_time_str} seconds",
+        p_state="info",
+        quiet_mode=tr_task.quiet_mode,
+    )
+
+    if spock_version < 4.0:
+        util.message(
+            "WARNING: Unable to pause/resume replication during repair due to"
+            "an older spock version. Please do a manual check as repair may"
+            "have caused further divergence",
+            p_state="warning",
+            quiet_mode=tr_task.quiet_mode,
+        )
+
+    tr_task.scheduler.task_status = "COMPLETED"
+    tr_task.scheduler.finished_at = datetime.now()
+    tr_task.scheduler.time_taken = run_time
+    tr_task.scheduler.task_context = {
+        "source_of_truth": tr_task.source_of_truth,
+        "upserted": total_upserted,
+        "deleted": total_deleted,
+    }
+    ace_db.update_ace_task(tr_task)
+
+
+fk_sql = """
+SELECT cn.nspname || '.' || c.relname, pn.nspname || '.' || p.relname
+FROM pg_catalog.pg_constraint k
+JOIN pg_catalog.pg_class c ON c.oid = k.conrelid
+JOIN pg_catalog.pg_namespace cn ON cn.oid = c.relnamespace
+JOIN pg_catalog.pg_class p ON p.oid = k.confrelid
+JOIN pg_catalog.pg_namespace pn ON pn.oid = p.relnamespace
+WHERE k.contype = 'f'
+"""
+
+
+def get_fk_order(conn, tables) -> list:
+    """
+    Orders tables so that every table comes after the tables that its foreign
+    keys reference. Returns None if the foreign keys between the tables form a
+    cycle.
+    """
+
+    graph = {table: set() for table in tables}
+    for child, parent in conn.execute(fk_sql).fetchall():
+        if child in graph and parent in graph and child != parent:
+            graph[child].add(parent)
+
+    try:
+        return list(TopologicalSorter(graph).static_order())
+    except CycleError:
+        return None
+
+
+def repair_node(conn_params, work, progress, lock) -> dict:
+    """
+    Applies the repairs of one node over a single connection, committing every
+    config.REPAIR_BATCH_ROWS rows.
+
+    Args:
+        work: (table, kind, statement, rows) items, applied in order. kind is
+            "upserted" or "deleted".
+
+    Returns:
+        {table: {kind: rows}}
+    """
+
+    counts = {}
+
+    with psycopg.connect(**conn_params) as conn:
+        cur = conn.cursor()
+        spock_version = ace.get_spock_version(conn)
+
+        def begin():
+            if spock_version >= 4.0:
+                cur.execute("SELECT spock.repair_mode(true);")
+
+        def commit():
+            if spock_version >= 4.0:
+                cur.execute("SELECT spock.repair_mode(false);")
+            conn.commit()
+
+        begin()
+        batch_rows = 0
+
+        for table, kind, statement, rows in work:
+            start = 0
+            while start < len(rows):
+                chunk = rows[start : start + config.REPAIR_BATCH_ROWS - batch_rows]
+                cur.executemany(statement, chunk)
+                start += len(chunk)
+                batch_rows += len(chunk)
+
+                if batch_rows >= config.REPAIR_BATCH_ROWS:
+                    commit()
+                    begin()
+                    batch_rows = 0
+
+            table_counts = counts.setdefault(table, {})
+            table_counts[kind] = table_counts.get(kind, 0) + len(rows)
+            with lock:
+                progress.advance()
+                progress.add(**{f"rows_{kind}": len(rows)})
+
+        commit()
+
+    return counts
+
+
+def repset_repair(rr_task: RepsetRepairTask) -> None:
+    """
+    Repairs every table that a repset-diff found to differ. Each node that
+    differs from the source of truth is repaired over one connection, in
+    parallel with the other nodes: rows are deleted from child tables before
+    their parents, and upserted into parent tables before their children, in
+    transactions of config.REPAIR_BATCH_ROWS rows.
+    """
+
+    start_time = datetime.now()
+    source_of_truth = rr_task.source_of_truth
+
+    node_params = {
+        rr_task.fields.host_map[params["host"] + ":" + params["port"]]: params
+        for params in rr_task.fields.conn_params
+    }
+    tables = {info["table"]: info for info in rr_task.fields.table_list}
+
+    work = {}
+    summary = {
+        table: {"upserted": {}, "deleted": {}, "deletes_skipped": {}}
+        for table in tables
+    }
+
+    try:
+        with psycopg.connect(**node_params[source_of_truth]) as conn:
+            order = get_fk_order(conn, tables)
+            if order is None:
+                util.message(
+                    "Foreign keys between the tables form a cycle; repairing them"
+                    " in repset order",
+                    p_state="warning",
+                    quiet_mode=rr_task.quiet_mode,
+                )
+                order = list(tables)
+
+            for table in order:
+                info = tables[table]
+                cols_list = [
+                    col
+                    for col in info["cols"].split(",")
+                    if not col.startswith("_Spock_")
+                ]
+                keys_list = info["key"].split(",")
+                table_types = ace.get_row_types(
+                    conn, info["l_schema"], info["l_table"]
+                )
+
+                diff_json = load_repair_diff(
+                    info["diff_file_path"], info["key"], source_of_truth
+                )
+                rows_to_upsert, rows_to_delete, other_nodes, changed_cols = (
+                    get_repair_rows(diff_json, source_of_truth, keys_list, cols_list)
+                )
+                _, delete_sql = get_repair_sql(
+                    info["l_schema"], info["l_table"], cols_list, keys_list
+                )
+
+                for node in other_nodes:
+                    upserts, deletes = work.setdefault(node, ([], []))
+                    upsert_groups = group_repair_rows(
+                        rows_to_upsert[node], changed_cols[node], cols_list
+                    )
+
+                    for update_cols, rows in upsert_groups.items():
+                        update_sql, _ = get_repair_sql(
+                            info["l_schema"],
+                            info["l_table"],
+                            cols_list,
+                            keys_list,
+                            update_cols,
+                        )
+                        upserts.append(
+                            (
+                                table,
+                                "upserted",
+                                update_sql,
+                                [
+                                    convert_repair_row(row, cols_list, table_types)
+                                    for row in rows
+                                ],
+                            )
+                        )
+
+                    delete_keys = list(rows_to_delete[node].keys())
+                    if rr_task.upsert_only:
+                        summary[table]["deletes_skipped"][node] = len(delete_keys)
+                    else:
+                        deletes.append((table, "deleted", delete_sql, delete_keys))
+    except Exception as e:
+        context = {"errors": [f"Could not prepare repairs: {str(e)}"]}
+        ace.handle_task_exception(rr_task, context)
+        raise e
 
-    if tr_task.generate_report:
-        now = datetime.now()
-        report_folder = "reports"
-        report["run_time"] = run_time
+    # Children are deleted from before their parents, and parents upserted into
+    # before their children
+    work = {
+        node: list(reversed(deletes)) + upserts
+        for node, (upserts, deletes) in work.items()
+    }
 
-        if not os.path.exists(report_folder):
-            os.mkdir(report_folder)
+    if rr_task.dry_run:
+        dry_run_msg = "######## DRY RUN ########\n\n"
+        for node, items in work.items():
+            # Upserts of a table are split by the columns they set
+            totals = {}
+            for table, kind, _, rows in items:
+                totals[(table, kind)] = totals.get((table, kind), 0) + len(rows)
 
-        dirname = now.strftime("%Y-%m-%d")
-        diff_file_suffix = now.strftime("%H%M%S") + f"{now.microsecond // 1000:03d}"
-        diff_filename = "report_" + diff_file_suffix + ".json"
+            for (table, kind), rows in totals.items():
+                dry_run_msg += (
+                    f"Repair would have {kind} {rows} rows in {table} on {node}\n"
+                )
+        dry_run_msg += "\n######## END DRY RUN ########"
 
-        dirname = os.path.join(report_folder, dirname)
+        util.message(dry_run_msg, p_state="alert", quiet_mode=rr_task.quiet_mode)
+        return
 
-        if not os.path.exists(dirname):
-            os.mkdir(dirname)
+    progress = TaskProgress(
+        rr_task,
+        blocks_total=sum(len(items) for items in work.values()),
+        phase="repair",
+    )
+    lock = threading.Lock()
+    errors = []
 
-        filename = os.path.join(dirname, diff_filename)
+    with ThreadPoolExecutor(max_workers=max(len(work), 1)) as executor:
+        futures = {
+            executor.submit(repair_node, node_params[node], items, progress, lock): node
+            for node, items in work.items()
+        }
 
-        try:
-            json.dump(report, open(filename, "w"), default=str, indent=2)
-        except Exception as e:
-            context = {"errors": [f"Could not write report: {str(e)}"]}
-            ace.handle_task_exception(tr_task, context)
-            raise e
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=1)
+            for future in done:
+                node = futures[future]
+                if future.exception():
+                    errors.append(f"{node}: {str(future.exception())}")
+                    util.message(
+                        f"Could not repair {node}: {str(future.exception())}",
+                        p_state="warning",
+                        quiet_mode=rr_task.quiet_mode,
+                    )
+                    continue
 
-        print(f"Wrote report to {filename}")
+                for table, counts in future.result().items():
+                    for kind, rows in counts.items():
+                        summary[table][kind][node] = rows
 
-    util.message("*** SUMMARY ***\n", p_state="info", quiet_mode=tr_task.quiet_mode)
+            progress.publish()
 
-    for node in other_nodes:
-        util.message(
-            f"{node} UPSERTED = {len(full_rows_to_upsert[node])} rows",
-            p_state="info",
-            quiet_mode=tr_task.quiet_mode,
-        )
+    progress.publish(force=True)
 
-    print()
+    run_time = util.round_timedelta(datetime.now() - start_time).total_seconds()
 
-    for node in other_nodes:
-        util.message(
-            f"{node} DELETED = {len(full_rows_to_delete[node])} rows",
-            p_state="info",
-            quiet_mode=tr_task.quiet_mode,
-        )
+    util.message("*** SUMMARY ***\n", p_state="info", quiet_mode=rr_task.quiet_mode)
+
+    for table in order:
+        for kind in ("upserted", "deleted"):
+            for node, rows in summary[table][kind].items():
+                util.message(
+                    f"{table}: {node} {kind.upper()} = {rows} rows",
+                    p_state="info",
+                    quiet_mode=rr_task.quiet_mode,
+                )
 
     util.message(
-        f"RUN TIME = {run_time_str} seconds",
+        f"RUN TIME = {run_time:.2f} seconds",
         p_state="info",
-        quiet_mode=tr_task.quiet_mode,
+        quiet_mode=rr_task.quiet_mode,
     )
 
-    if spock_version < 4.0:
+    rr_task.scheduler.task_status = "FAILED" if errors else "COMPLETED"
+    rr_task.scheduler.finished_at = datetime.now()
+    rr_task.scheduler.time_taken = run_time
+    rr_task.scheduler.task_context = {
+        "source_of_truth": source_of_truth,
+        "diff_task_id": rr_task.diff_task_id,
+        "tables": summary,
+        "errors": errors,
+    }
+    ace_db.update_ace_task(rr_task)
+
+    if not errors:
         util.message(
-            "WARNING: Unable to pause/resume replication during repair due to"
-            "an older spock version. Please do a manual check as repair may"
-            "have caused further divergence",
-            p_state="warning",
-            quiet_mode=tr_task.quiet_mode,
+            f"Successfully repaired {len(tables)} tables in cluster "
+            f"{rr_task.cluster_name}\n",
+            p_state="success",
+            quiet_mode=rr_task.quiet_mode,
         )
 
-    tr_task.scheduler.task_status = "COMPLETED"
-    tr_task.scheduler.finished_at = datetime.now()
-    tr_task.scheduler.time_taken = run_time
-    tr_task.scheduler.task_context = {
-        "source_of_truth": tr_task.source_of_truth,
-        "upserted": total_upserted,
-        "deleted": total_deleted,
-    }
-    ace_db.update_ace_task(tr_task)
-
 
-def table_rerun_temptable(td_task: TableDiffTask) -> None:
+def get_diff_keys(td_task) -> list:
+    """
+    Returns the distinct primary keys of the rows in the diff file of a rerun,
+    read from the key index of the diff file when it has one
+    """
 
-    # load diff data and validate
-    diff_data = json.load(open(td_task.diff_file_path, "r"))
-    diff_keys = set()
     key = td_task.fields.key.split(",")
 
-    # Simple pkey
-    if len(key) == 1:
-        for node_pair in diff_data.keys():
-            nd1, nd2 = node_pair.split("/")
+    diff_keys = ace_diff_index.read_keys(td_task.diff_file_path, key)
+    if diff_keys is not None:
+        return diff_keys
 
-            for row in diff_data[node_pair][nd1] + diff_data[node_pair][nd2]:
-                diff_keys.add(row[key[0]])
+    with open(td_task.diff_file_path, "r") as f:
+        diff_data = json.load(f)
+    diff_kset = set()
+    diff_keys = list()
 
-    # Comp pkey
-    else:
-        for node_pair in diff_data.keys():
-            nd1, nd2 = node_pair.split("/")
+    for node_pair in diff_data.keys():
+        nd1, nd2 = node_pair.split("/")
+
+        for row in diff_data[node_pair][nd1] + diff_data[node_pair][nd2]:
+            if len(key) == 1:
+                element = row[key[0]]
+            else:
+                element = tuple(row[key_component] for key_component in key)
+
+            if element not in diff_kset:
+                diff_kset.add(element)
+                diff_keys.append(element)
 
-            for row in diff_data[node_pair][nd1] + diff_data[node_pair][nd2]:
-                diff_keys.add(tuple(row[key_component] for key_component in key))
+    return diff_keys
+
+
+def table_rerun_temptable(td_task: TableDiffTask) -> None:
+
+    if td_task.fields.read_only_nodes:
+        e = AceException(
+            "The hostdb rerun creates tables, which read-only nodes "
+            f"{', '.join(td_task.fields.read_only_nodes)} cannot. "
+            "Use the multiprocessing rerun instead"
+        )
+        ace.handle_task_exception(td_task, {"errors": [str(e)]})
+        raise e
+
+    diff_keys = get_diff_keys(td_task)
+    key = td_task.fields.key.split(",")
 
     temp_table_name = f"temp_{td_task.scheduler.task_id.lower()}_rerun"
-    table_qry = f"create table {temp_table_name} as "
-    table_qry += f"SELECT * FROM {td_task._table_name} WHERE " + generate_where_clause(
-        key, diff_keys
+    table_qry = sql.SQL(
+        "CREATE TABLE {temp_table} AS "
+        "SELECT t.* FROM {table} t JOIN pg_temp.{key_table} USING ({key_cols})"
+    ).format(
+        temp_table=sql.Identifier(temp_table_name),
+        table=sql.SQL("{}.{}").format(
+            sql.Identifier(td_task.fields.l_schema),
+            sql.Identifier(td_task.fields.l_table),
+        ),
+        key_table=sql.Identifier(ace_keys.KEY_TABLE),
+        key_cols=sql.SQL(", ").join(sql.Identifier(col) for col in key),
     )
     clean_qry = f"drop table {temp_table_name}"
 
@@ -1211,7 +2496,16 @@ def table_rerun_temptable(td_task: TableDiffTask) -> None:
         for params in td_task.fields.conn_params:
             conn_list.append(psycopg.connect(**params))
 
+        table_types = ace.get_row_types(
+            conn_list[0], td_task.fields.l_schema, td_task.fields.l_table
+        )
+        key_types = {col: table_types[col] for col in key}
+
+        # The diff keys are joined against on every node
         for con in conn_list:
+            oids = ace_keys.create_key_table(con, key, key_types)
+            ace_keys.load_keys(con, key, oids, diff_keys)
+
             cur = con.cursor()
             cur.execute(table_qry)
             cur.execute(pkey_qry)
@@ -1235,8 +2529,16 @@ def table_rerun_temptable(td_task: TableDiffTask) -> None:
             _nodes=td_task._nodes,
             batch_size=td_task.batch_size,
             quiet_mode=td_task.quiet_mode,
+            low_impact=td_task.low_impact,
+            max_rows_per_sec=td_task.max_rows_per_sec,
+            max_mb_per_sec=td_task.max_mb_per_sec,
         )
         diff_args.scheduler.task_id = task_id
+        diff_args.scheduler.task_type = "table-diff"
+        diff_args.scheduler.task_status = "RUNNING"
+        diff_args.scheduler.started_at = datetime.now()
+        diff_args.scheduler.worker_budget = td_task.scheduler.worker_budget
+        diff_args.scheduler.deadline = td_task.scheduler.deadline
         diff_task = ace.table_diff_checks(diff_args)
         ace_db.create_ace_task(task=diff_task)
         table_diff(diff_task)
@@ -1256,7 +2558,10 @@ def table_rerun_temptable(td_task: TableDiffTask) -> None:
         ace.handle_task_exception(td_task, context)
         raise e
 
-    td_task.scheduler.task_status = "COMPLETED"
+    # The temp table diff stops at the deadline of the rerun
+    td_task.scheduler.task_status = (
+        "CANCELLED" if diff_task.scheduler.task_status == "CANCELLED" else "COMPLETED"
+    )
     td_task.scheduler.finished_at = datetime.now()
     td_task.scheduler.time_taken = diff_task.scheduler.time_taken
     td_task.scheduler.task_context = diff_task.scheduler.task_context
@@ -1264,53 +2569,43 @@ def table_rerun_temptable(td_task: TableDiffTask) -> None:
 
 
 def table_rerun_async(td_task: TableDiffTask) -> None:
+    diff_store = DiffStore.create(td_task.fields.key.split(","))
+    try:
+        return table_rerun_blocks(td_task, diff_store)
+    finally:
+        diff_store.remove()
+
+
+def table_rerun_blocks(td_task: TableDiffTask, diff_store: DiffStore) -> None:
+    """Rechecks the rows of a diff file, collecting the rows that still differ"""
+
     table_types = None
 
     try:
         for params in td_task.fields.conn_params:
-            conn = psycopg.connect(**params)
+            conn = ace_connections.get_node_conn(params)
             if not table_types:
-                table_types = ace.get_row_types(conn, td_task.fields.l_table)
+                table_types = ace.get_row_types(
+                    conn, td_task.fields.l_schema, td_task.fields.l_table
+                )
     except Exception as e:
         context = {"errors": [f"Could not connect to nodes: {str(e)}"]}
         ace.handle_task_exception(td_task, context)
         raise e
 
-    # load diff data and validate
+    # load diff keys and validate
     try:
-        diff_data = json.load(open(td_task.diff_file_path, "r"))
+        diff_keys = get_diff_keys(td_task)
     except Exception as e:
         context = {"errors": [f"Could not read diff file: {str(e)}"]}
         ace.handle_task_exception(td_task, context)
         raise e
 
-    diff_kset = set()
-    diff_keys = list()
     key = td_task.fields.key.split(",")
     simple_primary_key = len(key) == 1
 
-    # Simple pkey
-    if simple_primary_key == 1:
-        for node_pair in diff_data.keys():
-            nd1, nd2 = node_pair.split("/")
-
-            for row in diff_data[node_pair][nd1] + diff_data[node_pair][nd2]:
-                if row[key[0]] not in diff_kset:
-                    diff_kset.add(row[key[0]])
-                    diff_keys.append(row[key[0]])
-    # Comp pkey
-    else:
-        for node_pair in diff_data.keys():
-            nd1, nd2 = node_pair.split("/")
-
-            for row in diff_data[node_pair][nd1] + diff_data[node_pair][nd2]:
-                element = tuple(row[key_component] for key_component in key)
-                if element not in diff_kset:
-                    diff_kset.add(element)
-                    diff_keys.append(element)
-
     # create blocks
-    total_rows = len(diff_kset) * len(td_task.fields.node_list)
+    total_rows = len(diff_keys) * len(td_task.fields.node_list)
     total_diff = len(diff_keys)
 
     if total_diff > 100:
@@ -1325,11 +2620,7 @@ def table_rerun_async(td_task: TableDiffTask) -> None:
         blocks = [[diff_keys]]
 
     total_blocks = len(blocks)
-
-    # If we don't have enough blocks to keep all CPUs busy, use fewer processes
-    cpus = cpu_count()
-    max_procs = int(cpus * td_task.max_cpu_ratio) if cpus > 1 else 1
-    procs = max_procs if total_blocks > max_procs else total_blocks
+    procs = get_worker_count(td_task, total_blocks)
 
     start_time = datetime.now()
 
@@ -1343,14 +2634,17 @@ def table_rerun_async(td_task: TableDiffTask) -> None:
     cols_list = [col for col in cols_list if not col.startswith("_Spock_")]
 
     result_queue = Manager().list()
-    diff_dict = Manager().dict()
     row_diff_count = Manager().Value("I", 0)
     lock = Manager().Lock()
+    cancel_event = Manager().Event()
+    backend_pids = Manager().list()
+    throttle_state = Manager().dict({"factor": 1.0, "paused": False})
 
     # Shared variables needed by all workers
     shared_objects = {
         "cluster_name": td_task.cluster_name,
         "database": td_task.fields.database,
+        "cluster_nodes": td_task.fields.cluster_nodes,
         "node_list": td_task.fields.node_list,
         "schema_name": td_task.fields.l_schema,
         "table_name": td_task.fields.l_table,
@@ -1359,10 +2653,15 @@ def table_rerun_async(td_task: TableDiffTask) -> None:
         "block_rows": td_task.block_rows,
         "simple_primary_key": simple_primary_key,
         "mode": "rerun",
+        "key_types": {col: table_types[col] for col in key},
+        "read_only_nodes": td_task.fields.read_only_nodes,
         "result_queue": result_queue,
-        "diff_dict": diff_dict,
+        "diff_store": diff_store,
         "row_diff_count": row_diff_count,
         "lock": lock,
+        "cancel_event": cancel_event,
+        "backend_pids": backend_pids,
+        "throttle": get_throttle(td_task, procs, throttle_state),
     }
 
     util.message(
@@ -1376,8 +2675,26 @@ def table_rerun_async(td_task: TableDiffTask) -> None:
     errors = False
     errors_list = []
 
+    progress = TaskProgress(
+        td_task,
+        blocks_total=total_blocks,
+        node_pairs=len(list(combinations(td_task.fields.node_list, 2))),
+        phase="rerun",
+    )
+
+    canceller = TaskCanceller(
+        td_task, cancel_event, backend_pids, td_task.fields.conn_params
+    )
+    canceller.start()
+
+    health_monitor = nullcontext()
+    if td_task.low_impact:
+        health_monitor = NodeHealthMonitor(
+            td_task, throttle_state, backend_pids, td_task.fields.conn_params, progress
+        )
+
     try:
-        with WorkerPool(
+        with health_monitor, WorkerPool(
             n_jobs=procs,
             shared_objects=shared_objects,
             use_worker_state=True,
@@ -1391,7 +2708,12 @@ def table_rerun_async(td_task: TableDiffTask) -> None:
                 iterable_len=len(blocks),
                 progress_bar_style="rich",
             ):
-                if result == config.MAX_DIFFS_EXCEEDED:
+                progress.consume(result_queue)
+                progress.publish()
+
+                if result == config.TASK_CANCELLED or canceller.cancelled:
+                    break
+                elif result == config.MAX_DIFFS_EXCEEDED:
                     diffs_exceeded = True
                     mismatch = True
                     break
@@ -1400,6 +2722,9 @@ def table_rerun_async(td_task: TableDiffTask) -> None:
                     errors_list.append(result)
                     break
 
+            progress.consume(result_queue)
+            progress.publish(force=True)
+
             if diffs_exceeded:
                 util.message(
                     "Prematurely terminated jobs since diffs have"
@@ -1408,10 +2733,22 @@ def table_rerun_async(td_task: TableDiffTask) -> None:
                     quiet_mode=td_task.quiet_mode,
                 )
     except Exception as e:
+        canceller.stop()
         context = {"errors": [f"Could not spawn multiprocessing workers: {str(e)}"]}
         ace.handle_task_exception(td_task, context)
         raise e
 
+    canceller.stop()
+
+    # A cancel request that arrives after the last block has been compared
+    # does not make the results partial
+    blocks_done = progress.snapshot()["blocks_done"]
+    if canceller.cancelled and blocks_done < progress.blocks_total:
+        context = {"total_rows": total_rows, "mismatch": mismatch}
+        return finish_cancelled_diff(
+            td_task, canceller, progress, diff_store, table_types, context
+        )
+
     for result in result_queue:
         if result["status_code"] == config.BLOCK_MISMATCH:
             mismatch = True
@@ -1450,11 +2787,9 @@ def table_rerun_async(td_task: TableDiffTask) -> None:
         in the cluster
         """
 
-        for node_pair in diff_dict.keys():
+        for node_pair, node_rows in diff_store.counts().items():
             node1, node2 = node_pair.split("/")
-            diff_count = max(
-                len(diff_dict[node_pair][node1]), len(diff_dict[node_pair][node2])
-            )
+            diff_count = max(node_rows.values())
             util.message(
                 f"FOUND {diff_count} DIFFS BETWEEN {node1} AND {node2}",
                 p_state="warning",
@@ -1464,11 +2799,15 @@ def table_rerun_async(td_task: TableDiffTask) -> None:
         try:
             if td_task.output == "json":
                 td_task.diff_file_path = ace.write_diffs_json(
-                    diff_dict, table_types, quiet_mode=td_task.quiet_mode
+                    diff_store,
+                    table_types,
+                    quiet_mode=td_task.quiet_mode,
+                    key=td_task.fields.key,
+                )
+            else:
+                ace.write_diffs_csv(
+                    diff_store, quiet_mode=td_task.quiet_mode, output=td_task.output
                 )
-
-            elif td_task.output == "csv":
-                ace.write_diffs_csv()
         except Exception as e:
             context = {"errors": [f"Could not write diffs to file: {str(e)}"]}
             ace.handle_task_exception(td_task, context)
@@ -1497,13 +2836,108 @@ def table_rerun_async(td_task: TableDiffTask) -> None:
     ace_db.update_ace_task(td_task)
 
 
+def repset_fingerprint(rd_task: RepsetDiffTask, tables) -> tuple:
+    """
+    Fingerprints all tables of a repset in one go. Returns the tables whose
+    fingerprints differ, or could not be taken, which then need a table-diff,
+    the status of the tables that match, and the reason if the repset-diff was
+    cancelled meanwhile.
+    """
+
+    util.message(
+        f"\nFINGERPRINTING {len(tables)} TABLES...",
+        p_state="info",
+        quiet_mode=rd_task.quiet_mode,
+    )
+
+    start_time = datetime.now()
+    node_params = ace_fingerprint.get_node_params(
+        rd_task.cluster_name,
+        rd_task.fields.database,
+        rd_task.fields.node_list,
+        rd_task.fields.cluster_nodes,
+    )
+    cancel_event = threading.Event()
+    backend_pids = []
+    canceller = TaskCanceller(
+        rd_task, cancel_event, backend_pids, list(node_params.values())
+    )
+    progress = TaskProgress(rd_task, blocks_total=0, phase="fingerprint")
+
+    with canceller:
+        fingerprints = ace_fingerprint.fingerprint_tables(
+            rd_task, tables, node_params, cancel_event, backend_pids, progress
+        )
+
+    if canceller.cancelled:
+        status = [{"table": table, "status": "CANCELLED"} for table in tables]
+        return [], status, canceller.reason
+
+    run_time = util.round_timedelta(datetime.now() - start_time).total_seconds()
+    to_diff = []
+    matched = []
+
+    for table in tables:
+        if ace_fingerprint.fingerprints_match(fingerprints[table]):
+            matched.append(
+                {
+                    "table": table,
+                    "status": "COMPLETED",
+                    "time_taken": run_time,
+                    "total_rows": sum(
+                        fp["rows"] for fp in fingerprints[table].values()
+                    ),
+                    "mismatch": False,
+                    "diff_file_path": None,
+                    "fingerprint": True,
+                }
+            )
+        else:
+            to_diff.append(table)
+
+    util.message(
+        f"{len(matched)} TABLES MATCH, {len(to_diff)} TABLES NEED A DIFF "
+        f"({run_time:.2f} seconds)",
+        p_state="warning" if to_diff else "success",
+        quiet_mode=rd_task.quiet_mode,
+    )
+
+    return to_diff, matched, None
+
+
 def repset_diff(rd_task: RepsetDiffTask) -> None:
     """Loop thru a replication-sets tables and run table-diff on them"""
 
-    rd_task_context = []
     rd_start_time = datetime.now()
+    rd_task_context, errors_encountered, cancel_reason = diff_repset_tables(rd_task)
+
+    if cancel_reason:
+        rd_task.scheduler.task_status = "CANCELLED"
+    else:
+        rd_task.scheduler.task_status = (
+            "COMPLETED" if not errors_encountered else "FAILED"
+        )
+    rd_task.scheduler.finished_at = datetime.now()
+    rd_task.scheduler.task_context = rd_task_context
+    rd_task.scheduler.time_taken = util.round_timedelta(
+        datetime.now() - rd_start_time
+    ).total_seconds()
+
+    ace_db.update_ace_task(rd_task)
+
+
+def diff_repset_tables(rd_task: RepsetDiffTask) -> tuple:
+    """
+    Runs table-diff on the tables of a repset. Returns the status of every
+    table, whether any table failed, and the reason the diffs were cancelled,
+    if they were.
+    """
+
+    rd_task_context = []
     errors_encountered = False
+    cancel_reason = None
 
+    tables = []
     for table in rd_task.table_list:
 
         if table.split(".")[1] in rd_task.skip_tables:
@@ -1515,6 +2949,85 @@ def repset_diff(rd_task: RepsetDiffTask) -> None:
 
             continue
 
+        tables.append(table)
+
+    # Write counters are read before any table is checked, so that writes made
+    # while the repset-diff runs count as changes on the next run
+    counters = {}
+    try:
+        node_params = ace_fingerprint.get_node_params(
+            rd_task.cluster_name,
+            rd_task.fields.database,
+            rd_task.fields.node_list,
+            rd_task.fields.cluster_nodes,
+        )
+        counters = ace_watermarks.get_write_counters(node_params)
+    except Exception as e:
+        util.message(
+            f"Could not read table write counters: {str(e)}",
+            p_state="warning",
+            quiet_mode=rd_task.quiet_mode,
+        )
+
+    db_name = rd_task.fields.database["db_name"]
+
+    if rd_task.skip_unchanged and counters:
+        watermarks = ace_db.get_table_watermarks(rd_task.cluster_name, db_name)
+        unchanged = [
+            table
+            for table in tables
+            if ace_watermarks.is_unchanged(
+                watermarks.get(table), counters.get(table), rd_task.fields.node_list
+            )
+        ]
+
+        for table in unchanged:
+            util.message(
+                f"\nSKIPPING UNCHANGED TABLE {table}",
+                p_state="info",
+                quiet_mode=rd_task.quiet_mode,
+            )
+            rd_task_context.append(
+                {
+                    "table": table,
+                    "status": "SKIPPED",
+                    "reason": "No writes since last verified",
+                    "last_verified_at": watermarks[table]["last_verified_at"],
+                }
+            )
+
+        tables = [table for table in tables if table not in unchanged]
+
+    if rd_task.fingerprint and tables:
+        try:
+            tables, matched, cancel_reason = repset_fingerprint(rd_task, tables)
+        except Exception as e:
+            context = {"errors": [f"Could not fingerprint tables: {str(e)}"]}
+            ace.handle_task_exception(rd_task, context)
+            raise e
+
+        rd_task_context += matched
+
+        for status in matched:
+            if status["status"] == "COMPLETED":
+                ace_db.record_table_status(
+                    rd_task.cluster_name,
+                    db_name,
+                    status["table"],
+                    rd_task.scheduler.task_id,
+                    status["status"],
+                    status["mismatch"],
+                    time_taken=status["time_taken"],
+                    diff_rows=0,
+                    write_counters=counters.get(status["table"]),
+                )
+
+    for table in tables:
+
+        # The remaining tables are not checked
+        if cancel_reason:
+            break
+
         try:
             start_time = datetime.now()
             util.message(
@@ -1535,19 +3048,54 @@ def repset_diff(rd_task: RepsetDiffTask) -> None:
                 _nodes=rd_task._nodes,
                 batch_size=rd_task.batch_size,
                 skip_db_update=True,
+                low_impact=rd_task.low_impact,
+                max_rows_per_sec=rd_task.max_rows_per_sec,
+                max_mb_per_sec=rd_task.max_mb_per_sec,
+                exact_counts=rd_task.exact_counts,
+                parallel_workers=rd_task.parallel_workers,
+                digest_large_cols=rd_task.digest_large_cols,
+                dsns=rd_task.dsns,
             )
+            td_task.scheduler.started_at = start_time
+            td_task.scheduler.worker_budget = rd_task.scheduler.worker_budget
+
+            # The per-table diffs are not recorded as tasks of their own, but
+            # they publish their live progress into the repset-diff task, and
+            # stop when the repset-diff task is cancelled
+            td_task.scheduler.task_id = rd_task.scheduler.task_id
 
             td_task = ace.table_diff_checks(td_task)
+
+            # Whatever is left of the repset-diff deadline applies to the table
+            if rd_task.scheduler.deadline is not None:
+                td_task.scheduler.deadline = (
+                    rd_task.scheduler.deadline
+                    - (start_time - rd_task.scheduler.started_at).total_seconds()
+                )
+
             td_task = table_diff(td_task)
             run_time = util.round_timedelta(datetime.now() - start_time).total_seconds()
             status = {
                 "table": table,
-                "status": "COMPLETED",
+                "status": td_task.scheduler.task_status,
                 "time_taken": run_time,
                 "total_rows": td_task.scheduler.task_context["total_rows"],
                 "mismatch": td_task.scheduler.task_context["mismatch"],
                 "diff_file_path": getattr(td_task, "diff_file_path", None),
             }
+
+            if td_task.scheduler.task_status == "CANCELLED":
+                cancel_reason = td_task.scheduler.task_context["reason"]
+                status["reason"] = cancel_reason
+
+            ace_db.record_table_check(
+                rd_task.cluster_name,
+                db_name,
+                table,
+                td_task,
+                td_task.scheduler.task_context.get("diff_rows"),
+                counters.get(table),
+            )
         except Exception as e:
             errors_encountered = True
             status = {
@@ -1562,14 +3110,130 @@ def repset_diff(rd_task: RepsetDiffTask) -> None:
 
         rd_task_context.append(status)
 
-    rd_task.scheduler.task_status = "COMPLETED" if not errors_encountered else "FAILED"
-    rd_task.scheduler.finished_at = datetime.now()
-    rd_task.scheduler.task_context = rd_task_context
-    rd_task.scheduler.time_taken = util.round_timedelta(
-        datetime.now() - rd_start_time
+    return rd_task_context, errors_encountered, cancel_reason
+
+
+def cluster_sweep(cs_task: ClusterSweepTask) -> None:
+    """
+    Diffs every repset of every database of a cluster as one task. The repsets
+    run one after another, and the tables in them one at a time, so that each
+    table gets the whole worker budget of the sweep. They share the node
+    connections opened by the pre-flight checks, the deadline of the sweep,
+    and its cancellation. A table in more than one repset of a database is
+    diffed once.
+    """
+
+    start_time = datetime.now()
+    sweep_context = {}
+    errors_encountered = False
+    cancel_reason = None
+    seen = set()
+
+    # The job queue sets the budget of API tasks, which max_workers may lower
+    worker_budget = cs_task.scheduler.worker_budget
+    if cs_task.max_workers:
+        worker_budget = min(worker_budget or cs_task.max_workers, cs_task.max_workers)
+
+    for rd_task in cs_task.repset_tasks:
+        if cancel_reason:
+            break
+
+        dbname = rd_task.fields.database["db_name"]
+        rd_task.table_list = [
+            table for table in rd_task.table_list if (dbname, table) not in seen
+        ]
+        seen.update((dbname, table) for table in rd_task.table_list)
+
+        # The repset-diffs are not recorded as tasks of their own
+        rd_task.scheduler.task_id = cs_task.scheduler.task_id
+        rd_task.scheduler.started_at = cs_task.scheduler.started_at
+        rd_task.scheduler.deadline = cs_task.scheduler.deadline
+        rd_task.scheduler.worker_budget = worker_budget
+
+        util.message(
+            f"\n\nSWEEPING REPSET {rd_task.repset_name} IN DATABASE {dbname}...",
+            p_state="info",
+            quiet_mode=cs_task.quiet_mode,
+        )
+
+        try:
+            context, errors, cancel_reason = diff_repset_tables(rd_task)
+        except Exception as e:
+            context = [{"status": "FAILED", "error": str(e)}]
+            errors = True
+
+        errors_encountered = errors_encountered or errors
+        sweep_context.setdefault(dbname, {})[rd_task.repset_name] = context
+
+    summary = {}
+    for repsets in sweep_context.values():
+        for statuses in repsets.values():
+            for status in statuses:
+                if status.get("mismatch"):
+                    key = "mismatched"
+                else:
+                    key = status["status"].lower()
+                summary[key] = summary.get(key, 0) + 1
+
+    report = {
+        "cluster_name": cs_task.cluster_name,
+        "started_at": start_time,
+        "summary": summary,
+        "databases": sweep_context,
+    }
+
+    now = datetime.now()
+    dirname = os.path.join("reports", now.strftime("%Y-%m-%d"))
+    filename = os.path.join(
+        dirname,
+        "sweep_" + now.strftime("%H%M%S") + f"{now.microsecond // 1000:03d}.json",
+    )
+
+    try:
+        os.makedirs(dirname, exist_ok=True)
+        with open(filename, "w") as f:
+            json.dump(report, f, default=str, indent=2)
+    except Exception as e:
+        context = {"errors": [f"Could not write sweep report: {str(e)}"]}
+        ace.handle_task_exception(cs_task, context)
+        raise e
+
+    util.message("\n*** SUMMARY ***\n", p_state="info", quiet_mode=cs_task.quiet_mode)
+    for dbname, repsets in sweep_context.items():
+        for repset, statuses in repsets.items():
+            for status in statuses:
+                if status.get("mismatch"):
+                    state = "MISMATCH"
+                else:
+                    state = status["status"]
+                util.message(
+                    f"{dbname}: {repset}: {status.get('table')}: {state}",
+                    p_state="warning" if state in ("MISMATCH", "FAILED") else "info",
+                    quiet_mode=cs_task.quiet_mode,
+                )
+    util.message(
+        f"Wrote sweep report to {filename}",
+        p_state="info",
+        quiet_mode=cs_task.quiet_mode,
+    )
+
+    if cancel_reason:
+        cs_task.scheduler.task_status = "CANCELLED"
+    else:
+        cs_task.scheduler.task_status = (
+            "COMPLETED" if not errors_encountered else "FAILED"
+        )
+    cs_task.scheduler.finished_at = datetime.now()
+    cs_task.scheduler.task_context = {
+        "summary": summary,
+        "report_file": filename,
+        "databases": sweep_context,
+    }
+    cs_task.scheduler.time_taken = util.round_timedelta(
+        datetime.now() - start_time
     ).total_seconds()
 
-    ace_db.update_ace_task(rd_task)
+    ace_db.update_ace_task(cs_task)
 
 
 def spock_diff(sd_task: SpockDiffTask) -> None:
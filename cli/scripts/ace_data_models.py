@@ -16,6 +16,20 @@ class Task:
     finished_at: datetime = None
     time_taken: float = None
 
+    # Populated when the task goes through the API job queue
+    priority: int = None
+    queued_at: datetime = None
+    wait_time: float = None
+
+    # Upper bound on the number of worker processes (and hence connections
+    # per node) that the task may use. None means no limit beyond
+    # max_cpu_ratio.
+    worker_budget: int = None
+
+    # Maximum run time of the task in seconds, counted from started_at. The
+    # task is cancelled, and its partial results recorded, once it expires.
+    deadline: float = None
+
 
 @dataclass
 class DerivedFields:
@@ -29,6 +43,8 @@ class DerivedFields:
     node_list: list = None
     host_map: dict = None
     table_list: list = None
+    read_only_nodes: list = None
+    row_hash_nodes: list = None
 
 
 @dataclass
@@ -46,6 +62,29 @@ class TableDiffTask:
     batch_size: int
     quiet_mode: bool
 
+    # Low-impact mode: per-node rate targets and pauses while nodes are busy
+    low_impact: bool = False
+    max_rows_per_sec: int = None
+    max_mb_per_sec: float = None
+
+    # Size the diff from exact row counts instead of planner estimates
+    exact_counts: bool = False
+
+    # Compare whole-table fingerprints instead of blocks of rows
+    fingerprint: bool = False
+
+    # Hash every block with this many Postgres parallel workers per node
+    # instead of with more client connections. 0 disables parallel hashing.
+    parallel_workers: int = 0
+
+    # Compare columns of large types by their digests, and fetch their values
+    # only for rows that differ
+    digest_large_cols: bool = False
+
+    # {name: DSN} of nodes outside the cluster, e.g. a physical standby, that
+    # the nodes list may name
+    dsns: any = None
+
     # For table-diff, the diff_file_path is
     # obtained after the run of table-diff,
     # and is not mandatory
@@ -56,10 +95,10 @@ class TableDiffTask:
     # status of each table-diff task (for now)
     skip_db_update: bool = False
 
-    scheduler: Task = field(default=Task)
+    scheduler: Task = field(default_factory=Task)
 
     # Derived fields
-    fields: DerivedFields = field(default=DerivedFields)
+    fields: DerivedFields = field(default_factory=DerivedFields)
 
 
 @dataclass
@@ -85,10 +124,36 @@ class TableRepairTask:
     upsert_only: bool
 
     # Task-specific parameters
-    scheduler: Task = field(default=Task)
+    scheduler: Task = field(default_factory=Task)
 
     # Derived fields
-    fields: DerivedFields = field(default=DerivedFields)
+    fields: DerivedFields = field(default_factory=DerivedFields)
+
+
+@dataclass
+class RepsetRepairTask:
+    # Unprocessed fields
+    _dbname: str
+
+    # Mandatory fields
+    cluster_name: str
+
+    # The repset-diff task whose diff files are repaired
+    diff_task_id: str
+    source_of_truth: str
+
+    # Optional fields, but non-default since the handler method will fill in the
+    # default values
+    quiet_mode: bool
+    dry_run: bool
+    upsert_only: bool
+
+    # Task-specific parameters
+    scheduler: Task = field(default_factory=Task)
+
+    # Derived fields. table_list holds, for every table to repair, a dict with
+    # its name, diff file, schema, table, columns and primary key.
+    fields: DerivedFields = field(default_factory=DerivedFields)
 
 
 @dataclass
@@ -113,11 +178,84 @@ class RepsetDiffTask:
 
     invoke_method: str = "CLI"
 
+    # Low-impact mode, applied to the diff of every table in the repset
+    low_impact: bool = False
+    max_rows_per_sec: int = None
+    max_mb_per_sec: float = None
+
+    # Size the diff from exact row counts instead of planner estimates
+    exact_counts: bool = False
+
+    # Fingerprint every table first, and diff only those whose fingerprints
+    # differ across nodes
+    fingerprint: bool = False
+
+    # Parallel block hashing, applied to the diff of every table
+    parallel_workers: int = 0
+
+    # Large column digests, applied to the diff of every table
+    digest_large_cols: bool = False
+
+    # Skip tables that were last verified without differences and have had no
+    # writes on any node since
+    skip_unchanged: bool = False
+
+    # Nodes outside the cluster, applied to the diff of every table
+    dsns: any = None
+
+    # Task-specific parameters
+    scheduler: Task = field(default_factory=Task)
+
+    # Derived fields
+    fields: DerivedFields = field(default_factory=DerivedFields)
+
+
+@dataclass
+class ClusterSweepTask:
+    # Unprocessed fields
+    _dbnames: any
+    _nodes: str
+
+    # Mandatory fields
+    cluster_name: str
+
+    # Optional fields
+    # Non-default members since the handler method will fill in the
+    # default values
+    block_rows: int
+    max_cpu_ratio: float
+    output: str
+    batch_size: int
+    quiet_mode: bool
+
+    invoke_method: str = "CLI"
+
+    # Repsets to sweep, and tables to leave out of them. All repsets of every
+    # database by default.
+    repsets: any = None
+    skip_tables: any = None
+
+    # Options applied to the diff of every table, as in repset-diff
+    low_impact: bool = False
+    max_rows_per_sec: int = None
+    max_mb_per_sec: float = None
+    exact_counts: bool = False
+    fingerprint: bool = False
+    parallel_workers: int = 0
+    digest_large_cols: bool = False
+    skip_unchanged: bool = False
+
+    # Upper bound on the worker processes of the whole sweep
+    max_workers: int = None
+
     # Task-specific parameters
-    scheduler: Task = field(default=Task)
+    scheduler: Task = field(default_factory=Task)
 
     # Derived fields
-    fields: DerivedFields = field(default=DerivedFields)
+    fields: DerivedFields = field(default_factory=DerivedFields)
+
+    # One repset-diff per database and repset, in the order they are swept
+    repset_tasks: list = field(default_factory=list)
 
 
 @dataclass
@@ -133,10 +271,10 @@ class SpockDiffTask:
     quiet_mode: bool
 
     # Task-specific parameters
-    scheduler: Task = field(default=Task)
+    scheduler: Task = field(default_factory=Task)
 
     # Derived fields
-    fields: DerivedFields = field(default=DerivedFields)
+    fields: DerivedFields = field(default_factory=DerivedFields)
 
 
 @dataclass
@@ -153,7 +291,7 @@ class SchemaDiffTask:
     quiet_mode: bool
 
     # Task-specific parameters
-    scheduler: Task = field(default=Task)
+    scheduler: Task = field(default_factory=Task)
 
     # Derived fields
-    fields: DerivedFields = field(default=DerivedFields)
+    fields: DerivedFields = field(default_factory=DerivedFields)
@@ -1,15 +1,23 @@
-from datetime import time
+from datetime import datetime, timedelta
 import json
+import os
 import pickle
 import sqlite3
+import threading
+import time
 from typing import Union
 import util
 import string
 import random
+import ace_config as config
 from ace_data_models import TableDiffTask, TableRepairTask, RepsetDiffTask
 
 sqlite_db = util.MY_LITE
-local_db_conn = sqlite3.connect(sqlite_db, check_same_thread=False)
+
+# Connections are opened lazily, one per thread in every process. A sqlite3
+# connection must not be shared across threads, and it must never be carried
+# across a fork into mpire or scheduler workers.
+conn_state = threading.local()
 
 ace_tasks_sql = """
 CREATE TABLE IF NOT EXISTS ace_tasks (
@@ -24,10 +32,93 @@ CREATE TABLE IF NOT EXISTS ace_tasks (
   diff_file_path    TEXT,
   started_at        TEXT,
   finished_at       TEXT,
+  time_taken        DOUBLE,
+  priority          INTEGER,
+  queued_at         TEXT,
+  wait_time         DOUBLE,
+  task_progress     TEXT,
+  cancel_requested_at TEXT
+);
+"""
+
+# Columns added after the first release of ace_tasks. Older task stores
+# are migrated in place by create_ace_tables().
+ace_tasks_added_columns = {
+    "priority": "INTEGER",
+    "queued_at": "TEXT",
+    "wait_time": "DOUBLE",
+    "task_progress": "TEXT",
+    "cancel_requested_at": "TEXT",
+}
+
+ace_tasks_indexes_sql = [
+    """
+    CREATE INDEX IF NOT EXISTS ace_tasks_status_cluster_idx
+    ON ace_tasks (task_status, cluster_name)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ace_tasks_finished_at_idx
+    ON ace_tasks (finished_at)
+    """,
+]
+
+# Per-table state of the consistency monitor. write_counters holds the
+# inserted + updated + deleted tuple counts of the table on every node as of
+# the last verification, so that unchanged tables can be skipped. Tables are
+# kept per database, as databases of a cluster can have tables of one name.
+ace_table_watermarks_sql = """
+CREATE TABLE IF NOT EXISTS ace_table_watermarks (
+  cluster_name      TEXT        NOT NULL,
+  db_name           TEXT        NOT NULL,
+  table_name        TEXT        NOT NULL,
+  last_checked_at   TEXT,
+  last_verified_at  TEXT,
+  last_task_id      TEXT,
+  last_status       TEXT,
+  mismatch          INTEGER,
+  write_counters    TEXT,
+  PRIMARY KEY (cluster_name, db_name, table_name)
+);
+"""
+
+ace_drift_history_sql = """
+CREATE TABLE IF NOT EXISTS ace_drift_history (
+  id                INTEGER     PRIMARY KEY AUTOINCREMENT,
+  cluster_name      TEXT        NOT NULL,
+  db_name           TEXT        NOT NULL,
+  table_name        TEXT        NOT NULL,
+  task_id           TEXT,
+  checked_at        TEXT        NOT NULL,
+  task_status       TEXT,
+  mismatch          INTEGER,
+  diff_rows         INTEGER,
+  diff_file_path    TEXT,
   time_taken        DOUBLE
 );
 """
 
+ace_drift_history_index_sql = """
+CREATE INDEX IF NOT EXISTS ace_drift_history_table_idx
+ON ace_drift_history (cluster_name, db_name, table_name, checked_at)
+"""
+
+# Table metadata cached by ace_metadata, keyed on the node and table and
+# stamped with the relation oid and change marker that it was fetched at
+ace_table_metadata_sql = """
+CREATE TABLE IF NOT EXISTS ace_table_metadata (
+  node              TEXT        NOT NULL,
+  schema_name       TEXT        NOT NULL,
+  table_name        TEXT        NOT NULL,
+  relid             INTEGER     NOT NULL,
+  marker            TEXT        NOT NULL,
+  cols              TEXT        NOT NULL,
+  key_cols          TEXT        NOT NULL,
+  col_types         TEXT        NOT NULL,
+  fetched_at        TEXT,
+  PRIMARY KEY (node, schema_name, table_name)
+);
+"""
+
 ace_internal_table_sql = """
 CREATE TABLE IF NOT EXISTS ace_internal (
     job_id TEXT PRIMARY KEY,
@@ -36,6 +127,54 @@ CREATE TABLE IF NOT EXISTS ace_internal (
 """
 
 
+def get_local_db_conn() -> sqlite3.Connection:
+    conn = getattr(conn_state, "conn", None)
+
+    if conn is not None and conn_state.pid == os.getpid():
+        return conn
+
+    conn = sqlite3.connect(sqlite_db, timeout=config.TASK_DB_BUSY_TIMEOUT / 1000)
+    conn.execute(f"PRAGMA busy_timeout = {int(config.TASK_DB_BUSY_TIMEOUT)}")
+
+    # WAL lets status readers run alongside a writer. The journal mode is
+    # persistent, so this is a no-op once any connection has switched it.
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+
+    conn_state.conn = conn
+    conn_state.pid = os.getpid()
+
+    return conn
+
+
+def run_in_transaction(work, sql, func_name):
+    """
+    Runs work(cursor) in a single transaction and returns its result.
+
+    busy_timeout already makes SQLite wait for competing writers. If the lock
+    still cannot be acquired, the whole transaction is retried with exponential
+    backoff, up to config.TASK_DB_MAX_RETRIES times.
+    """
+
+    conn = get_local_db_conn()
+
+    for attempt in range(config.TASK_DB_MAX_RETRIES + 1):
+        try:
+            with conn:
+                return work(conn.cursor())
+        except sqlite3.OperationalError as e:
+            if "database is locked" in str(e) and attempt < config.TASK_DB_MAX_RETRIES:
+                time.sleep(config.TASK_DB_RETRY_DELAY * (2**attempt))
+                continue
+            util.fatal_sql_error(e, sql, func_name)
+        except Exception as e:
+            util.fatal_sql_error(e, sql, func_name)
+
+
+def format_timestamp(ts):
+    return ts.isoformat(timespec="milliseconds") if ts else None
+
+
 def generate_task_id(length=8):
     return "".join(
         random.choice(string.ascii_lowercase + string.digits + string.ascii_uppercase)
@@ -44,61 +183,96 @@ def generate_task_id(length=8):
 
 
 def create_ace_tables():
-    try:
-        c = local_db_conn.cursor()
+    def work(c):
         c.execute(ace_tasks_sql)
         # c.execute(ace_internal_table_sql)
-        local_db_conn.commit()
-    except Exception as e:
-        util.fatal_sql_error(e, ace_tasks_sql, "create_ace_tasks_table()")
+
+        c.execute("PRAGMA table_info(ace_tasks)")
+        existing_cols = {row[1] for row in c.fetchall()}
+        for col_name, col_type in ace_tasks_added_columns.items():
+            if col_name not in existing_cols:
+                c.execute(f"ALTER TABLE ace_tasks ADD COLUMN {col_name} {col_type}")
+
+        for index_sql in ace_tasks_indexes_sql:
+            c.execute(index_sql)
+
+        c.execute(ace_table_watermarks_sql)
+        c.execute(ace_drift_history_sql)
+        c.execute(ace_drift_history_index_sql)
+        c.execute(ace_table_metadata_sql)
+
+    run_in_transaction(work, ace_tasks_sql, "create_ace_tasks_table()")
 
 
 def create_ace_task(
     task: Union[TableDiffTask, TableRepairTask, RepsetDiffTask]
 ) -> None:
-    try:
-        c = local_db_conn.cursor()
-        sql = """
-                INSERT INTO ace_tasks (task_id, task_type, cluster_name, schema,
-                table_name, repset_name, task_status, task_context, diff_file_path,
-                started_at, finished_at, time_taken)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-              """
-        c.execute(
-            sql,
-            (
-                task.scheduler.task_id,
-                task.scheduler.task_type,
-                task.cluster_name,
-                getattr(task.fields, "l_schema", None),
-                getattr(task.fields, "l_table", None),
-                getattr(task.fields, "repset_name", None),
-                task.scheduler.task_status,
-                task.scheduler.task_context,
-                # diff_file_path is not mandatory for table-diff and repset-diff
-                getattr(task, "diff_file_path", None),
-                task.scheduler.started_at,
-                task.scheduler.finished_at,
-                task.scheduler.time_taken,
-            ),
+    sql = """
+            INSERT INTO ace_tasks (task_id, task_type, cluster_name, schema,
+            table_name, repset_name, task_status, task_context, diff_file_path,
+            started_at, finished_at, time_taken, priority, queued_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+          """
+    params = (
+        task.scheduler.task_id,
+        task.scheduler.task_type,
+        task.cluster_name,
+        getattr(task.fields, "l_schema", None),
+        getattr(task.fields, "l_table", None),
+        getattr(task.fields, "repset_name", None),
+        task.scheduler.task_status,
+        task.scheduler.task_context,
+        # diff_file_path is not mandatory for table-diff and repset-diff
+        getattr(task, "diff_file_path", None),
+        format_timestamp(task.scheduler.started_at),
+        format_timestamp(task.scheduler.finished_at),
+        task.scheduler.time_taken,
+        task.scheduler.priority,
+        format_timestamp(task.scheduler.queued_at),
+    )
+
+    run_in_transaction(lambda c: c.execute(sql, params), sql, "create_ace_task()")
+
+
+def start_queued_ace_tasks(tasks) -> None:
+    """Record, in one write, that a set of queued tasks are now running"""
+
+    if not tasks:
+        return
+
+    sql = """
+            UPDATE ace_tasks SET
+            task_status = ?,
+            started_at = ?,
+            wait_time = ?
+            WHERE task_id = ?
+          """
+    params = [
+        (
+            task.scheduler.task_status,
+            format_timestamp(task.scheduler.started_at),
+            task.scheduler.wait_time,
+            task.scheduler.task_id,
         )
-        local_db_conn.commit()
-    except Exception as e:
-        util.fatal_sql_error(e, sql, "create_ace_task()")
+        for task in tasks
+    ]
+
+    run_in_transaction(
+        lambda c: c.executemany(sql, params), sql, "start_queued_ace_tasks()"
+    )
 
 
 def store_pickled_task(job_id, task_obj):
-    try:
-        c = local_db_conn.cursor()
-        sql = "INSERT INTO ace_internal (job_id, task_obj) VALUES (?, ?)"
-        c.execute(sql, (job_id, sqlite3.Binary(task_obj)))
-        local_db_conn.commit()
-    except Exception as e:
-        util.fatal_sql_error(e, sql, "store_pickled_task()")
+    sql = "INSERT INTO ace_internal (job_id, task_obj) VALUES (?, ?)"
+    run_in_transaction(
+        lambda c: c.execute(sql, (job_id, sqlite3.Binary(task_obj))),
+        sql,
+        "store_pickled_task()",
+    )
 
 
 def get_pickled_task(job_id):
-    c = local_db_conn.cursor()
+    c = get_local_db_conn().cursor()
     sql = "SELECT task_obj FROM ace_internal WHERE job_id = ?"
     c.execute(sql, (job_id,))
     row = c.fetchone()
@@ -108,7 +282,7 @@ def get_pickled_task(job_id):
 
 
 def get_ace_task_by_id(task_id) -> dict:
-    c = local_db_conn.cursor()
+    c = get_local_db_conn().cursor()
     sql = "SELECT * FROM ace_tasks WHERE task_id = ?"
 
     # We are using a paramterised query here, so there's no
@@ -122,73 +296,351 @@ def get_ace_task_by_id(task_id) -> dict:
     colnames = [desc[0] for desc in c.description]
 
     task_details = {
-        colname: json.loads(value) if colname == 'task_context' and value else value
+        colname: (
+            json.loads(value)
+            if colname in ("task_context", "task_progress") and value
+            else value
+        )
         for colname, value in zip(colnames, row)
     }
 
     return task_details
 
 
+def update_ace_tasks(tasks) -> None:
+    """Write the status of several tasks in a single transaction"""
+
+    if not tasks:
+        return
+
+    sql = """
+            UPDATE ace_tasks SET
+            task_status = ?,
+            task_context = ?,
+            diff_file_path = ?,
+            started_at = ?,
+            finished_at = ?,
+            time_taken = ?
+            WHERE task_id = ?
+          """
+
+    # Prepare data outside of the execute call
+    params = [
+        (
+            task.scheduler.task_status,
+            json.dumps(task.scheduler.task_context),
+            getattr(task, "diff_file_path", None),
+            format_timestamp(task.scheduler.started_at),
+            format_timestamp(task.scheduler.finished_at),
+            task.scheduler.time_taken,
+            task.scheduler.task_id,
+        )
+        for task in tasks
+    ]
+
+    run_in_transaction(lambda c: c.executemany(sql, params), sql, "update_ace_task()")
+
+
+def update_ace_task_progress(task_id, progress: dict) -> None:
+    sql = "UPDATE ace_tasks SET task_progress = ? WHERE task_id = ?"
+    run_in_transaction(
+        lambda c: c.execute(sql, (json.dumps(progress, default=str), task_id)),
+        sql,
+        "update_ace_task_progress()",
+    )
+
+
+def request_ace_task_cancel(task_id) -> bool:
+    """
+    Flags a queued or running task for cancellation. The task itself notices
+    the flag and stops.
+
+    Returns:
+        False if the task does not exist or has already finished.
+    """
+
+    sql = """
+            UPDATE ace_tasks SET cancel_requested_at = ?
+            WHERE task_id = ?
+            AND task_status IN ('QUEUED', 'RUNNING')
+          """
+
+    updated = run_in_transaction(
+        lambda c: c.execute(sql, (format_timestamp(datetime.now()), task_id)).rowcount,
+        sql,
+        "request_ace_task_cancel()",
+    )
+
+    return updated > 0
+
+
+def is_ace_task_cancel_requested(task_id) -> bool:
+    c = get_local_db_conn().cursor()
+    sql = "SELECT cancel_requested_at FROM ace_tasks WHERE task_id = ?"
+    c.execute(sql, (task_id,))
+    row = c.fetchone()
+
+    return bool(row and row[0])
+
+
 def update_ace_task(task: Union[TableDiffTask, TableRepairTask, RepsetDiffTask]):
-    try:
-        c = local_db_conn.cursor()
-        sql = """
-                UPDATE ace_tasks SET
-                task_status = ?,
-                task_context = ?,
-                diff_file_path = ?,
-                started_at = ?,
-                finished_at = ?,
-                time_taken = ?
-                WHERE task_id = ?
-              """
-
-        # Prepare data outside of the execute call
-        task_context = json.dumps(task.scheduler.task_context)
-        started_at = task.scheduler.started_at.isoformat(timespec="milliseconds")
-        finished_at = task.scheduler.finished_at.isoformat(timespec="milliseconds")
-
-        c.execute(
-            sql,
-            (
-                task.scheduler.task_status,
-                task_context,
-                getattr(task, "diff_file_path", None),
-                started_at,
-                finished_at,
-                task.scheduler.time_taken,
-                task.scheduler.task_id,
-            ),
+    update_ace_tasks([task])
+
+
+def get_table_watermarks(cluster_name, db_name) -> dict:
+    """
+    Returns the monitor state of every table of a database of a cluster, by
+    table name
+    """
+
+    c = get_local_db_conn().cursor()
+    sql = "SELECT * FROM ace_table_watermarks WHERE cluster_name = ? AND db_name = ?"
+    c.execute(sql, (cluster_name, db_name))
+    colnames = [desc[0] for desc in c.description]
+
+    watermarks = {}
+    for row in c.fetchall():
+        watermark = dict(zip(colnames, row))
+        if watermark["write_counters"]:
+            watermark["write_counters"] = json.loads(watermark["write_counters"])
+        watermarks[watermark["table_name"]] = watermark
+
+    return watermarks
+
+
+def record_table_check(
+    cluster_name, db_name, table_name, task, diff_rows=None, write_counters=None
+) -> None:
+    """
+    Appends a check of a table to its drift history and moves its watermark.
+    The last-verified time and the write counters only move when the check
+    completed.
+    """
+
+    context = task.scheduler.task_context
+
+    record_table_status(
+        cluster_name,
+        db_name,
+        table_name,
+        task.scheduler.task_id,
+        task.scheduler.task_status,
+        context.get("mismatch") if isinstance(context, dict) else None,
+        finished_at=task.scheduler.finished_at,
+        time_taken=task.scheduler.time_taken,
+        diff_rows=diff_rows,
+        diff_file_path=getattr(task, "diff_file_path", None),
+        write_counters=write_counters,
+    )
+
+
+def record_table_status(
+    cluster_name,
+    db_name,
+    table_name,
+    task_id,
+    status,
+    mismatch,
+    finished_at=None,
+    time_taken=None,
+    diff_rows=None,
+    diff_file_path=None,
+    write_counters=None,
+) -> None:
+    """
+    Same as record_table_check(), for checks that did not run as a table-diff
+    task of their own, such as a table found to match by its fingerprint
+    """
+
+    checked_at = format_timestamp(finished_at or datetime.now())
+
+    history_sql = """
+            INSERT INTO ace_drift_history (cluster_name, db_name, table_name,
+            task_id, checked_at, task_status, mismatch, diff_rows,
+            diff_file_path, time_taken)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+          """
+    history_params = (
+        cluster_name,
+        db_name,
+        table_name,
+        task_id,
+        checked_at,
+        status,
+        mismatch,
+        diff_rows,
+        diff_file_path,
+        time_taken,
+    )
+
+    verified = status == "COMPLETED"
+    watermark_sql = """
+            INSERT INTO ace_table_watermarks (cluster_name, db_name,
+            table_name, last_checked_at, last_verified_at, last_task_id,
+            last_status, mismatch, write_counters)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (cluster_name, db_name, table_name) DO UPDATE SET
+            last_checked_at = excluded.last_checked_at,
+            last_verified_at = coalesce(excluded.last_verified_at,
+                                        last_verified_at),
+            last_task_id = excluded.last_task_id,
+            last_status = excluded.last_status,
+            mismatch = excluded.mismatch,
+            write_counters = coalesce(excluded.write_counters, write_counters)
+          """
+    watermark_params = (
+        cluster_name,
+        db_name,
+        table_name,
+        checked_at,
+        checked_at if verified else None,
+        task_id,
+        status,
+        mismatch,
+        json.dumps(write_counters) if verified and write_counters else None,
+    )
+
+    def work(c):
+        c.execute(history_sql, history_params)
+        c.execute(watermark_sql, watermark_params)
+
+    run_in_transaction(work, watermark_sql, "record_table_status()")
+
+
+def get_drift_history(cluster_name, db_name, table_name=None, limit=100) -> list:
+    c = get_local_db_conn().cursor()
+    sql = "SELECT * FROM ace_drift_history WHERE cluster_name = ? AND db_name = ?"
+    params = [cluster_name, db_name]
+
+    if table_name:
+        sql += " AND table_name = ?"
+        params.append(table_name)
+
+    sql += " ORDER BY checked_at DESC LIMIT ?"
+    params.append(limit)
+
+    c.execute(sql, params)
+    colnames = [desc[0] for desc in c.description]
+
+    return [dict(zip(colnames, row)) for row in c.fetchall()]
+
+
+def get_table_metadata(node, schema_name) -> dict:
+    """Returns the cached metadata of every table of a schema on a node"""
+
+    c = get_local_db_conn().cursor()
+    sql = """
+        SELECT table_name, relid, marker, cols, key_cols, col_types
+        FROM ace_table_metadata
+        WHERE node = ? AND schema_name = ?
+    """
+    c.execute(sql, (node, schema_name))
+
+    return {
+        table_name: {
+            "relid": relid,
+            "marker": marker,
+            "cols": json.loads(cols),
+            "key": json.loads(key_cols),
+            "types": json.loads(col_types),
+        }
+        for table_name, relid, marker, cols, key_cols, col_types in c.fetchall()
+    }
+
+
+def store_table_metadata(node, schema_name, entries) -> None:
+    """Caches (table_name, metadata) pairs fetched by ace_metadata"""
+
+    sql = """
+            INSERT OR REPLACE INTO ace_table_metadata (node, schema_name,
+            table_name, relid, marker, cols, key_cols, col_types, fetched_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+          """
+    fetched_at = format_timestamp(datetime.now())
+    params = [
+        (
+            node,
+            schema_name,
+            table_name,
+            entry["relid"],
+            entry["marker"],
+            json.dumps(entry["cols"]),
+            json.dumps(entry["key"]),
+            json.dumps(entry["types"]),
+            fetched_at,
         )
-        local_db_conn.commit()
-    except sqlite3.OperationalError as e:
-        if "database is locked" in str(e):
-            print("Database is locked. Retrying...")
-            time.sleep(1)  # Wait for 1 second before retrying
-            return update_ace_task(task)  # Recursive call to retry
-        else:
-            util.fatal_sql_error(e, sql, "update_ace_task()")
-    except Exception as e:
-        util.fatal_sql_error(e, sql, "update_ace_task()")
+        for table_name, entry in entries
+    ]
+
+    run_in_transaction(
+        lambda c: c.executemany(sql, params), sql, "store_table_metadata()"
+    )
+
+
+def delete_table_metadata(node, schema_name, table_names) -> None:
+    sql = """
+            DELETE FROM ace_table_metadata
+            WHERE node = ? AND schema_name = ? AND table_name = ?
+          """
+    params = [(node, schema_name, table_name) for table_name in table_names]
+
+    run_in_transaction(
+        lambda c: c.executemany(sql, params), sql, "delete_table_metadata()"
+    )
+
+
+def purge_ace_tasks(retention_days=config.TASK_RETENTION_DAYS) -> int:
+    """
+    Deletes finished tasks, and drift history, older than the retention period
+    and compacts the task store. Queued and running tasks are never deleted.
+
+    Returns:
+        The number of tasks deleted.
+    """
+
+    cutoff = format_timestamp(datetime.now() - timedelta(days=retention_days))
+    sql = """
+            DELETE FROM ace_tasks
+            WHERE task_status NOT IN ('QUEUED', 'RUNNING')
+            AND finished_at < ?
+          """
+
+    history_sql = "DELETE FROM ace_drift_history WHERE checked_at < ?"
+
+    def work(c):
+        deleted = c.execute(sql, (cutoff,)).rowcount
+        c.execute(history_sql, (cutoff,))
+        return deleted
+
+    deleted = run_in_transaction(work, sql, "purge_ace_tasks()")
+
+    # Fold the WAL back into the main database file and refresh the planner
+    # statistics for the indexes
+    conn = get_local_db_conn()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.execute("PRAGMA optimize")
+
+    return deleted
 
 
 def cleanup_ace_tasks():
-    try:
-        c = local_db_conn.cursor()
-        sql = "DELETE FROM ace_tasks"
-        c.execute(sql)
-        local_db_conn.commit()
-    except Exception as e:
-        util.fatal_sql_error(e, sql, "cleanup_ace_tasks()")
+    sql = "DELETE FROM ace_tasks"
+    run_in_transaction(lambda c: c.execute(sql), sql, "cleanup_ace_tasks()")
 
 
 def drop_ace_tables():
-    try:
-        c = local_db_conn.cursor()
-        tasks_sql = "DROP TABLE IF EXISTS ace_tasks"
-        internal_sql = "DROP TABLE IF EXISTS ace_internal"
+    tasks_sql = "DROP TABLE IF EXISTS ace_tasks"
+    internal_sql = "DROP TABLE IF EXISTS ace_internal"
+    monitor_sql = [
+        "DROP TABLE IF EXISTS ace_table_watermarks",
+        "DROP TABLE IF EXISTS ace_drift_history",
+        "DROP TABLE IF EXISTS ace_table_metadata",
+    ]
+
+    def work(c):
         c.execute(tasks_sql)
         c.execute(internal_sql)
-        local_db_conn.commit()
-    except Exception as e:
-        util.fatal_sql_error(e, tasks_sql, "drop_ace_tables()")
+        for drop_sql in monitor_sql:
+            c.execute(drop_sql)
+
+    run_in_transaction(work, tasks_sql, "drop_ace_tables()")
@@ -0,0 +1,194 @@
+"""
+Key index files (diffs_<time>.json.idx) written alongside diff files, so that
+readers can seek to the keys and node pairs they need.
+"""
+
+import json
+import os
+
+INDEX_SUFFIX = ".idx"
+INDEX_VERSION = 1
+
+
+def index_path(diff_file) -> str:
+    return diff_file + INDEX_SUFFIX
+
+
+def dumps(value) -> bytes:
+    return json.dumps(value, default=str).encode()
+
+
+def dump_diffs(f, write_dict, key_cols=None) -> tuple:
+    """
+    Writes write_dict to the binary file f exactly as json.dumps() would,
+    reading the rows of each node from any iterable. Returns the number of
+    bytes written, the sections of every node pair, and the JSON of the keys
+    of every node pair if key_cols is given.
+    """
+
+    pairs = {}
+    key_sections = []
+    offset = 0
+
+    def write(data):
+        nonlocal offset
+        f.write(data)
+        offset += len(data)
+
+    write(b"{")
+    for i, (node_pair, nodes_data) in enumerate(write_dict.items()):
+        write((", " if i else "").encode() + dumps(node_pair) + b": {")
+
+        sections = {}
+        pair_keys = set()
+        for j, (node, rows) in enumerate(nodes_data.items()):
+            write((", " if j else "").encode() + dumps(node) + b": ")
+
+            start = offset
+            count = 0
+            write(b"[")
+            for row in rows:
+                write((b", " if count else b"") + dumps(row))
+                count += 1
+
+                if key_cols:
+                    pair_keys.add(tuple(row[col] for col in key_cols))
+            write(b"]")
+
+            sections[node] = [start, offset - start, count]
+
+        write(b"}")
+
+        pairs[node_pair] = {"rows": sections}
+        if not key_cols:
+            continue
+
+        try:
+            keys = sorted(pair_keys)
+        except TypeError:
+            keys = list(pair_keys)
+
+        if len(key_cols) == 1:
+            keys = [key[0] for key in keys]
+
+        pairs[node_pair]["keys"] = len(keys)
+        key_sections.append((node_pair, dumps(keys)))
+    write(b"}")
+
+    return offset, pairs, key_sections
+
+
+def write_diff_file(filename, write_dict, key_cols) -> None:
+    """
+    Writes write_dict to filename exactly as json.dumps() would, and the key
+    index of the diff file next to it
+    """
+
+    with open(filename, "wb") as f:
+        size, pairs, key_sections = dump_diffs(f, write_dict, key_cols)
+
+    # Key sections are laid out after the header, in node pair order
+    position = 0
+    for node_pair, data in key_sections:
+        pairs[node_pair]["keys"] = [position, len(data), pairs[node_pair]["keys"]]
+        position += len(data)
+
+    header = {
+        "version": INDEX_VERSION,
+        "key": key_cols,
+        "diff_file_size": size,
+        "pairs": pairs,
+    }
+
+    with open(index_path(filename), "wb") as f:
+        f.write(dumps(header) + b"\n")
+        for _, data in key_sections:
+            f.write(data)
+
+
+def read_header(diff_file, key_cols):
+    """
+    Returns (header, byte offset of the key sections) of the index of a diff
+    file, or None if there is no usable index for the given primary key
+    """
+
+    path = index_path(diff_file)
+
+    try:
+        if not os.path.exists(path):
+            return None
+
+        with open(path, "rb") as f:
+            header = json.loads(f.readline())
+            start = f.tell()
+
+        if (
+            header.get("version") != INDEX_VERSION
+            or header.get("key") != list(key_cols)
+            or header.get("diff_file_size") != os.path.getsize(diff_file)
+        ):
+            return None
+    except Exception:
+        return None
+
+    return header, start
+
+
+def read_section(path, offset, length):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return json.loads(f.read(length))
+
+
+def read_keys(diff_file, key_cols):
+    """
+    Returns the distinct primary keys of all rows in a diff file (scalars for
+    a simple primary key, tuples for a composite one), or None if the diff
+    file has no usable index
+    """
+
+    index = read_header(diff_file, key_cols)
+    if not index:
+        return None
+
+    header, start = index
+    path = index_path(diff_file)
+
+    seen = set()
+    diff_keys = []
+    for pair in header["pairs"].values():
+        offset, length, _ = pair["keys"]
+        for key in read_section(path, start + offset, length):
+            if len(key_cols) > 1:
+                key = tuple(key)
+            if key not in seen:
+                seen.add(key)
+                diff_keys.append(key)
+
+    return diff_keys
+
+
+def read_rows(diff_file, key_cols, node):
+    """
+    Returns the contents of a diff file limited to the node pairs that include
+    node, in the same form as the whole file, or None if the diff file has no
+    usable index
+    """
+
+    index = read_header(diff_file, key_cols)
+    if not index:
+        return None
+
+    header, _ = index
+
+    diff_json = {}
+    for node_pair, pair in header["pairs"].items():
+        if node not in node_pair.split("/"):
+            continue
+
+        diff_json[node_pair] = {
+            nd: read_section(diff_file, offset, length)
+            for nd, (offset, length, _) in pair["rows"].items()
+        }
+
+    return diff_json
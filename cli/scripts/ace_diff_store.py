@@ -0,0 +1,196 @@
+"""
+Spill files for the rows that table-diff and table-rerun find to differ.
+"""
+
+import json
+import os
+import sqlite3
+import tempfile
+
+import ace_config as config
+
+schema_sql = """
+CREATE TABLE IF NOT EXISTS node_pairs (
+    node_pair TEXT PRIMARY KEY,
+    node1 TEXT NOT NULL,
+    node2 TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS diff_rows (
+    node_pair TEXT NOT NULL,
+    node TEXT NOT NULL,
+    pkey TEXT NOT NULL,
+    row TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS diff_rows_pkey
+    ON diff_rows (node_pair, node, pkey);
+"""
+
+
+class DiffStore:
+    """
+    The spill file of one task. Instances are passed to the mpire workers with
+    the other shared objects, and every process opens its own connection.
+    """
+
+    def __init__(self, path, key_cols):
+        self.path = path
+        self.key_cols = key_cols
+        self._conn = None
+        self._pid = None
+
+    @classmethod
+    def create(cls, key_cols):
+        os.makedirs(config.DIFF_SPILL_DIR, exist_ok=True)
+        fd, path = tempfile.mkstemp(
+            prefix="ace_diffs_", suffix=".db", dir=config.DIFF_SPILL_DIR
+        )
+        os.close(fd)
+
+        store = cls(path, key_cols)
+        store.conn.executescript(schema_sql)
+        store.close()
+
+        return store
+
+    def __getstate__(self):
+        return {"path": self.path, "key_cols": self.key_cols}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["key_cols"])
+
+    @property
+    def conn(self):
+        # Connections are not carried across a fork into the workers
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(
+                self.path, timeout=config.TASK_DB_BUSY_TIMEOUT / 1000
+            )
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            self._conn.execute("PRAGMA synchronous = OFF")
+            self._pid = os.getpid()
+
+        return self._conn
+
+    def add(self, node_pair, host1, rows1, host2, rows2) -> None:
+        """
+        Appends the rows of one mismatched block, as lists of {column: value}
+        dicts from host1 and host2
+        """
+
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO node_pairs VALUES (?, ?, ?)",
+                (node_pair, host1, host2),
+            )
+            for host, rows in ((host1, rows1), (host2, rows2)):
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO diff_rows VALUES (?, ?, ?, ?)",
+                    (
+                        (
+                            node_pair,
+                            host,
+                            json.dumps([row[col] for col in self.key_cols]),
+                            json.dumps(row, default=str),
+                        )
+                        for row in rows
+                    ),
+                )
+
+    def counts(self) -> dict:
+        """Returns {node_pair: {node1: rows, node2: rows}}, in the order found"""
+
+        counts = {
+            node_pair: {node1: 0, node2: 0}
+            for node_pair, node1, node2 in self.conn.execute(
+                "SELECT node_pair, node1, node2 FROM node_pairs ORDER BY rowid"
+            )
+        }
+
+        for node_pair, node, rows in self.conn.execute(
+            "SELECT node_pair, node, count(*) FROM diff_rows GROUP BY node_pair, node"
+        ):
+            counts[node_pair][node] = rows
+
+        return counts
+
+    def rows(self, node_pair, node):
+        """Yields the rows of node in a node pair, in the order found"""
+
+        cur = self.conn.execute(
+            "SELECT row FROM diff_rows WHERE node_pair = ? AND node = ? "
+            "ORDER BY rowid",
+            (node_pair, node),
+        )
+
+        while True:
+            batch = cur.fetchmany(config.DIFF_SPILL_FETCH_ROWS)
+            if not batch:
+                break
+            for (row,) in batch:
+                yield json.loads(row)
+
+    def aligned_rows(self, node_pair, node1, node2):
+        """
+        Yields (row1, row2) for every primary key in a node pair, with None for
+        the side that does not have the row. Rows found on node1 come first,
+        in the order found, and then those found only on node2.
+        """
+
+        cur = self.conn.execute(
+            """
+            SELECT a.row, b.row, 1, a.rowid FROM diff_rows a
+            LEFT JOIN diff_rows b
+                ON b.node_pair = a.node_pair AND b.node = ? AND b.pkey = a.pkey
+            WHERE a.node_pair = ? AND a.node = ?
+            UNION ALL
+            SELECT NULL, b.row, 2, b.rowid FROM diff_rows b
+            WHERE b.node_pair = ? AND b.node = ? AND NOT EXISTS (
+                SELECT 1 FROM diff_rows a
+                WHERE a.node_pair = b.node_pair AND a.node = ? AND a.pkey = b.pkey
+            )
+            ORDER BY 3, 4
+            """,
+            (node2, node_pair, node1, node_pair, node2, node1),
+        )
+
+        while True:
+            batch = cur.fetchmany(config.DIFF_SPILL_FETCH_ROWS)
+            if not batch:
+                break
+            for row1, row2, _, _ in batch:
+                yield (
+                    json.loads(row1) if row1 is not None else None,
+                    json.loads(row2) if row2 is not None else None,
+                )
+
+    def items(self):
+        """
+        Yields (node_pair, {node: rows}) like the items of a diff dict, with
+        each node's rows as a generator
+        """
+
+        for node_pair, nodes in self.counts().items():
+            yield node_pair, {node: self.rows(node_pair, node) for node in nodes}
+
+    def as_dict(self) -> dict:
+        return {
+            node_pair: {node: list(rows) for node, rows in nodes_data.items()}
+            for node_pair, nodes_data in self.items()
+        }
+
+    def __bool__(self):
+        row = self.conn.execute("SELECT 1 FROM diff_rows LIMIT 1").fetchone()
+        return row is not None
+
+    def close(self) -> None:
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+    def remove(self) -> None:
+        self.close()
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(self.path + suffix)
+            except FileNotFoundError:
+                pass
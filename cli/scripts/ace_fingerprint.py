@@ -0,0 +1,237 @@
+"""
+Whole-table fingerprints for a quick yes/no comparison of tables across nodes.
+"""
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from hashlib import md5
+
+import psycopg
+from psycopg import sql
+
+import ace_config as config
+import ace_nodes
+import cluster
+
+sizes_sql = """
+SELECT n.nspname, c.relname,
+       pg_relation_size(c.oid) / current_setting('block_size')::int
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE (n.nspname, c.relname) IN (SELECT * FROM unnest(%s::text[], %s::text[]))
+"""
+
+
+def get_node_params(cluster_name, database, node_list, cluster_nodes=None) -> dict:
+    """
+    Returns {node name: connection parameters} for the nodes of a task. The
+    cluster_nodes of a task include the nodes it diffs from outside the cluster.
+    """
+
+    if cluster_nodes is None:
+        db, pg, node_info = cluster.load_json(cluster_name)
+        cluster_nodes = [{**database, **node} for node in node_info]
+
+    node_params = {}
+    for nd in cluster_nodes:
+        if nd["name"] not in node_list:
+            continue
+
+        node_params[nd["name"]] = ace_nodes.conn_params(
+            nd,
+            {
+                "dbname": nd["db_name"],
+                "user": nd["db_user"],
+                "password": nd["db_password"],
+                "host": nd["public_ip"],
+                "port": nd.get("port", 5432),
+                "options": f"-c statement_timeout={config.STATEMENT_TIMEOUT}",
+            },
+        )
+
+    return node_params
+
+
+def get_ranges(pages, max_ranges):
+    """Splits a table of the given number of pages into (start, end) blocks"""
+
+    n = min(max_ranges, max(pages // config.FINGERPRINT_RANGE_PAGES, 1))
+    bounds = [None] + [pages * i // n for i in range(1, n)] + [None]
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def fingerprint_query(schema_name, table_name, start, end):
+    table = sql.SQL("{}.{}").format(
+        sql.Identifier(schema_name), sql.Identifier(table_name)
+    )
+
+    conditions = []
+    if start is not None:
+        conditions.append(
+            sql.SQL("ctid >= {}::tid").format(sql.Literal(f"({start},0)"))
+        )
+    if end is not None:
+        conditions.append(sql.SQL("ctid < {}::tid").format(sql.Literal(f"({end},0)")))
+
+    where_clause = sql.SQL("")
+    if conditions:
+        where_clause = sql.SQL(" WHERE ") + sql.SQL(" AND ").join(conditions)
+
+    return sql.SQL(
+        "SELECT count(*), "
+        "coalesce(sum(hashtextextended(t::text, 0)::numeric), 0), "
+        "coalesce(sum(hashtextextended(t::text, 1)::numeric), 0) "
+        "FROM {table} t{where_clause}"
+    ).format(table=table, where_clause=where_clause)
+
+
+def plan_node(conn, tables, max_ranges) -> list:
+    """Returns the (table, query) work items for one node"""
+
+    # TID range scans need PostgreSQL 14. Older nodes hash every table in one
+    # sequential scan.
+    ranged = conn.info.server_version >= 140000
+
+    names = [table.split(".", 1) for table in tables]
+    rows = conn.execute(
+        sizes_sql, ([name[0] for name in names], [name[1] for name in names])
+    ).fetchall()
+    pages = {
+        f"{schema_name}.{table_name}": size for schema_name, table_name, size in rows
+    }
+
+    work = []
+    for table in tables:
+        schema_name, table_name = table.split(".", 1)
+        ranges = [(None, None)]
+        if ranged and pages.get(table):
+            ranges = get_ranges(pages[table], max_ranges)
+
+        for start, end in ranges:
+            query = fingerprint_query(schema_name, table_name, start, end)
+            work.append((table, query))
+
+    return work
+
+
+def fingerprint_tables(
+    task, tables, node_params, cancel_event, backend_pids, progress=None
+) -> dict:
+    """
+    Fingerprints every table in tables ("schema.table" names) on every node.
+
+    Args:
+        task: The running task. Its worker budget, if any, caps the number of
+            connections per node.
+        node_params: {node name: connection parameters}
+        cancel_event: Stops the workers once set.
+        backend_pids: A list that (host, port, backend_pid) tuples are appended
+            to for every connection, so that the task can cancel its queries.
+        progress: An optional TaskProgress, advanced by one block per range.
+
+    Returns:
+        {table: {node: {"rows": ..., "fingerprint": ...}}}. Tables that could
+        not be fingerprinted on some node have an "error" entry for that node
+        instead.
+    """
+
+    max_workers = config.FINGERPRINT_WORKERS_PER_NODE
+    if task.scheduler.worker_budget:
+        max_workers = min(max_workers, task.scheduler.worker_budget)
+    max_workers = max(max_workers, 1)
+
+    sums = {table: {node: [0, 0, 0] for node in node_params} for table in tables}
+    errors = {}
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def drain(node, params, work):
+        with psycopg.connect(**params, autocommit=True) as conn:
+            info = conn.info
+            backend_pids.append((info.host, str(info.port), info.backend_pid))
+
+            while not (cancel_event.is_set() or stop.is_set()):
+                try:
+                    table, query = work.get_nowait()
+                except queue.Empty:
+                    return
+
+                if table in errors.get(node, {}):
+                    continue
+
+                try:
+                    rows, hash1, hash2 = conn.execute(query).fetchone()
+                except Exception as e:
+                    if cancel_event.is_set():
+                        return
+                    with lock:
+                        errors.setdefault(node, {})[table] = str(e)
+                    continue
+
+                with lock:
+                    partial = sums[table][node]
+                    partial[0] += rows
+                    partial[1] += hash1
+                    partial[2] += hash2
+                    if progress:
+                        progress.rows_checked += rows
+                        progress.advance()
+
+    # Plan all nodes before any work starts
+    work_by_node = {}
+    for node, params in node_params.items():
+        with psycopg.connect(**params) as conn:
+            work_by_node[node] = plan_node(conn, tables, max_workers)
+
+        if progress:
+            progress.blocks_total += len(work_by_node[node])
+
+    futures = []
+    with ThreadPoolExecutor(max_workers=max_workers * len(node_params)) as executor:
+        for node, items in work_by_node.items():
+            work = queue.Queue()
+            for item in items:
+                work.put(item)
+
+            for _ in range(min(max_workers, len(items))):
+                futures.append(executor.submit(drain, node, node_params[node], work))
+
+        try:
+            pending = futures
+            while pending:
+                done, pending = wait(pending, timeout=1)
+                for future in done:
+                    if future.exception():
+                        raise future.exception()
+                if progress:
+                    progress.publish()
+        finally:
+            stop.set()
+
+    if progress:
+        progress.publish(force=True)
+
+    fingerprints = {}
+    for table in tables:
+        fingerprints[table] = {}
+        for node in node_params:
+            if table in errors.get(node, {}):
+                fingerprints[table][node] = {"error": errors[node][table]}
+                continue
+
+            rows, hash1, hash2 = sums[table][node]
+            digest = md5(f"{rows}:{hash1}:{hash2}".encode()).hexdigest()
+            fingerprints[table][node] = {"rows": rows, "fingerprint": digest}
+
+    return fingerprints
+
+
+def fingerprints_match(table_fingerprints) -> bool:
+    """True if a table was fingerprinted on every node, with equal results"""
+
+    if any("error" in fp for fp in table_fingerprints.values()):
+        return False
+
+    return len({fp["fingerprint"] for fp in table_fingerprints.values()}) == 1
@@ -0,0 +1,126 @@
+"""
+Temp tables of primary keys, for re-checking the rows of a diff file.
+"""
+
+from psycopg import sql
+from psycopg.pq import Format
+
+KEY_TABLE = "ace_diff_keys"
+
+
+def create_key_table(conn, key_cols, key_types, table_name=KEY_TABLE) -> list:
+    """
+    Creates the temp table of keys on the node that conn is connected to, and
+    returns the type oids of its columns.
+
+    Args:
+        key_cols: The primary key columns, in order.
+        key_types: {column: type} as returned by ace.get_row_types().
+    """
+
+    conn.execute(
+        sql.SQL("CREATE TEMP TABLE IF NOT EXISTS {table} ({cols})").format(
+            table=sql.Identifier(table_name),
+            cols=sql.SQL(", ").join(
+                sql.SQL("{} {}").format(sql.Identifier(col), sql.SQL(key_types[col]))
+                for col in key_cols
+            ),
+        )
+    )
+
+    oids = conn.execute(
+        "SELECT atttypid::int FROM pg_catalog.pg_attribute "
+        "WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped "
+        "ORDER BY attnum",
+        (f"pg_temp.{table_name}",),
+    ).fetchall()
+
+    return [oid for (oid,) in oids]
+
+
+def as_text(value) -> str:
+    """The PostgreSQL text form of a key value read from a diff file"""
+
+    if isinstance(value, bool):
+        return "t" if value else "f"
+
+    return str(value)
+
+
+def load_keys(conn, key_cols, oids, keys, table_name=KEY_TABLE) -> None:
+    """
+    Replaces the contents of the temp table of keys with keys: scalars for a
+    simple primary key, tuples for a composite one. Commits, so that the
+    connection does not hold a transaction open between batches.
+    """
+
+    adapters = conn.adapters
+    binary = True
+    loaders = []
+    for oid in oids:
+        try:
+            adapters.get_dumper_by_oid(oid, Format.BINARY)
+        except Exception:
+            binary = False
+        loader = adapters.get_loader(oid, Format.TEXT)
+        loaders.append(loader(oid, conn) if loader else None)
+
+    if len(key_cols) == 1:
+        keys = [(key,) for key in keys]
+
+    copy_sql = sql.SQL("COPY {table} ({cols}) FROM STDIN (FORMAT {format})").format(
+        table=sql.Identifier(table_name),
+        cols=sql.SQL(", ").join(sql.Identifier(col) for col in key_cols),
+        format=sql.SQL("BINARY" if binary else "TEXT"),
+    )
+
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("TRUNCATE {}").format(sql.Identifier(table_name)))
+
+        with cur.copy(copy_sql) as copy:
+            if binary:
+                copy.set_types(oids)
+
+            for key in keys:
+                row = [as_text(value) for value in key]
+                if binary:
+                    row = [
+                        loader.load(value.encode()) if loader else value
+                        for loader, value in zip(loaders, row)
+                    ]
+                copy.write_row(row)
+
+    conn.commit()
+
+
+def key_array_filter(key_cols, key_types, keys) -> tuple:
+    """
+    A WHERE condition matching the rows with the given keys, passed as one
+    array parameter per key column, and its parameters. For read-only nodes,
+    which cannot create the temp table.
+    """
+
+    if len(key_cols) == 1:
+        keys = [(key,) for key in keys]
+
+    cols = sql.SQL(", ").join(sql.Identifier(col) for col in key_cols)
+    arrays = sql.SQL(", ").join(
+        sql.SQL("%s::text[]::{}[]").format(sql.SQL(key_types[col])) for col in key_cols
+    )
+    params = [[as_text(key[i]) for key in keys] for i in range(len(key_cols))]
+
+    condition = sql.SQL("({cols}) IN (SELECT * FROM unnest({arrays}))").format(
+        cols=cols, arrays=arrays
+    )
+
+    return condition, params
+
+
+def key_filter(key_cols, table_name=KEY_TABLE) -> sql.Composable:
+    """A WHERE condition matching the rows whose keys are in the temp table"""
+
+    cols = sql.SQL(", ").join(sql.Identifier(col) for col in key_cols)
+
+    return sql.SQL("({cols}) IN (SELECT {cols} FROM pg_temp.{table})").format(
+        cols=cols, table=sql.Identifier(table_name)
+    )
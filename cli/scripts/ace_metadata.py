@@ -0,0 +1,124 @@
+"""
+Cache of table metadata (columns, primary key and column types) on the nodes
+of a cluster.
+"""
+
+import time
+
+import ace_config as config
+import ace_db
+
+markers_sql = """
+SELECT c.relname,
+       c.oid::bigint,
+       concat_ws(
+           ':',
+           c.xmin::text,
+           (SELECT string_agg(a.xmin::text, ',' ORDER BY a.attnum)
+            FROM pg_catalog.pg_attribute a
+            WHERE a.attrelid = c.oid AND a.attnum > 0),
+           (SELECT string_agg(i.xmin::text, ',')
+            FROM pg_catalog.pg_index i
+            WHERE i.indrelid = c.oid AND i.indisprimary)
+       )
+FROM pg_catalog.pg_class c
+JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+WHERE n.nspname = %s
+AND c.relkind IN ('r', 'p')
+"""
+
+metadata_sql = """
+SELECT c.relname,
+       ARRAY(SELECT a.attname::text
+             FROM pg_catalog.pg_attribute a
+             WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+             ORDER BY a.attnum),
+       ARRAY(SELECT pg_catalog.format_type(a.atttypid, a.atttypmod)
+             FROM pg_catalog.pg_attribute a
+             WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+             ORDER BY a.attnum),
+       ARRAY(SELECT a.attname::text
+             FROM pg_catalog.pg_index i
+             JOIN pg_catalog.pg_attribute a
+             ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey::int2[])
+             WHERE i.indrelid = c.oid AND i.indisprimary
+             ORDER BY array_position(i.indkey::int2[], a.attnum))
+FROM pg_catalog.pg_class c
+JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+WHERE n.nspname = %s
+AND c.relname = ANY(%s)
+"""
+
+# {(node, schema): (monotonic time of the marker check, {table: metadata})}
+schema_cache = {}
+
+
+def node_of(conn) -> str:
+    info = conn.info
+    return f"{info.user}@{info.host}:{info.port}/{info.dbname}"
+
+
+def fetch_schema(conn, node, schema) -> dict:
+    """
+    Returns the metadata of every table in the schema, refetching only the
+    tables whose oid or change marker differs from the task store
+    """
+
+    current = {
+        table: (relid, marker)
+        for table, relid, marker in conn.execute(markers_sql, (schema,)).fetchall()
+    }
+    cached = ace_db.get_table_metadata(node, schema)
+
+    tables = {}
+    stale = []
+    for table, (relid, marker) in current.items():
+        entry = cached.get(table)
+        if entry and (entry["relid"], entry["marker"]) == (relid, marker):
+            tables[table] = entry
+        else:
+            stale.append(table)
+
+    if stale:
+        fetched = []
+        for table, cols, types, key in conn.execute(
+            metadata_sql, (schema, stale)
+        ).fetchall():
+            relid, marker = current[table]
+            entry = {
+                "relid": relid,
+                "marker": marker,
+                "cols": cols,
+                "types": dict(zip(cols, types)),
+                "key": key,
+            }
+            tables[table] = entry
+            fetched.append((table, entry))
+
+        ace_db.store_table_metadata(node, schema, fetched)
+
+    dropped = [table for table in cached if table not in current]
+    if dropped:
+        ace_db.delete_table_metadata(node, schema, dropped)
+
+    return tables
+
+
+def get_table_metadata(conn, schema, table):
+    """
+    Returns {"cols": [...], "key": [...], "types": {col: type}} for the table
+    on the node that conn is connected to, or None if there is no such table
+    """
+
+    node = node_of(conn)
+    checked_at, tables = schema_cache.get((node, schema), (None, None))
+
+    if checked_at is not None and table in tables:
+        if time.monotonic() - checked_at < config.METADATA_CACHE_TTL:
+            return tables[table]
+
+    tables = fetch_schema(conn, node, schema)
+    schema_cache[(node, schema)] = (time.monotonic(), tables)
+
+    return tables.get(table)
+
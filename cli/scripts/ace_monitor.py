@@ -0,0 +1,257 @@
+"""
+Continuous consistency monitor, which re-checks the tables of a cluster that
+have had writes since they were last verified.
+"""
+
+import signal
+import threading
+from datetime import datetime, timedelta
+
+import ace
+import ace_config as config
+import ace_connections
+import ace_core
+import ace_db
+import ace_watermarks
+import cluster
+import util
+from ace_data_models import TableDiffTask
+from ace_exceptions import AceException
+
+
+class ConsistencyMonitor:
+    def __init__(
+        self,
+        cluster_name,
+        dbname=None,
+        nodes="all",
+        interval=config.MONITOR_INTERVAL,
+        reverify_hours=config.MONITOR_REVERIFY_HOURS,
+        block_rows=config.BLOCK_ROWS_DEFAULT,
+        max_cpu_ratio=config.MAX_CPU_RATIO_DEFAULT,
+        batch_size=config.BATCH_SIZE_DEFAULT,
+        low_impact=False,
+        max_rows_per_sec=None,
+        max_mb_per_sec=None,
+        quiet_mode=False,
+    ):
+        self.cluster_name = cluster_name
+        self.dbname = dbname
+        self.nodes = nodes
+        self.interval = interval
+        self.reverify_hours = reverify_hours
+        self.block_rows = block_rows
+        self.max_cpu_ratio = max_cpu_ratio
+        self.batch_size = batch_size
+        self.low_impact = low_impact
+        self.max_rows_per_sec = max_rows_per_sec
+        self.max_mb_per_sec = max_mb_per_sec
+        self.quiet_mode = quiet_mode
+
+        self.node_params = self.get_node_params()
+        self._stop = threading.Event()
+
+    def get_node_params(self) -> dict:
+        if not ace.check_cluster_exists(self.cluster_name):
+            raise AceException(f"Cluster {self.cluster_name} not found")
+
+        db, pg, node_info = cluster.load_json(self.cluster_name)
+
+        database = db[0]
+        if self.dbname:
+            database = next((d for d in db if d["db_name"] == self.dbname), None)
+
+        if not database:
+            raise AceException(
+                f"Database '{self.dbname}' not found in cluster '{self.cluster_name}'"
+            )
+
+        # Watermarks are kept per database, so the default one is named too
+        self.dbname = database["db_name"]
+
+        node_list = ace.parse_nodes(self.nodes)
+        node_params = {}
+
+        for node in node_info:
+            if node_list and node["name"] not in node_list:
+                continue
+
+            nd = {**database, **node}
+            node_params[nd["name"]] = {
+                "dbname": nd["db_name"],
+                "user": nd["db_user"],
+                "password": nd["db_password"],
+                "host": nd["public_ip"],
+                "port": nd.get("port", 5432),
+                "options": f"-c statement_timeout={config.STATEMENT_TIMEOUT}",
+            }
+
+        if len(node_params) < 2:
+            raise AceException("The monitor needs at least two nodes to compare")
+
+        return node_params
+
+    def get_tables(self) -> list:
+        # Any one node will do, as with repset-diff
+        params = next(iter(self.node_params.values()))
+        conn = ace_connections.get_node_conn(params)
+
+        rows = conn.execute(
+            "SELECT DISTINCT concat_ws('.', nspname, relname) FROM spock.tables "
+            "ORDER BY 1"
+        ).fetchall()
+
+        return [row[0] for row in rows]
+
+    def get_write_counters(self) -> dict:
+        """Returns {table: {node: write counters}}, see ace_watermarks"""
+
+        return ace_watermarks.get_write_counters(self.node_params)
+
+    def plan_cycle(self, tables, counters, watermarks) -> list:
+        """
+        Returns the (table, writes since last verified) pairs to check in this
+        cycle, most urgent first
+        """
+
+        reverify_before = datetime.now() - timedelta(hours=self.reverify_hours)
+        plan = []
+
+        for table in tables:
+            watermark = watermarks.get(table)
+            current = counters.get(table, {})
+
+            if not watermark or not watermark["last_verified_at"]:
+                # Never verified: check first
+                plan.append((table, None, 0))
+                continue
+
+            writes = ace_watermarks.writes_since(watermark["write_counters"], current)
+            unknown = writes is None
+            if unknown:
+                # Stats were reset, or a node was not verified before: count
+                # all tuples as written
+                writes = sum(
+                    ace_watermarks.total_writes(counts) for counts in current.values()
+                )
+
+            clean = (
+                watermark["last_status"] == "COMPLETED" and not watermark["mismatch"]
+            )
+            last_verified = datetime.fromisoformat(watermark["last_verified_at"])
+            fresh = last_verified > reverify_before
+
+            if clean and fresh and not unknown and writes == 0:
+                continue
+
+            # Drifted or failed tables come right after unverified ones
+            plan.append((table, writes, 1 if clean else 0))
+
+        def urgency(item):
+            table, writes, clean = item
+            return (writes is not None, clean, -(writes or 0))
+
+        return [(table, writes) for table, writes, _ in sorted(plan, key=urgency)]
+
+    def check_table(self, table, write_counters) -> TableDiffTask:
+        td_task = TableDiffTask(
+            cluster_name=self.cluster_name,
+            _table_name=table,
+            _dbname=self.dbname,
+            block_rows=self.block_rows,
+            max_cpu_ratio=self.max_cpu_ratio,
+            output="json",
+            _nodes=self.nodes,
+            batch_size=self.batch_size,
+            quiet_mode=self.quiet_mode,
+            low_impact=self.low_impact,
+            max_rows_per_sec=self.max_rows_per_sec,
+            max_mb_per_sec=self.max_mb_per_sec,
+        )
+        td_task.scheduler.task_id = ace_db.generate_task_id()
+        td_task.scheduler.task_type = "table-diff"
+        td_task.scheduler.task_status = "RUNNING"
+        td_task.scheduler.started_at = datetime.now()
+
+        try:
+            td_task = ace.table_diff_checks(td_task)
+        except Exception as e:
+            td_task.scheduler.task_status = "FAILED"
+            td_task.scheduler.finished_at = datetime.now()
+            td_task.scheduler.task_context = {"errors": [str(e)]}
+            ace_db.record_table_check(self.cluster_name, self.dbname, table, td_task)
+            raise
+
+        ace_db.create_ace_task(task=td_task)
+
+        try:
+            ace_core.table_diff(td_task)
+        finally:
+            context = td_task.scheduler.task_context
+            diff_rows = context.get("diff_rows") if isinstance(context, dict) else None
+            ace_db.record_table_check(
+                self.cluster_name,
+                self.dbname,
+                table,
+                td_task,
+                diff_rows,
+                write_counters,
+            )
+
+        return td_task
+
+    def run_cycle(self) -> None:
+        cycle_start = datetime.now()
+        tables = self.get_tables()
+        counters = self.get_write_counters()
+        watermarks = ace_db.get_table_watermarks(self.cluster_name, self.dbname)
+        plan = self.plan_cycle(tables, counters, watermarks)
+
+        util.message(
+            f"Monitor cycle: {len(plan)} of {len(tables)} tables to check, "
+            f"{len(tables) - len(plan)} unchanged since last verified",
+            p_state="info",
+        )
+
+        for table, writes in plan:
+            if self._stop.is_set():
+                break
+
+            if writes is None:
+                reason = "never verified"
+            else:
+                reason = f"{writes} writes since last verified"
+
+            util.message(f"\nCHECKING TABLE {table} ({reason})", p_state="info")
+
+            try:
+                td_task = self.check_table(table, counters.get(table))
+                util.message(
+                    f"{table}: {td_task.scheduler.task_status}, "
+                    f"mismatch={td_task.scheduler.task_context.get('mismatch')}",
+                    p_state="info",
+                )
+            except Exception as e:
+                util.message(f"{table}: check failed with: {str(e)}", p_state="warning")
+
+        run_time = util.round_timedelta(datetime.now() - cycle_start).total_seconds()
+        util.message(f"Monitor cycle done in {run_time:.2f} seconds", p_state="info")
+
+    def stop(self, *_) -> None:
+        util.message("Stopping the monitor after the current table", p_state="warning")
+        self._stop.set()
+
+    def run(self, once=False) -> None:
+        ace_connections.enable_persistent_connections()
+        signal.signal(signal.SIGTERM, self.stop)
+
+        try:
+            while not self._stop.is_set():
+                self.run_cycle()
+
+                if once:
+                    break
+
+                self._stop.wait(self.interval)
+        finally:
+            ace_connections.close_all()
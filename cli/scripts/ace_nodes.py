@@ -0,0 +1,109 @@
+"""
+Nodes from outside the cluster of a diff: <cluster>:<node>, or names given to
+DSNs with --dsns.
+"""
+
+import json
+
+from psycopg.conninfo import conninfo_to_dict
+
+import ace
+import cluster
+from ace_exceptions import AceException
+
+
+def parse_dsns(dsns) -> dict:
+    """Returns {name: DSN}, from a dict or its JSON"""
+
+    if not dsns:
+        return {}
+
+    if isinstance(dsns, str):
+        try:
+            dsns = json.loads(dsns)
+        except json.JSONDecodeError as e:
+            raise AceException(f"DSNs should be a JSON object of name: DSN: {e}")
+
+    if not isinstance(dsns, dict):
+        raise AceException("DSNs should be a JSON object of name: DSN")
+
+    for name in dsns:
+        if not name or any(c in name for c in "/,:"):
+            raise AceException(f"Invalid DSN name '{name}'")
+
+    return dsns
+
+
+def cluster_node(ref, database) -> dict:
+    cluster_name, node_name = ref.split(":", 1)
+
+    if not ace.check_cluster_exists(cluster_name):
+        raise AceException(f"Cluster {cluster_name} not found")
+
+    db, pg, node_info = cluster.load_json(cluster_name)
+
+    other_db = next(
+        (entry for entry in db if entry["db_name"] == database["db_name"]), None
+    )
+    if not other_db:
+        raise AceException(
+            f"Database '{database['db_name']}' not found in cluster '{cluster_name}'"
+        )
+
+    node = next((node for node in node_info if node["name"] == node_name), None)
+    if not node:
+        raise AceException(f"Node '{node_name}' not found in cluster '{cluster_name}'")
+
+    return {**other_db, **node, "name": ref}
+
+
+def dsn_node(name, dsn, database) -> dict:
+    try:
+        info = conninfo_to_dict(dsn)
+    except Exception as e:
+        raise AceException(f"Invalid DSN for node '{name}': {e}")
+
+    return {
+        **database,
+        "name": name,
+        "db_name": info.pop("dbname", database["db_name"]),
+        "db_user": info.pop("user", database["db_user"]),
+        "db_password": info.pop("password", database.get("db_password")),
+        "public_ip": info.pop("host", "localhost"),
+        "port": info.pop("port", 5432),
+        # sslmode, connect_timeout and any other parameters of the DSN
+        "conninfo": info,
+    }
+
+
+def conn_params(node, params) -> dict:
+    """
+    Adds the parameters of a node's DSN that have no field of their own to its
+    connection parameters
+    """
+
+    conninfo = dict(node.get("conninfo") or {})
+    if not conninfo:
+        return params
+
+    options = conninfo.pop("options", None)
+    if options:
+        conninfo["options"] = f"{params['options']} {options}".strip()
+
+    return {**params, **conninfo}
+
+
+def external_nodes(database, node_list, dsns) -> list:
+    """
+    Returns the entries of the nodes in node_list that are not in the cluster of
+    the diff, merged with their database like the nodes of the cluster are
+    """
+
+    nodes = []
+    for name in node_list:
+        if name in dsns:
+            nodes.append(dsn_node(name, dsns[name], database))
+        elif ":" in name:
+            nodes.append(cluster_node(name, database))
+
+    return nodes
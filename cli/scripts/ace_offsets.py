@@ -0,0 +1,98 @@
+"""
+Block boundaries of a table-diff.
+"""
+
+from array import array
+
+from psycopg import sql
+
+import ace_config as config
+
+INT64_MIN = -(2**63)
+INT64_MAX = 2**63 - 1
+
+
+class BlockOffsets:
+    """The first primary key of every block of a table, in key order"""
+
+    def __init__(self, key_cols):
+        self.simple = len(key_cols) == 1
+        self.columns = [array("q") for _ in key_cols]
+
+    def append(self, key) -> None:
+        for i, value in enumerate(key):
+            column = self.columns[i]
+            if isinstance(column, array):
+                if type(value) is int and INT64_MIN <= value <= INT64_MAX:
+                    column.append(value)
+                    continue
+
+                # Not an int64 column after all
+                column = self.columns[i] = list(column)
+
+            column.append(value)
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def key(self, i):
+        if self.simple:
+            return self.columns[0][i]
+
+        return tuple(column[i] for column in self.columns)
+
+    @property
+    def blocks(self) -> int:
+        # The first block is open below, and the last one above
+        return len(self) + 1
+
+    def block(self, i) -> tuple:
+        """Returns the (start, end) keys of block i, with None for an open end"""
+
+        start = self.key(i - 1) if i > 0 else None
+        end = self.key(i) if i < len(self) else None
+
+        return start, end
+
+    def batches(self, batch_size) -> list:
+        """Returns the (first, last + 1) block numbers of every batch"""
+
+        return [
+            (first, min(first + batch_size, self.blocks))
+            for first in range(0, self.blocks, batch_size)
+        ]
+
+
+def offsets_sql(schema_name, table_name, key_cols, block_rows) -> sql.Composable:
+    keys = sql.SQL(", ").join(sql.Identifier(col) for col in key_cols)
+
+    return sql.SQL(
+        "SELECT {keys} FROM ("
+        "SELECT {keys}, row_number() OVER (ORDER BY {keys}) AS ace_row "
+        "FROM {table}) t "
+        "WHERE (ace_row - 1) % {block_rows} = 0"
+    ).format(
+        keys=keys,
+        table=sql.Identifier(schema_name, table_name),
+        block_rows=sql.Literal(block_rows),
+    )
+
+
+def get_block_offsets(conn, schema_name, table_name, key_cols, block_rows):
+    """Reads the block boundaries of a table from one node"""
+
+    offsets = BlockOffsets(key_cols)
+
+    # Server-side cursors only live inside a transaction
+    with conn.transaction():
+        with conn.cursor(name="ace_block_offsets") as cur:
+            cur.execute(offsets_sql(schema_name, table_name, key_cols, block_rows))
+
+            while True:
+                rows = cur.fetchmany(config.BLOCK_OFFSETS_FETCH_ROWS)
+                if not rows:
+                    break
+                for row in rows:
+                    offsets.append(row)
+
+    return offsets
@@ -0,0 +1,147 @@
+"""
+Live progress reporting for running ACE tasks.
+"""
+
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import ace_config as config
+import ace_db
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+
+    if not sorted_values:
+        return None
+
+    rank = max(int(round(pct / 100 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+class TaskProgress:
+    def __init__(
+        self,
+        task,
+        blocks_total,
+        node_pairs=1,
+        phase="diff",
+        publish_interval=config.PROGRESS_PUBLISH_INTERVAL,
+    ):
+        self.task = task
+        self.phase = phase
+        self.blocks_total = blocks_total
+        self.node_pairs = max(node_pairs, 1)
+        self.publish_interval = publish_interval
+
+        self.table = None
+        fields = getattr(task, "fields", None)
+        if fields and fields.l_schema and fields.l_table:
+            self.table = f"{fields.l_schema}.{fields.l_table}"
+
+        self.comparisons_done = 0
+        self.mismatched_blocks = 0
+        self.rows_checked = 0
+        self.node_rows = defaultdict(int)
+        self.bytes_fetched = 0
+        self.latencies = defaultdict(list)
+        self.counters = {}
+        self.values = {}
+
+        self.started = time.monotonic()
+        self.last_published = 0.0
+        self.results_seen = 0
+
+    def consume(self, result_queue) -> None:
+        """Fold in result dicts appended to result_queue since the last call"""
+
+        new_results = result_queue[self.results_seen :]
+        self.results_seen += len(new_results)
+
+        for result in new_results:
+            self.comparisons_done += 1
+
+            if result["status_code"] == config.BLOCK_MISMATCH:
+                self.mismatched_blocks += 1
+
+            stats = result.get("stats")
+            if not stats:
+                continue
+
+            self.rows_checked += sum(stats["rows"].values())
+            for node, rows in stats["rows"].items():
+                self.node_rows[node] += rows
+            self.bytes_fetched += stats["bytes"]
+            for node, latency in stats["latency"].items():
+                self.latencies[node].append(latency)
+
+    def add(self, **counters) -> None:
+        """Increments free-form counters, e.g. rows upserted by a repair"""
+
+        for name, value in counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, **values) -> None:
+        """Sets free-form values, e.g. the throttle state of a low-impact diff"""
+
+        self.values.update(values)
+
+    def advance(self, blocks=1) -> None:
+        self.comparisons_done += blocks * self.node_pairs
+
+    def snapshot(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        blocks_done = min(self.comparisons_done // self.node_pairs, self.blocks_total)
+
+        eta = None
+        if 0 < blocks_done < self.blocks_total:
+            eta = round(elapsed / blocks_done * (self.blocks_total - blocks_done), 1)
+        elif blocks_done >= self.blocks_total:
+            eta = 0.0
+
+        latency = {}
+        for node, values in self.latencies.items():
+            values = sorted(values)
+            # Seconds, rounded to the nearest tenth of a millisecond
+            latency[node] = {
+                "p50": round(percentile(values, 50), 4),
+                "p95": round(percentile(values, 95), 4),
+                "p99": round(percentile(values, 99), 4),
+                "max": round(values[-1], 4),
+            }
+
+        snapshot = {
+            "phase": self.phase,
+            "table": self.table,
+            "blocks_done": blocks_done,
+            "blocks_total": self.blocks_total,
+            "mismatched_blocks": self.mismatched_blocks,
+            "rows_checked": self.rows_checked,
+            "rows_per_sec": round(self.rows_checked / elapsed, 1) if elapsed else None,
+            "bytes_fetched": self.bytes_fetched,
+            "query_latency": latency,
+            "elapsed": round(elapsed, 1),
+            "eta": eta,
+            "updated_at": datetime.now().isoformat(timespec="milliseconds"),
+        }
+        snapshot.update(self.counters)
+        snapshot.update(self.values)
+
+        return snapshot
+
+    def publish(self, force=False) -> None:
+        """
+        Writes a snapshot into the task record, at most once every
+        publish_interval seconds unless force is True
+        """
+
+        if not self.task.scheduler.task_id:
+            return
+
+        now = time.monotonic()
+        if not force and now - self.last_published < self.publish_interval:
+            return
+
+        self.last_published = now
+        ace_db.update_ace_task_progress(self.task.scheduler.task_id, self.snapshot())
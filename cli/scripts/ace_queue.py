@@ -0,0 +1,219 @@
+"""
+Admission control for jobs submitted through the ACE API.
+"""
+
+import heapq
+import itertools
+import threading
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Callable
+
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_EXECUTED
+
+import ace
+import ace_config as config
+import ace_db
+from ace_exceptions import AceException
+
+
+@dataclass(order=True)
+class QueuedJob:
+    # (-priority, sequence number), so that higher priorities are popped first
+    # and jobs with equal priority are popped in submission order
+    sort_key: tuple
+    task_id: str = field(compare=False)
+    cluster_name: str = field(compare=False)
+    func: Callable = field(compare=False)
+    task: Any = field(compare=False)
+    queued_at: datetime = field(compare=False)
+
+
+class JobQueue:
+    def __init__(
+        self,
+        scheduler,
+        max_running=config.MAX_RUNNING_JOBS,
+        max_running_per_cluster=config.MAX_RUNNING_JOBS_PER_CLUSTER,
+        cpu_budget=config.JOB_CPU_BUDGET,
+        connection_budget=config.JOB_CONNECTION_BUDGET,
+    ):
+        self.scheduler = scheduler
+        self.max_running = max(1, max_running)
+        self.max_running_per_cluster = max(1, max_running_per_cluster)
+
+        # Each worker process holds one connection per node, so the worker
+        # budget of a job is also its connection budget
+        self.job_budget = max(
+            1, min(cpu_budget, connection_budget) // self.max_running
+        )
+
+        self._pending = []
+        self._running = {}
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+        scheduler.add_listener(self._job_finished, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
+
+    def submit(self, func, task, priority=config.JOB_PRIORITY_DEFAULT) -> dict:
+        """
+        Queue func(task) for execution and return the queue position of the task
+        """
+
+        now = datetime.now()
+        task.scheduler.task_status = "QUEUED"
+        task.scheduler.priority = priority
+        task.scheduler.queued_at = now
+        ace_db.create_ace_task(task=task)
+
+        job = QueuedJob(
+            sort_key=(-priority, next(self._sequence)),
+            task_id=task.scheduler.task_id,
+            cluster_name=task.cluster_name,
+            func=func,
+            task=task,
+            queued_at=now,
+        )
+
+        with self._lock:
+            heapq.heappush(self._pending, job)
+            self._dispatch()
+
+        return self.queue_info(task.scheduler.task_id)
+
+    def cancel(self, task_id) -> str:
+        """
+        Cancels a task. A task that is still waiting in the queue is removed from
+        it and marked as cancelled right away. A running task is asked to stop,
+        which it does at its next check for cancel requests.
+
+        Returns:
+            The status of the task after the call: "CANCELLED" or "CANCELLING".
+
+        Raises:
+            AceException: If the task is not queued or running, or if it is
+                running but cannot be cancelled.
+        """
+
+        with self._lock:
+            job = next((job for job in self._pending if job.task_id == task_id), None)
+            if job:
+                self._pending.remove(job)
+                heapq.heapify(self._pending)
+
+        if job:
+            self._cancel_queued(job)
+            return "CANCELLED"
+
+        ace.cancel_task_checks(task_id)
+        if not ace_db.request_ace_task_cancel(task_id):
+            raise AceException(f"Task {task_id} is not queued or running")
+
+        return "CANCELLING"
+
+    def queue_info(self, task_id=None) -> dict:
+        """
+        Returns the current state of the queue. If task_id is still waiting in the
+        queue, its position and the time it has waited so far are included as well.
+        """
+
+        now = datetime.now()
+
+        with self._lock:
+            info = {
+                "queue_depth": len(self._pending),
+                "running_jobs": len(self._running),
+                "max_running_jobs": self.max_running,
+                "max_running_jobs_per_cluster": self.max_running_per_cluster,
+                "job_worker_budget": self.job_budget,
+            }
+
+            for position, job in enumerate(sorted(self._pending), start=1):
+                if job.task_id == task_id:
+                    info["queue_position"] = position
+                    info["wait_time"] = (now - job.queued_at).total_seconds()
+                    break
+
+        return info
+
+    def _dispatch(self) -> None:
+        # Must be called with self._lock held
+        running_per_cluster = Counter(
+            job.cluster_name for job in self._running.values()
+        )
+        held_back = []
+        admitted = []
+
+        while self._pending and len(self._running) + len(admitted) < self.max_running:
+            job = heapq.heappop(self._pending)
+
+            # The task may have been cancelled from the CLI while it was queued
+            if ace_db.is_ace_task_cancel_requested(job.task_id):
+                self._cancel_queued(job)
+                continue
+
+            # A busy cluster must not block jobs for other clusters that are
+            # further down the queue
+            if running_per_cluster[job.cluster_name] >= self.max_running_per_cluster:
+                held_back.append(job)
+                continue
+
+            running_per_cluster[job.cluster_name] += 1
+            admitted.append(job)
+
+        for job in held_back:
+            heapq.heappush(self._pending, job)
+
+        if not admitted:
+            return
+
+        now = datetime.now()
+        for job in admitted:
+            task = job.task
+            task.scheduler.task_status = "RUNNING"
+            task.scheduler.started_at = now
+            task.scheduler.wait_time = (now - job.queued_at).total_seconds()
+            task.scheduler.worker_budget = self.job_budget
+
+        ace_db.start_queued_ace_tasks([job.task for job in admitted])
+
+        for job in admitted:
+            self._start(job)
+
+    def _cancel_queued(self, job: QueuedJob) -> None:
+        job.task.scheduler.started_at = datetime.now()
+        ace.handle_task_cancellation(
+            job.task, "cancelled by user while queued", {"errors": []}
+        )
+
+    def _start(self, job: QueuedJob) -> None:
+        task = job.task
+        self._running[job.task_id] = job
+
+        try:
+            self.scheduler.add_job(
+                job.func,
+                args=(task,),
+                id=job.task_id,
+                misfire_grace_time=None,
+            )
+        except Exception as e:
+            del self._running[job.task_id]
+            ace.handle_task_exception(
+                task, {"errors": [f"Could not schedule task: {str(e)}"]}
+            )
+
+    def _job_finished(self, event) -> None:
+        with self._lock:
+            job = self._running.pop(event.job_id, None)
+            self._dispatch()
+
+        if not job or not event.exception:
+            return
+
+        # Tasks record their own failures. If the task is still marked as
+        # running, the worker died before it could do so.
+        task_details = ace_db.get_ace_task_by_id(event.job_id)
+        if task_details and task_details["task_status"] == "RUNNING":
+            ace.handle_task_exception(job.task, {"errors": [str(event.exception)]})
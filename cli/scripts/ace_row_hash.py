@@ -0,0 +1,282 @@
+"""
+Row-hash indexes, for verifying critical tables without scanning them.
+"""
+
+import hashlib
+from contextlib import contextmanager
+
+from psycopg import sql
+
+schema_sql = """
+CREATE SCHEMA IF NOT EXISTS ace;
+CREATE TABLE IF NOT EXISTS ace.row_hash_tables (
+    table_name TEXT PRIMARY KEY,
+    blocks INTEGER NOT NULL,
+    installed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE TABLE IF NOT EXISTS ace.row_hash_blocks (
+    table_name TEXT NOT NULL,
+    block_id INTEGER NOT NULL,
+    row_count BIGINT NOT NULL,
+    hash BIGINT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS row_hash_blocks_table
+    ON ace.row_hash_blocks (table_name, block_id);
+"""
+
+# With auto-DDL, Spock adds new tables to a replication set. The summaries of
+# a node must describe its own rows only, so the ace tables are kept out of
+# every replication set.
+remove_from_repsets_sql = """
+SELECT spock.repset_remove_table(s.set_name, t.set_reloid)
+FROM spock.replication_set s
+JOIN spock.replication_set_table t ON t.set_id = s.set_id
+WHERE t.set_reloid IN ('ace.row_hash_tables'::regclass,
+                       'ace.row_hash_blocks'::regclass)
+"""
+
+# The text of a row depends on these settings. Every row is hashed with them
+# pinned, so that a change hashed by one session is undone by the next.
+row_text_settings = {
+    "timezone": "UTC",
+    "datestyle": "ISO, MDY",
+    "intervalstyle": "postgres",
+    "extra_float_digits": "1",
+    "bytea_output": "hex",
+}
+
+
+def spock_major_version(conn) -> int:
+    row = conn.execute(
+        "SELECT extversion FROM pg_extension WHERE extname = 'spock'"
+    ).fetchone()
+
+    return int(row[0].split(".")[0]) if row else 0
+
+
+@contextmanager
+def local_transaction(conn):
+    """
+    A transaction whose DDL and writes are not replicated by Spock, if the
+    node runs it
+    """
+
+    with conn.transaction():
+        spock = spock_major_version(conn) >= 4
+        if spock:
+            conn.execute(
+                "SELECT set_config('spock.enable_ddl_replication', 'off', true)"
+            )
+            conn.execute("SELECT spock.repair_mode(true)")
+
+        yield spock
+
+        if spock:
+            conn.execute("SELECT spock.repair_mode(false)")
+
+
+def function_name(table) -> str:
+    # Qualified table names can exceed the length of an identifier
+    return "row_hash_" + hashlib.md5(table.encode()).hexdigest()[:16]
+
+
+def block_id(row, key_cols, blocks) -> sql.Composable:
+    """The block of a row, from the hash of its primary key"""
+
+    key = sql.SQL("ROW({})::text").format(
+        sql.SQL(", ").join(sql.Identifier(row, col) for col in key_cols)
+    )
+
+    return sql.SQL("mod(mod(hashtextextended({key}, 0), {n}) + {n}, {n})").format(
+        key=key, n=sql.Literal(blocks)
+    )
+
+
+def trigger_function_sql(schema_name, table_name, key_cols, blocks):
+    table = f"{schema_name}.{table_name}"
+
+    return sql.SQL(
+        """
+CREATE OR REPLACE FUNCTION ace.{function}() RETURNS trigger
+LANGUAGE plpgsql {settings} AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        DELETE FROM ace.row_hash_blocks WHERE table_name = {table};
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO ace.row_hash_blocks
+        VALUES ({table}, {old_block}, -1, hashtextextended(OLD::text, 0));
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO ace.row_hash_blocks
+        VALUES ({table}, {new_block}, 1, hashtextextended(NEW::text, 0));
+    END IF;
+    RETURN NULL;
+END
+$$
+"""
+    ).format(
+        function=sql.Identifier(function_name(table)),
+        settings=sql.SQL(" ").join(
+            sql.SQL("SET {} = {}").format(sql.Identifier(name), sql.Literal(value))
+            for name, value in row_text_settings.items()
+        ),
+        table=sql.Literal(table),
+        old_block=block_id("old", key_cols, blocks),
+        new_block=block_id("new", key_cols, blocks),
+    )
+
+
+def install(conn, schema_name, table_name, key_cols, blocks) -> int:
+    """
+    Installs the row-hash index of a table on one node, and backfills it.
+    Returns the number of rows hashed.
+    """
+
+    table = f"{schema_name}.{table_name}"
+    relation = sql.Identifier(schema_name, table_name)
+    function = sql.Identifier("ace", function_name(table))
+
+    with local_transaction(conn) as spock:
+        conn.execute(schema_sql)
+        if spock:
+            conn.execute(remove_from_repsets_sql)
+        conn.execute(trigger_function_sql(schema_name, table_name, key_cols, blocks))
+
+        for name, events, level in (
+            ("ace_row_hash", "INSERT OR UPDATE OR DELETE", "ROW"),
+            ("ace_row_hash_truncate", "TRUNCATE", "STATEMENT"),
+        ):
+            trigger = sql.Identifier(name)
+            conn.execute(
+                sql.SQL("DROP TRIGGER IF EXISTS {} ON {}").format(trigger, relation)
+            )
+            conn.execute(
+                sql.SQL(
+                    "CREATE TRIGGER {trigger} AFTER {events} ON {table} "
+                    "FOR EACH {level} EXECUTE FUNCTION {function}()"
+                ).format(
+                    trigger=trigger,
+                    events=sql.SQL(events),
+                    table=relation,
+                    level=sql.SQL(level),
+                    function=function,
+                )
+            )
+            # Spock applies replicated changes as a replica, which fires only
+            # ALWAYS triggers
+            conn.execute(
+                sql.SQL("ALTER TABLE {} ENABLE ALWAYS TRIGGER {}").format(
+                    relation, trigger
+                )
+            )
+
+        # Writes wait until the backfill commits, and are logged after it
+        conn.execute(sql.SQL("LOCK TABLE {} IN SHARE MODE").format(relation))
+        for name, value in row_text_settings.items():
+            conn.execute("SELECT set_config(%s, %s, true)", (name, value))
+        conn.execute(
+            "DELETE FROM ace.row_hash_blocks WHERE table_name = %s", (table,)
+        )
+        conn.execute(
+            sql.SQL(
+                "INSERT INTO ace.row_hash_blocks "
+                "SELECT %s, {block}, count(*), bit_xor(hashtextextended(t::text, 0)) "
+                "FROM {table} t GROUP BY 2"
+            ).format(block=block_id("t", key_cols, blocks), table=relation),
+            (table,),
+        )
+        conn.execute(
+            "INSERT INTO ace.row_hash_tables (table_name, blocks) VALUES (%s, %s) "
+            "ON CONFLICT (table_name) DO UPDATE "
+            "SET blocks = excluded.blocks, installed_at = now()",
+            (table, blocks),
+        )
+
+        rows = conn.execute(
+            "SELECT coalesce(sum(row_count), 0) FROM ace.row_hash_blocks "
+            "WHERE table_name = %s",
+            (table,),
+        ).fetchone()[0]
+
+    return rows
+
+
+def remove(conn, schema_name, table_name) -> bool:
+    """
+    Removes the row-hash index of a table from one node. Returns False if the
+    table had none.
+    """
+
+    table = f"{schema_name}.{table_name}"
+    relation = sql.Identifier(schema_name, table_name)
+
+    with local_transaction(conn):
+        if not installed(conn, table):
+            return False
+
+        for name in ("ace_row_hash", "ace_row_hash_truncate"):
+            conn.execute(
+                sql.SQL("DROP TRIGGER IF EXISTS {} ON {}").format(
+                    sql.Identifier(name), relation
+                )
+            )
+        conn.execute(
+            sql.SQL("DROP FUNCTION IF EXISTS {}()").format(
+                sql.Identifier("ace", function_name(table))
+            )
+        )
+        conn.execute(
+            "DELETE FROM ace.row_hash_blocks WHERE table_name = %s", (table,)
+        )
+        conn.execute(
+            "DELETE FROM ace.row_hash_tables WHERE table_name = %s", (table,)
+        )
+
+    return True
+
+
+def installed(conn, table):
+    """Returns the number of blocks of a table's row-hash index, or None"""
+
+    exists = conn.execute(
+        "SELECT to_regclass('ace.row_hash_tables') IS NOT NULL"
+    ).fetchone()[0]
+    if not exists:
+        return None
+
+    row = conn.execute(
+        "SELECT blocks FROM ace.row_hash_tables WHERE table_name = %s", (table,)
+    ).fetchone()
+
+    return row[0] if row else None
+
+
+def get_summaries(conn, table) -> dict:
+    """
+    Folds the logged changes of a table into one row per block, and returns
+    {block_id: (row_count, hash)} for its non-empty blocks
+    """
+
+    with local_transaction(conn):
+        rows = conn.execute(
+            """
+            WITH logged AS (
+                DELETE FROM ace.row_hash_blocks WHERE table_name = %s
+                RETURNING block_id, row_count, hash
+            ), folded AS (
+                SELECT block_id, sum(row_count)::bigint AS row_count,
+                       bit_xor(hash) AS hash
+                FROM logged GROUP BY block_id
+                HAVING sum(row_count) <> 0
+            ), kept AS (
+                INSERT INTO ace.row_hash_blocks
+                SELECT %s, block_id, row_count, hash FROM folded
+            )
+            SELECT block_id, row_count, hash FROM folded
+            """,
+            (table, table),
+        ).fetchall()
+
+    return {block: (count, hash) for block, count, hash in rows}
@@ -0,0 +1,251 @@
+"""
+Low-impact mode for ACE diffs.
+"""
+
+import threading
+import time
+
+import psycopg
+
+import ace_config as config
+import util
+from ace_progress import percentile
+
+
+class RateLimiter:
+    """Paces the block queries of one worker process"""
+
+    def __init__(self, rows_per_sec, bytes_per_sec, throttle_state, cancel_event):
+        """
+        Args:
+            rows_per_sec, bytes_per_sec: This worker's share of the per-node
+                targets. None or 0 means no limit.
+            throttle_state: The dict shared with the NodeHealthMonitor.
+            cancel_event: Stops a paused worker when the task is cancelled.
+        """
+
+        self.rows_per_sec = rows_per_sec
+        self.bytes_per_sec = bytes_per_sec
+        self.throttle_state = throttle_state
+        self.cancel_event = cancel_event
+        self.next_at = time.monotonic()
+
+    def pace(self, rows, nbytes) -> None:
+        """
+        Called after every block comparison with the rows and bytes it read from
+        each node. Sleeps until the worker is back under its rate.
+        """
+
+        while True:
+            if self.cancel_event.is_set():
+                return
+
+            # One round trip to the manager per block
+            state = self.throttle_state.copy()
+            if not state["paused"]:
+                break
+            time.sleep(config.THROTTLE_PAUSE_POLL_INTERVAL)
+
+        factor = state["factor"]
+        duration = 0.0
+        if self.rows_per_sec:
+            duration = max(duration, rows / (self.rows_per_sec * factor))
+        if self.bytes_per_sec:
+            duration = max(duration, nbytes / (self.bytes_per_sec * factor))
+
+        # Time spent paused or waiting on the nodes is not made up for with
+        # a burst afterwards
+        now = time.monotonic()
+        self.next_at = max(self.next_at, now) + duration
+
+        if self.next_at > now:
+            time.sleep(self.next_at - now)
+
+
+class NodeHealthMonitor:
+    def __init__(
+        self,
+        task,
+        throttle_state,
+        backend_pids,
+        conn_params,
+        progress=None,
+        interval=config.THROTTLE_CHECK_INTERVAL,
+    ):
+        """
+        Args:
+            task: The running task. Its quiet_mode is honoured.
+            throttle_state: The dict shared with the workers' RateLimiters.
+            backend_pids: (host, port, backend_pid) of the task's own
+                connections, which are not counted as active backends.
+            conn_params: Connection parameters for the nodes of the task.
+            progress: The TaskProgress of the task, for block query latencies.
+                The throttle state is also reported through it.
+        """
+
+        self.task = task
+        self.throttle_state = throttle_state
+        self.backend_pids = backend_pids
+        self.conn_params = conn_params
+        self.progress = progress
+        self.interval = interval
+
+        self.conns = {}
+        self.latencies_seen = {}
+        self.pauses = 0
+        self.unhealthy = {}
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(
+            target=self._watch, name="ace-node-health", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+        for conn in self.conns.values():
+            conn.close()
+        self.conns = {}
+
+    def get_conn(self, params):
+        node = (params["host"], str(params["port"]))
+        conn = self.conns.get(node)
+
+        if conn is None or conn.closed:
+            conn = psycopg.connect(**params, autocommit=True)
+            self.conns[node] = conn
+
+        return conn
+
+    def check_node(self, params) -> list:
+        """Returns the thresholds that the node is currently over"""
+
+        node = (params["host"], str(params["port"]))
+        own_pids = [
+            pid
+            for host, port, pid in list(self.backend_pids)
+            if (host, str(port)) == node
+        ]
+        problems = []
+
+        conn = self.get_conn(params)
+        active = conn.execute(
+            """
+            SELECT count(*) FROM pg_stat_activity
+            WHERE state = 'active'
+            AND backend_type = 'client backend'
+            AND pid <> pg_backend_pid()
+            AND pid <> ALL(%s::int[])
+            """,
+            (own_pids,),
+        ).fetchone()[0]
+
+        if active > config.THROTTLE_MAX_ACTIVE_BACKENDS:
+            problems.append(f"{active} active backends")
+
+        has_lag_tracker = conn.execute(
+            "SELECT to_regclass('spock.lag_tracker') IS NOT NULL"
+        ).fetchone()[0]
+
+        if has_lag_tracker:
+            lag = conn.execute(
+                "SELECT max(extract(epoch FROM replication_lag)) "
+                "FROM spock.lag_tracker"
+            ).fetchone()[0]
+
+            if lag is not None and lag > config.THROTTLE_MAX_LAG_SECONDS:
+                problems.append(f"replication lag of {float(lag):.1f}s")
+
+        return problems
+
+    def check_latency(self) -> list:
+        if not self.progress:
+            return []
+
+        problems = []
+        for node, latencies in list(self.progress.latencies.items()):
+            # Only blocks finished since the last check count. Paused workers
+            # finish none, and must not be held back by old latencies.
+            seen = self.latencies_seen.get(node, 0)
+            self.latencies_seen[node] = len(latencies)
+            recent = sorted(latencies[seen:][-config.THROTTLE_LATENCY_WINDOW :])
+
+            p95 = percentile(recent, 95)
+            if p95 is not None and p95 > config.THROTTLE_MAX_QUERY_LATENCY:
+                problems.append(f"{node}: p95 block query latency of {p95:.2f}s")
+
+        return problems
+
+    def check(self) -> None:
+        unhealthy = {}
+
+        for params in self.conn_params:
+            try:
+                problems = self.check_node(params)
+            except Exception as e:
+                # A node that cannot answer a health check is not healthy
+                problems = [f"health check failed: {str(e)}"]
+                self.conns.pop((params["host"], str(params["port"])), None)
+
+            if problems:
+                unhealthy[params["host"]] = problems
+
+        latency_problems = self.check_latency()
+        if latency_problems:
+            unhealthy["latency"] = latency_problems
+
+        state = self.throttle_state.copy()
+        factor = state["factor"]
+
+        if unhealthy:
+            # Multiplicative decrease, additive increase
+            factor = max(factor / 2, config.THROTTLE_MIN_FACTOR)
+            if not state["paused"]:
+                self.pauses += 1
+                util.message(
+                    f"Pausing diff workers, nodes are busy: {unhealthy}",
+                    p_state="warning",
+                    quiet_mode=self.task.quiet_mode,
+                )
+        else:
+            factor = min(factor + config.THROTTLE_RECOVERY_STEP, 1.0)
+
+        self.throttle_state.update({"factor": factor, "paused": bool(unhealthy)})
+        self.unhealthy = unhealthy
+
+        if self.progress:
+            self.progress.set(
+                throttle={
+                    "paused": bool(unhealthy),
+                    "rate_factor": round(factor, 2),
+                    "pauses": self.pauses,
+                    "unhealthy": unhealthy,
+                }
+            )
+
+    def _watch(self) -> None:
+        while True:
+            try:
+                self.check()
+            except Exception as e:
+                util.message(
+                    f"Could not check node health: {str(e)}",
+                    p_state="warning",
+                    quiet_mode=self.task.quiet_mode,
+                )
+
+            if self._stop.wait(self.interval):
+                return
@@ -0,0 +1,109 @@
+"""
+Write counters of tables, for skipping tables that have had no writes since
+they were last verified.
+"""
+
+import ace_connections
+
+counters_sql = """
+SELECT concat_ws('.', s.schemaname, s.relname),
+       s.n_tup_ins,
+       s.n_tup_upd,
+       s.n_tup_del,
+       c.relfilenode,
+       d.stats_reset::text
+FROM pg_stat_user_tables s
+JOIN pg_class c ON c.oid = s.relid
+CROSS JOIN (
+    SELECT stats_reset FROM pg_stat_database WHERE datname = current_database()
+) d
+"""
+
+COUNTERS = ("ins", "upd", "del")
+
+
+def get_write_counters(node_params) -> dict:
+    """
+    Returns {table: {node: {"ins": ..., "upd": ..., "del": ...,
+    "relfilenode": ..., "stats_reset": ...}}} for every table on the given nodes
+    """
+
+    counters = {}
+
+    for node, params in node_params.items():
+        conn = ace_connections.get_node_conn(params)
+
+        try:
+            rows = conn.execute(counters_sql).fetchall()
+        finally:
+            if not ace_connections.persistent:
+                conn.close()
+
+        for table, ins, upd, dels, relfilenode, stats_reset in rows:
+            counters.setdefault(table, {})[node] = {
+                "ins": ins,
+                "upd": upd,
+                "del": dels,
+                "relfilenode": relfilenode,
+                "stats_reset": stats_reset,
+            }
+
+    return counters
+
+
+def total_writes(node_counters) -> int:
+    return sum(node_counters[name] for name in COUNTERS)
+
+
+def writes_since(previous, current):
+    """
+    Returns the number of writes to a table on all nodes since its counters
+    were recorded, or None if that cannot be told
+    """
+
+    if not current or not previous:
+        return None
+
+    writes = 0
+    for node, now in current.items():
+        before = previous.get(node)
+
+        # Watermarks from before stats reset times were recorded hold a
+        # single number per node
+        if not isinstance(before, dict):
+            return None
+
+        if before.get("stats_reset") != now["stats_reset"]:
+            return None
+
+        # TRUNCATE does not move the tuple counters, but gives the table a new
+        # relfilenode
+        if before.get("relfilenode") != now["relfilenode"]:
+            return None
+
+        deltas = [now[name] - before.get(name, 0) for name in COUNTERS]
+        if any(delta < 0 for delta in deltas):
+            return None
+
+        writes += sum(deltas)
+
+    return writes
+
+
+def is_unchanged(watermark, current, nodes) -> bool:
+    """
+    True if a table was last verified without differences, and has had no
+    writes on any of the nodes since
+    """
+
+    if not watermark or not watermark["last_verified_at"]:
+        return False
+
+    if watermark["last_status"] != "COMPLETED" or watermark["mismatch"]:
+        return False
+
+    current = current or {}
+    if set(current) != set(nodes):
+        return False
+
+    return writes_since(watermark["write_counters"], current) == 0